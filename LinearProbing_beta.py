@@ -14,7 +14,7 @@ from torch.utils.data import distributed
 import tensorboard_logger as tb_logger
 
 from torchvision import transforms, datasets
-from dataset import RGB2Lab, RGB2YCbCr
+from dataset import RGB2Lab, RGB2YCbCr, CorruptedCIFAR10
 from util import adjust_learning_rate, AverageMeter, accuracy
 
 from models.alexnet import MyAlexNetCMC, MyAlexNetCMC_cc
@@ -65,6 +65,7 @@ def parse_option():
 	parser.add_argument('--feat_version', type=str, default='Lab')
 	# parser.add_argument('--corruption', type=str, default='original')
 	parser.add_argument('--level', type=int, default=5, help='The level of corruption')
+	parser.add_argument('--offline_aug', action='store_true', help='read corruptions from materialize_corruption.py shards')
 	# path definition
 	parser.add_argument('--data_folder', type=str, default=None, help='path to data')
 	parser.add_argument('--save_path', type=str, default=None, help='path to save linear classifier')
@@ -191,6 +192,18 @@ def get_train_val_loader(args):
 		val_dataset = datasets.CIFAR10(root=args.data_folder,
 			train=False, download=True, transform=val_transform)
 
+		if args.offline_aug:
+			# clean and corrupted images are cropped and flipped together
+			train_dataset = CorruptedCIFAR10(root=args.data_folder, view=args.view, level=args.level,
+				train=True, download=True,
+				transform=transforms.Compose([
+					transforms.RandomCrop(32, padding=4),
+					transforms.RandomHorizontalFlip(),
+				]),
+				split_transform=normalize_lst)
+			val_dataset = CorruptedCIFAR10(root=args.data_folder, view=args.view, level=args.level,
+				train=False, download=True, split_transform=normalize_lst)
+
 	print('number of train: {}'.format(len(train_dataset)))
 	print('number of val: {}'.format(len(val_dataset)))
 
@@ -1,48 +1,128 @@
 import torch
 from torch import nn
-from .alias_multinomial import AliasMethod
+from .sampler import UniformSampler, _compiling
+from .storage import register_memory, load_memory, read_memory, read_slice, write_memory, write_slice
+import functools
 import math
 
 
+class GatherScore(torch.autograd.Function):
+    """
+    out[b, k] = <read(idx[b, k]), x[b]> computed K-tile by K-tile, so only a (B, chunk, D)
+    block of gathered rows is alive at a time; backward gathers the tiles again instead of
+    keeping them. The rows of the positives idx[:, 0] are about to be overwritten by the memory
+    update, backward reads them from a snapshot taken here; rows written by a later forward
+    before this backward are read as updated.
+    """
+    @staticmethod
+    def forward(ctx, read, idx, x, chunk):
+        batchSize, K = idx.shape
+        out = x.new_empty(batchSize, K)
+        for k in range(0, K, chunk):
+            weight = read(idx[:, k:k + chunk].reshape(-1)).view(batchSize, -1, x.size(1))
+            out[:, k:k + chunk] = torch.bmm(weight.type_as(x), x.unsqueeze(2)).squeeze(2)
+        ctx.read = read
+        ctx.chunk = chunk
+        ctx.positives = read(idx[:, 0])
+        ctx.save_for_backward(idx)
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        idx, = ctx.saved_tensors
+        batchSize, K = idx.shape
+        # sorted positives to find which gathered rows have been updated since forward
+        pos, order = idx[:, 0].sort()
+        grad_x = grad_out.new_zeros(batchSize, ctx.positives.size(1))
+        for k in range(0, K, ctx.chunk):
+            tile = idx[:, k:k + ctx.chunk].contiguous().view(-1)
+            weight = ctx.read(tile)
+            slot = torch.searchsorted(pos, tile).clamp_(max=batchSize - 1)
+            stale = pos[slot] == tile
+            weight[stale] = ctx.positives[order[slot[stale]]]
+            weight = weight.view(batchSize, -1, grad_x.size(1)).type_as(grad_out)
+            grad_x += torch.bmm(grad_out[:, k:k + ctx.chunk].unsqueeze(1), weight).squeeze(1)
+        return None, None, grad_x, None
+
+
+def normalize(params, i, out, outputSize, name, sync_free=False):
+    """
+    out / Z, Z = params[i] being set to mean(out) * outputSize by the first batch if calibrate()
+    was not called. With sync_free Z stays on the device, otherwise it is read with .item().
+    """
+    if sync_free:
+        Z = params[i]
+        Z = torch.where(Z < 0, (out.detach().mean() * outputSize).to(Z.dtype), Z)
+        params[i].copy_(Z)
+        return torch.div(out, Z)
+    Z = params[i].item()
+    if Z < 0:
+        params[i] = out.detach().mean() * outputSize
+        Z = params[i].clone().detach().item()
+        print("normalization constant {} is set to {:.1f}".format(name, Z))
+    return torch.div(out, Z)
+
+
 class NCEAverage(nn.Module):
 
-    def __init__(self, inputSize, outputSize, K, T=0.07, momentum=0.5, use_softmax=False):
+    def __init__(self, inputSize, outputSize, K, T=0.07, momentum=0.5, use_softmax=False, sampler=None,
+                 chunk_size=None, storage='float32', sync_free=False, fused_memory=False, shared_negatives=False):
         super(NCEAverage, self).__init__()
         self.nLem = outputSize
-        self.unigrams = torch.ones(self.nLem)
-        self.multinomial = AliasMethod(self.unigrams)
-        self.multinomial.cuda()
+        # noise distribution of the negatives, see NCE/sampler.py
+        self.sampler = sampler if sampler is not None else UniformSampler(self.nLem)
         self.K = K
+        self.T = T
+        self.momentum = momentum
         self.use_softmax = use_softmax
+        # score the K+1 samples in tiles of chunk_size instead of gathering (B, K+1, D) weights
+        self.chunk_size = chunk_size
+        # keep Z on the device, forward then never waits for it
+        self.sync_free = sync_free
+        # both views in one (N, 2, D) buffer `memory`, [:, 0] is memory_l and [:, 1] memory_ab
+        self.fused_memory = fused_memory
+        # one set of K negatives for the whole batch, scored with a (B, D) x (D, K) mm
+        self.shared_negatives = shared_negatives
+        self._positives = None
 
         self.register_buffer('params', torch.tensor([K, T, -1, -1, momentum]))
+        self._init_memory(inputSize, outputSize, storage)
+
+    def _init_memory(self, inputSize, outputSize, storage):
         stdv = 1. / math.sqrt(inputSize / 3)
-        self.register_buffer('memory_l', torch.rand(outputSize, inputSize).mul_(2 * stdv).add_(-stdv))
-        self.register_buffer('memory_ab', torch.rand(outputSize, inputSize).mul_(2 * stdv).add_(-stdv))
+        memory_l = torch.rand(outputSize, inputSize).mul_(2 * stdv).add_(-stdv)
+        memory_ab = torch.rand(outputSize, inputSize).mul_(2 * stdv).add_(-stdv)
+        # memories are stored as `storage` (see NCE/storage.py), read and updated in float32
+        if self.fused_memory:
+            register_memory(self, 'memory', torch.stack([memory_l, memory_ab], 1), storage)
+        else:
+            register_memory(self, 'memory_l', memory_l, storage)
+            register_memory(self, 'memory_ab', memory_ab, storage)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys,
+                              unexpected_keys, error_msgs):
+        if self.fused_memory and prefix + 'memory_l' in state_dict and prefix + 'memory' not in state_dict:
+            # checkpoint with separate memories
+            for suffix in ['', '_scale']:
+                if prefix + 'memory_l' + suffix in state_dict:
+                    state_dict[prefix + 'memory' + suffix] = torch.stack(
+                        [state_dict.pop(prefix + 'memory_l' + suffix), state_dict.pop(prefix + 'memory_ab' + suffix)], 1)
+        # checkpoint of another storage
+        for name in ['memory'] if self.fused_memory else ['memory_l', 'memory_ab']:
+            if hasattr(self, name):
+                load_memory(self, state_dict, prefix, name)
+        super(NCEAverage, self)._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys,
+                                                      unexpected_keys, error_msgs)
+        # forward reads the host copies of the hyperparameters
+        K, self.T, self.momentum = self.params[[0, 1, 4]].tolist()
+        self.K = int(K)
 
     def forward(self, l, ab, y, idx=None):
-        K = int(self.params[0].item())
-        T = self.params[1].item()
-        Z_l = self.params[2].item()
-        Z_ab = self.params[3].item()
-
-        momentum = self.params[4].item()
-        batchSize = l.size(0)
-        outputSize = self.memory_l.size(0)
-        inputSize = self.memory_l.size(1)
+        T = self.T
+        outputSize = self.nLem
 
         # score computation
-        if idx is None:
-            idx = self.multinomial.draw(batchSize * (self.K + 1)).view(batchSize, -1)
-            idx.select(1, 0).copy_(y.data)
-        # sample
-        weight_l = torch.index_select(self.memory_l, 0, idx.view(-1)).detach()
-        weight_l = weight_l.view(batchSize, K + 1, inputSize)
-        out_ab = torch.bmm(weight_l, ab.view(batchSize, inputSize, 1))
-        # sample
-        weight_ab = torch.index_select(self.memory_ab, 0, idx.view(-1)).detach()
-        weight_ab = weight_ab.view(batchSize, K + 1, inputSize)
-        out_l = torch.bmm(weight_ab, l.view(batchSize, inputSize, 1))
+        out_l, out_ab = self.score(l, ab, y, idx)
 
         if self.use_softmax:
             out_ab = torch.div(out_ab, T)
@@ -54,36 +134,153 @@ class NCEAverage(nn.Module):
             out_l = torch.exp(torch.div(out_l, T))
             # set Z_0 if haven't been set yet,
             # Z_0 is used as a constant approximation of Z, to scale the probs
-            if Z_l < 0:
-                self.params[2] = out_l.mean() * outputSize
-                Z_l = self.params[2].clone().detach().item()
-                print("normalization constant Z_l is set to {:.1f}".format(Z_l))
-            if Z_ab < 0:
-                self.params[3] = out_ab.mean() * outputSize
-                Z_ab = self.params[3].clone().detach().item()
-                print("normalization constant Z_ab is set to {:.1f}".format(Z_ab))
-            # compute out_l, out_ab
-            out_l = torch.div(out_l, Z_l).contiguous()
-            out_ab = torch.div(out_ab, Z_ab).contiguous()
+            out_l = self._normalize(out_l, 2, 'Z_l').contiguous()
+            out_ab = self._normalize(out_ab, 3, 'Z_ab').contiguous()
 
         # # update memory
         with torch.no_grad():
-            l_pos = torch.index_select(self.memory_l, 0, y.view(-1))
-            l_pos.mul_(momentum)
-            l_pos.add_(torch.mul(l, 1 - momentum))
-            l_norm = l_pos.pow(2).sum(1, keepdim=True).pow(0.5)
-            updated_l = l_pos.div(l_norm)
-            self.memory_l.index_copy_(0, y, updated_l)
-
-            ab_pos = torch.index_select(self.memory_ab, 0, y.view(-1))
-            ab_pos.mul_(momentum)
-            ab_pos.add_(torch.mul(ab, 1 - momentum))
-            ab_norm = ab_pos.pow(2).sum(1, keepdim=True).pow(0.5)
-            updated_ab = ab_pos.div(ab_norm)
-            self.memory_ab.index_copy_(0, y, updated_ab)
+            self.update(l, ab, y, self.momentum)
 
         return out_l, out_ab
 
+    @torch.no_grad()
+    def calibrate(self, l, ab, y):
+        """set Z_l and Z_ab from a batch, leaving the memories untouched"""
+        out_l, out_ab = self.score(l, ab, y)
+        self.params[2] = self._batch_mean(torch.exp(torch.div(out_l, self.T))) * self.nLem
+        self.params[3] = self._batch_mean(torch.exp(torch.div(out_ab, self.T))) * self.nLem
+        print("normalization constants Z_l, Z_ab are set to {:.1f}, {:.1f}".format(*self.params[2:4].tolist()))
+
+    def _batch_mean(self, x):
+        """mean of the exp(s / T) of a batch, Z / outputSize"""
+        return x.mean()
+
+    def _normalize(self, out, i, name):
+        return normalize(self.params, i, out, self.nLem, name, self.sync_free)
+
+    def memory_rows(self, view, start=0, end=None):
+        """float32 rows start:end of memory_l (view 0) or memory_ab (view 1), not a copy for float32 storage"""
+        end = self.nLem if end is None else end
+        if self.fused_memory:
+            return read_slice(self, 'memory', start, end).select(1, view)
+        return read_slice(self, ['memory_l', 'memory_ab'][view], start, end)
+
+    def score(self, l, ab, y, idx=None):
+        """(B, K+1, 1) similarities of ab to memory_l and of l to memory_ab, column 0 is y"""
+        K = self.K
+        batchSize = l.size(0)
+        if self.sampler.device != y.device:
+            self.sampler.to(y.device)
+        if idx is None and self.shared_negatives:
+            negatives = self.sampler.draw(K)
+            out_l, out_ab = self.score_shared(negatives, l, ab, y)
+            if self.sampler.observes:
+                idx = torch.cat([y.view(-1, 1), negatives.view(1, -1).expand(batchSize, K)], 1)
+                self.sampler.observe(idx, (out_l + out_ab).view(batchSize, -1).detach() / 2)
+            return out_l, out_ab
+        if idx is None:
+            idx = self.sampler.draw(batchSize * (K + 1)).view(batchSize, -1)
+            idx.select(1, 0).copy_(y.data)
+        if self.fused_memory:
+            out_l, out_ab = self.score_fused(idx, l, ab)
+        else:
+            out_l, out_ab = self.score_rows(functools.partial(read_memory, self, 'memory_l'),
+                                            functools.partial(read_memory, self, 'memory_ab'), idx, l, ab)
+        if self.sampler.observes:
+            self.sampler.observe(idx, (out_l + out_ab).view(batchSize, -1).detach() / 2)
+        return out_l, out_ab
+
+    def score_rows(self, read_l, read_ab, idx, l, ab):
+        """score with the rows `read_l(idx)` / `read_ab(idx)` of the two memories"""
+        batchSize, inputSize = l.shape
+        if self.chunk_size:
+            out_ab = GatherScore.apply(read_l, idx, ab, self.chunk_size).unsqueeze(2)
+            out_l = GatherScore.apply(read_ab, idx, l, self.chunk_size).unsqueeze(2)
+        else:
+            # sample
+            weight_l = read_l(idx).detach()
+            weight_l = weight_l.view(batchSize, -1, inputSize)
+            out_ab = torch.bmm(weight_l, ab.view(batchSize, inputSize, 1))
+            # sample
+            weight_ab = read_ab(idx).detach()
+            weight_ab = weight_ab.view(batchSize, -1, inputSize)
+            out_l = torch.bmm(weight_ab, l.view(batchSize, inputSize, 1))
+        return out_l, out_ab
+
+    def score_shared(self, negatives, l, ab, y):
+        """
+        (B, K+1, 1) scores against the positives y and the same K negatives for every anchor:
+        B + K rows are gathered instead of B (K+1) and the negatives are scored with one mm
+        """
+        batchSize = l.size(0)
+        rows = torch.cat([y, negatives])
+        if self.fused_memory:
+            weight = read_memory(self, 'memory', rows).detach()
+            self._positives = weight[:batchSize]
+            weight_l, weight_ab = weight.select(1, 0), weight.select(1, 1)
+        else:
+            weight_l = read_memory(self, 'memory_l', rows).detach()
+            weight_ab = read_memory(self, 'memory_ab', rows).detach()
+        out_ab = torch.cat([torch.mul(weight_l[:batchSize], ab).sum(1, keepdim=True),
+                            torch.mm(ab, weight_l[batchSize:].t())], 1)
+        out_l = torch.cat([torch.mul(weight_ab[:batchSize], l).sum(1, keepdim=True),
+                           torch.mm(l, weight_ab[batchSize:].t())], 1)
+        return out_l.unsqueeze(2), out_ab.unsqueeze(2)
+
+    def score_fused(self, idx, l, ab):
+        """
+        score_rows for the fused memory: one gather of both views and one bmm of the (B, 2(K+1), D)
+        rows against [ab, l], the pairs across views are computed too but the rows are read once.
+        The positive rows are kept for update.
+        """
+        batchSize, inputSize = l.shape
+        self._positives = None
+        if self.chunk_size:
+            return self.score_rows(lambda i: read_memory(self, 'memory', i).select(1, 0),
+                                   lambda i: read_memory(self, 'memory', i).select(1, 1), idx, l, ab)
+        weight = read_memory(self, 'memory', idx).detach()
+        out = torch.bmm(weight.view(batchSize, -1, inputSize), torch.stack([ab, l], 2))
+        out = out.view(batchSize, -1, 2, 2)
+        self._positives = weight.view(batchSize, -1, 2, inputSize).select(1, 0)
+        return out[:, :, 1, 1].unsqueeze(2), out[:, :, 0, 0].unsqueeze(2)
+
+    def update_fused(self, l, ab, y, momentum):
+        """
+        momentum update of both views of the rows y in one pass. Of duplicate indices in y the
+        last one wins: all of them write the same row, so the result does not depend on the order
+        index_copy_ applies them in.
+        """
+        y, order = y.sort(stable=True)
+        first = torch.ones_like(y, dtype=torch.bool)
+        first[1:] = y[1:] != y[:-1]
+        segment = first.long().cumsum(0) - 1
+        last = torch.zeros_like(y).scatter_reduce_(0, segment, torch.arange(len(y), device=y.device), 'amax')
+        src = order[last[segment]]
+
+        pos = read_memory(self, 'memory', y) if self._positives is None else self._positives[src]
+        self._positives = None
+        pos.mul_(momentum).add_(torch.stack([l, ab], 1)[src], alpha=1 - momentum)
+        pos.div_(pos.pow(2).sum(2, keepdim=True).pow(0.5))
+        write_memory(self, 'memory', y, pos)
+
+    def update(self, l, ab, y, momentum):
+        """momentum update of the rows y of both memories"""
+        if self.fused_memory:
+            return self.update_fused(l, ab, y, momentum)
+        l_pos = read_memory(self, 'memory_l', y)
+        l_pos.mul_(momentum)
+        l_pos.add_(torch.mul(l, 1 - momentum))
+        l_norm = l_pos.pow(2).sum(1, keepdim=True).pow(0.5)
+        updated_l = l_pos.div(l_norm)
+        write_memory(self, 'memory_l', y, updated_l)
+
+        ab_pos = read_memory(self, 'memory_ab', y)
+        ab_pos.mul_(momentum)
+        ab_pos.add_(torch.mul(ab, 1 - momentum))
+        ab_norm = ab_pos.pow(2).sum(1, keepdim=True).pow(0.5)
+        updated_ab = ab_pos.div(ab_norm)
+        write_memory(self, 'memory_ab', y, updated_ab)
+
 
 # =========================
 # InsDis and MoCo
@@ -91,66 +288,119 @@ class NCEAverage(nn.Module):
 
 class MemoryInsDis(nn.Module):
     """Memory bank with instance discrimination"""
-    def __init__(self, inputSize, outputSize, K, T=0.07, momentum=0.5, use_softmax=False):
+    def __init__(self, inputSize, outputSize, K, T=0.07, momentum=0.5, use_softmax=False, sampler=None,
+                 storage='float32', sync_free=False):
         super(MemoryInsDis, self).__init__()
         self.nLem = outputSize
-        self.unigrams = torch.ones(self.nLem)
-        self.multinomial = AliasMethod(self.unigrams)
-        self.multinomial.cuda()
+        # noise distribution of the negatives, see NCE/sampler.py
+        self.sampler = sampler if sampler is not None else UniformSampler(self.nLem)
         self.K = K
+        self.T = T
+        self.momentum = momentum
         self.use_softmax = use_softmax
+        # keep Z on the device, forward then never waits for it
+        self.sync_free = sync_free
 
         self.register_buffer('params', torch.tensor([K, T, -1, momentum]))
         stdv = 1. / math.sqrt(inputSize / 3)
-        self.register_buffer('memory', torch.rand(outputSize, inputSize).mul_(2 * stdv).add_(-stdv))
-
-    def forward(self, x, y, idx=None):
-        K = int(self.params[0].item())
-        T = self.params[1].item()
-        Z = self.params[2].item()
-        momentum = self.params[3].item()
-
+        register_memory(self, 'memory', torch.rand(outputSize, inputSize).mul_(2 * stdv).add_(-stdv), storage)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys,
+                              unexpected_keys, error_msgs):
+        load_memory(self, state_dict, prefix, 'memory')
+        super(MemoryInsDis, self)._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys,
+                                                        unexpected_keys, error_msgs)
+        # forward reads the host copies of the hyperparameters
+        K, self.T, self.momentum = self.params[[0, 1, 3]].tolist()
+        self.K = int(K)
+
+    def score(self, x, y, idx=None):
+        """(B, K+1, 1) similarities of x to the memory, column 0 is y"""
         batchSize = x.size(0)
-        outputSize = self.memory.size(0)
         inputSize = self.memory.size(1)
-
-        # score computation
+        if self.sampler.device != y.device:
+            self.sampler.to(y.device)
         if idx is None:
-            idx = self.multinomial.draw(batchSize * (self.K + 1)).view(batchSize, -1)
+            idx = self.sampler.draw(batchSize * (self.K + 1)).view(batchSize, -1)
             idx.select(1, 0).copy_(y.data)
 
         # sample
-        weight = torch.index_select(self.memory, 0, idx.view(-1))
-        weight = weight.view(batchSize, K + 1, inputSize)
+        weight = read_memory(self, 'memory', idx)
+        weight = weight.view(batchSize, self.K + 1, inputSize)
         out = torch.bmm(weight, x.view(batchSize, inputSize, 1))
+        if self.sampler.observes:
+            self.sampler.observe(idx, out.view(batchSize, self.K + 1).detach())
+        return out
+
+    @torch.no_grad()
+    def calibrate(self, x, y):
+        """set Z from a batch, leaving the memory untouched"""
+        self.params[2] = torch.exp(torch.div(self.score(x, y), self.T)).mean() * self.memory.size(0)
+        print("normalization constant Z is set to {:.1f}".format(self.params[2].item()))
+
+    def forward(self, x, y, idx=None):
+        T = self.T
+        momentum = self.momentum
+        outputSize = self.memory.size(0)
+
+        # score computation
+        out = self.score(x, y, idx)
 
         if self.use_softmax:
             out = torch.div(out, T)
             out = out.squeeze().contiguous()
         else:
             out = torch.exp(torch.div(out, T))
-            if Z < 0:
-                self.params[2] = out.mean() * outputSize
-                Z = self.params[2].clone().detach().item()
-                print("normalization constant Z is set to {:.1f}".format(Z))
             # compute the out
-            out = torch.div(out, Z).squeeze().contiguous()
+            out = normalize(self.params, 2, out, outputSize, 'Z', self.sync_free).squeeze().contiguous()
 
         # # update memory
         with torch.no_grad():
-            weight_pos = torch.index_select(self.memory, 0, y.view(-1))
+            weight_pos = read_memory(self, 'memory', y)
             weight_pos.mul_(momentum)
             weight_pos.add_(torch.mul(x, 1 - momentum))
             weight_norm = weight_pos.pow(2).sum(1, keepdim=True).pow(0.5)
             updated_weight = weight_pos.div(weight_norm)
-            self.memory.index_copy_(0, y, updated_weight)
+            write_memory(self, 'memory', y, updated_weight)
 
         return out
 
 
+def queue_slots(start, batchSize, queueSize):
+    """the at most two slices [a, b) of a ring buffer written by an enqueue of batchSize at start"""
+    end = start + batchSize
+    if end <= queueSize:
+        return [(start, end)]
+    return [(start, queueSize), (0, end - queueSize)]
+
+
+class QueueScore(torch.autograd.Function):
+    """
+    q @ queue.T against the live queue, without copying it. Backward needs the queue of forward
+    while the enqueue that follows overwrites batchSize slots from `start` (or the slots of a
+    long tensor), so only those rows are saved and backward corrects for them.
+    """
+    @staticmethod
+    def forward(ctx, q, queue, start):
+        ctx.queue = queue
+        if torch.is_tensor(start):
+            ctx.slots = [start]
+        else:
+            ctx.slots = [slice(a, b) for a, b in queue_slots(start, q.size(0), queue.size(0))]
+        ctx.old = [queue[s].clone() for s in ctx.slots]
+        return torch.mm(q, queue.t())
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        grad_q = grad_out.mm(ctx.queue.type_as(grad_out))
+        for s, old in zip(ctx.slots, ctx.old):
+            grad_q += grad_out[:, s].mm((old - ctx.queue[s]).type_as(grad_out))
+        return grad_q, None, None
+
+
 class MemoryMoCo(nn.Module):
     """Fixed-size queue with momentum encoder"""
-    def __init__(self, inputSize, outputSize, K, T=0.07, use_softmax=False):
+    def __init__(self, inputSize, outputSize, K, T=0.07, use_softmax=False, storage='float32', sync_free=False):
         super(MemoryMoCo, self).__init__()
         self.outputSize = outputSize
         self.inputSize = inputSize
@@ -158,47 +408,79 @@ class MemoryMoCo(nn.Module):
         self.T = T
         self.index = 0
         self.use_softmax = use_softmax
+        # keep Z on the device, forward then never waits for it
+        self.sync_free = sync_free
 
         self.register_buffer('params', torch.tensor([-1]))
+        # queue pointer, self.index is its host copy
+        self.register_buffer('ptr', torch.zeros(1, dtype=torch.long))
         stdv = 1. / math.sqrt(inputSize / 3)
-        self.register_buffer('memory', torch.rand(self.queueSize, inputSize).mul_(2 * stdv).add_(-stdv))
+        register_memory(self, 'memory', torch.rand(self.queueSize, inputSize).mul_(2 * stdv).add_(-stdv), storage)
         print('using queue shape: ({},{})'.format(self.queueSize, inputSize))
 
-    def forward(self, q, k):
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys,
+                              unexpected_keys, error_msgs):
+        # checkpoints saved before the pointer was stored start from the beginning of the queue
+        state_dict.setdefault(prefix + 'ptr', torch.zeros(1, dtype=torch.long))
+        load_memory(self, state_dict, prefix, 'memory')
+        super(MemoryMoCo, self)._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys,
+                                                      unexpected_keys, error_msgs)
+        self.index = int(self.ptr.item()) % self.queueSize
+
+    def _start(self, batchSize):
+        """where the next enqueue goes: self.index, or with sync_free its slots computed from ptr"""
+        if self.sync_free:
+            return (self.ptr + torch.arange(batchSize, device=self.ptr.device)).remainder_(self.queueSize)
+        return self.index
+
+    def score(self, q, k, start=None):
+        """(B, 1 + K) similarities of q to its key and to the queue"""
         batchSize = q.shape[0]
-        k = k.detach()
-
-        Z = self.params[0].item()
-
+        start = self._start(batchSize) if start is None else start
         # pos logit
         l_pos = torch.bmm(q.view(batchSize, 1, -1), k.view(batchSize, -1, 1))
         l_pos = l_pos.view(batchSize, 1)
         # neg logit
-        queue = self.memory.clone()
-        l_neg = torch.mm(queue.detach(), q.transpose(1, 0))
-        l_neg = l_neg.transpose(0, 1)
+        if _compiling():
+            # autograd Functions holding the live queue do not survive tracing, score a copy
+            l_neg = torch.mm(q, read_memory(self, 'memory', copy=True).t())
+        else:
+            l_neg = QueueScore.apply(q, read_memory(self, 'memory'), start)
+        return torch.cat((l_pos, l_neg), dim=1)
+
+    @torch.no_grad()
+    def calibrate(self, q, k):
+        """set Z from a batch, leaving the queue untouched"""
+        self.params[0] = torch.exp(torch.div(self.score(q, k), self.T)).mean() * self.outputSize
+        print("normalization constant Z is set to {:.1f}".format(self.params[0].item()))
+
+    def forward(self, q, k):
+        batchSize = q.shape[0]
+        k = k.detach()
+        start = self._start(batchSize)
 
-        out = torch.cat((l_pos, l_neg), dim=1)
+        out = self.score(q, k, start)
 
         if self.use_softmax:
             out = torch.div(out, self.T)
             out = out.squeeze().contiguous()
         else:
             out = torch.exp(torch.div(out, self.T))
-            if Z < 0:
-                self.params[0] = out.mean() * self.outputSize
-                Z = self.params[0].clone().detach().item()
-                print("normalization constant Z is set to {:.1f}".format(Z))
             # compute the out
-            out = torch.div(out, Z).squeeze().contiguous()
+            out = normalize(self.params, 0, out, self.outputSize, 'Z', self.sync_free).squeeze().contiguous()
 
         # # update memory
         with torch.no_grad():
-            out_ids = torch.arange(batchSize).cuda()
-            out_ids += self.index
-            out_ids = torch.fmod(out_ids, self.queueSize)
-            out_ids = out_ids.long()
-            self.memory.index_copy_(0, out_ids, k)
+            if self.sync_free:
+                # self.index is left behind, ptr alone tracks the queue
+                write_memory(self, 'memory', start, k)
+                self.ptr.add_(batchSize).remainder_(self.queueSize)
+                return out
+            offset = 0
+            for a, b in queue_slots(self.index, batchSize, self.queueSize):
+                write_slice(self, 'memory', a, k[offset:offset + b - a])
+                offset += b - a
             self.index = (self.index + batchSize) % self.queueSize
+            self.ptr.fill_(self.index)
 
         return out
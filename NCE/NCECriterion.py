@@ -1,46 +1,97 @@
+import math
+
 import torch
 from torch import nn
 
 eps = 1e-7
 
 
+class NCELoss(torch.autograd.Function):
+    """
+    Eq. (12) in log space, straight from the (B, K+1) probabilities x, column 0 the positive:
+        log D1 = log P_pos - log(P_pos + m Pn + eps)
+        log D0 = log(m Pn) - log(P_neg + m Pn + eps)
+    so the loss is (sum log1p((x + eps) / (m Pn)) - sum log(P_pos / (m Pn))) / B, whose terms stay
+    small instead of cancelling against B m log(m Pn). Forward holds one chunk of
+    `chunk` rows at a time, backward writes the gradient into a single buffer.
+    """
+    @staticmethod
+    def forward(ctx, x, n_data, chunk):
+        P = x.view(x.size(0), -1)
+        bsz, m = P.size(0), P.size(1) - 1
+        mPn = m / float(n_data)
+        total = P.new_zeros(1, dtype=torch.float64)
+        for i in range(0, bsz, chunk):
+            total += P[i:i + chunk].div(mPn).add_(eps / mPn).log1p_().sum().double()
+        total -= P.select(1, 0).div(mPn).log_().sum().double()
+
+        ctx.save_for_backward(x)
+        ctx.c = mPn + eps
+        return total.div_(bsz).to(x.dtype)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, = ctx.saved_tensors
+        P = x.view(x.size(0), -1)
+        scale = grad_output / P.size(0)
+        grad = P.add(ctx.c).reciprocal_().mul_(scale)
+        grad.select(1, 0).sub_(P.select(1, 0).reciprocal().mul_(scale))
+        return grad.view_as(x), None, None
+
+
 class NCECriterion(nn.Module):
     """
     Eq. (12): L_{NCE}
     """
-    def __init__(self, n_data):
+    def __init__(self, n_data, chunk_size=None):
         super(NCECriterion, self).__init__()
         self.n_data = n_data
+        # rows per log(x + c) temporary, ~1M entries by default
+        self.chunk_size = chunk_size
 
     def forward(self, x):
-        bsz = x.shape[0]
-        m = x.size(1) - 1
-
-        # noise distribution
-        Pn = 1 / float(self.n_data)
+        chunk = self.chunk_size or max(1, (1 << 20) // max(1, x[0].numel()))
+        return NCELoss.apply(x, self.n_data, chunk)
 
-        # loss for positive pair
-        P_pos = x.select(1, 0)
-        log_D1 = torch.div(P_pos, P_pos.add(m * Pn + eps)).log_()
 
-        # loss for K negative pair
-        P_neg = x.narrow(1, 1, m)
-        log_D0 = torch.div(P_neg.clone().fill_(m * Pn), P_neg.add(m * Pn + eps)).log_()
+class InfoNCELoss(torch.autograd.Function):
+    """
+    Softmax cross-entropy of the (B, K+1) logits x with the positive in column 0,
+        loss = mean(logsumexp(x) - x[:, 0])
+    without a label tensor. Forward combines the logsumexp of tiles of `chunk` columns and keeps
+    only tile-sized temporaries, backward writes softmax(x) - onehot(0) into a single buffer.
+    """
+    @staticmethod
+    def forward(ctx, x, chunk):
+        S = x.view(x.size(0), -1)
+        # half logits are accumulated in float32
+        dtype = torch.promote_types(x.dtype, torch.float32)
+        # logsumexp of a tile from its fused log_softmax, lse = t[:, 0] - log_softmax(t)[:, 0]
+        lse = torch.stack([t.select(1, 0).to(dtype) - torch.log_softmax(t, 1, dtype=dtype).select(1, 0)
+                           for t in S.split(chunk, 1)], 1)
+        lse = torch.logsumexp(lse, 1) if lse.size(1) > 1 else lse.squeeze(1)
 
-        loss = - (log_D1.sum(0) + log_D0.view(-1, 1).sum(0)) / bsz
+        ctx.save_for_backward(x)
+        ctx.dtype = dtype
+        return lse.sub(S.select(1, 0).to(dtype)).mean().to(x.dtype)
 
-        return loss
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, = ctx.saved_tensors
+        S = x.view(x.size(0), -1)
+        scale = grad_output.to(ctx.dtype) / S.size(0)
+        grad = torch.softmax(S, 1, dtype=ctx.dtype).mul_(scale)
+        grad.select(1, 0).sub_(scale)
+        return grad.to(x.dtype).view_as(x), None
 
 
 class NCESoftmaxLoss(nn.Module):
-    """Softmax cross-entropy loss (a.k.a., info-NCE loss in CPC paper)"""
-    def __init__(self):
+    """Softmax cross-entropy loss (a.k.a., info-NCE loss in CPC paper), the positive in column 0"""
+    def __init__(self, chunk_size=None):
         super(NCESoftmaxLoss, self).__init__()
-        self.criterion = nn.CrossEntropyLoss()
+        # columns per log_softmax temporary, ~1M entries by default
+        self.chunk_size = chunk_size
 
     def forward(self, x):
-        bsz = x.shape[0]
-        x = x.squeeze()
-        label = torch.zeros([bsz]).cuda().long()
-        loss = self.criterion(x, label)
-        return loss
+        chunk = self.chunk_size or max(1, (1 << 20) // x.size(0))
+        return InfoNCELoss.apply(x, chunk)
@@ -9,57 +9,97 @@ class AliasMethod(object):
 
         if probs.sum() > 1:
             probs.div_(probs.sum())
-        K = len(probs)
-        self.prob = torch.zeros(K)
-        self.alias = torch.LongTensor([0]*K)
+        self.prob, self.alias = self.build(probs)
+        self._buffers = None
 
-        # Sort the data into the outcomes with probabilities
-        # that are larger and smaller than 1/K.
-        smaller = []
-        larger = []
-        for kk, prob in enumerate(probs):
-            self.prob[kk] = K*prob
-            if self.prob[kk] < 1.0:
-                smaller.append(kk)
-            else:
-                larger.append(kk)
+    @staticmethod
+    def build(probs):
+        """
+        Vectorized table construction. Each round hands every small outcome (K*p < 1) to the
+        large outcome whose excess interval contains the start of its deficit interval, exactly
+        the pairing the sequential loop makes in bulk; larges that drop below 1 become the
+        smalls of the next round.
+        A (R, K) `probs` builds R independent tables at once, aliases are then column indices.
+        """
+        probs = probs.detach().to('cpu', torch.float64)
+        rows = probs.reshape(-1, probs.size(-1))
+        R, K = rows.shape
+        prob = (rows / rows.sum(1, keepdim=True) * K).view(-1)
+        alias = torch.arange(R * K)
+        row = torch.arange(R).repeat_interleave(K)
 
-        # Loop though and create little binary mixtures that
-        # appropriately allocate the larger outcomes over the
-        # overall uniform mixture.
+        smaller = torch.nonzero(prob < 1.0).view(-1)
+        larger = torch.nonzero(prob >= 1.0).view(-1)
         while len(smaller) > 0 and len(larger) > 0:
-            small = smaller.pop()
-            large = larger.pop()
+            deficit = 1.0 - prob[smaller]
+            excess = prob[larger] - 1.0
+            start = torch.cumsum(deficit, 0) - deficit
+            owner = torch.searchsorted(torch.cumsum(excess, 0), start, right=True)
+            if R == 1:
+                owner.clamp_(max=len(larger) - 1)
+            else:
+                # every table balances on its own, so only rounding can carry an owner into the next row
+                lo = torch.searchsorted(row[larger], row[smaller])
+                hi = torch.searchsorted(row[larger], row[smaller], right=True) - 1
+                paired = lo <= hi
+                prob[smaller[~paired]] = 1
+                smaller, deficit = smaller[paired], deficit[paired]
+                owner = torch.max(torch.min(owner[paired], hi[paired]), lo[paired])
 
-            self.alias[small] = large
-            self.prob[large] = (self.prob[large] - 1.0) + self.prob[small]
+            alias[smaller] = larger[owner]
+            prob.index_add_(0, larger[owner], -deficit)
 
-            if self.prob[large] < 1.0:
-                smaller.append(large)
-            else:
-                larger.append(large)
+            smaller = larger[prob[larger] < 1.0]
+            larger = larger[prob[larger] >= 1.0]
 
-        for last_one in smaller+larger:
-            self.prob[last_one] = 1
+        # outcomes left unpaired only differ from 1 by rounding
+        prob[smaller] = 1
+        prob[larger] = 1
+        return prob.view(probs.shape).float(), (alias - row * K).view(probs.shape)
+
+    def save(self, path):
+        torch.save({'prob': self.prob.cpu(), 'alias': self.alias.cpu()}, path)
+
+    @classmethod
+    def load(cls, path, device='cpu'):
+        state = torch.load(path, map_location='cpu')
+        sampler = cls.__new__(cls)
+        sampler.prob = state['prob'].to(device)
+        sampler.alias = state['alias'].to(device)
+        sampler._buffers = None
+        return sampler
+
+    def to(self, device):
+        self.prob = self.prob.to(device)
+        self.alias = self.alias.to(device)
+        self._buffers = None
+        return self
 
     def cuda(self):
-        self.prob = self.prob.cuda()
-        self.alias = self.alias.cuda()
+        return self.to('cuda')
 
     def draw(self, N):
         """
         Draw N samples from multinomial
         :param N: number of samples
-        :return: samples
+        :return: samples, a new tensor (callers write the positives into it and keep it for
+            backward); only the temporaries are reused between calls
         """
         K = self.alias.size(0)
+        if self._buffers is None or self._buffers[0].numel() != N:
+            device = self.prob.device
+            self._buffers = (torch.empty(N, dtype=torch.float64, device=device),
+                             torch.empty(N, dtype=torch.long, device=device),
+                             torch.empty(N, dtype=torch.float, device=device),
+                             torch.empty(N, dtype=torch.long, device=device),
+                             torch.empty(N, dtype=torch.bool, device=device))
+        u, kk, prob, alias, keep = self._buffers
 
-        kk = torch.zeros(N, dtype=torch.long, device=self.prob.device).random_(0, K)
-        prob = self.prob.index_select(0, kk)
-        alias = self.alias.index_select(0, kk)
-        # b is whether a random number is greater than q
-        b = torch.bernoulli(prob)
-        oq = kk.mul(b.long())
-        oj = alias.mul((1-b).long())
-
-        return oq + oj
+        # one uniform picks the column (integer part) and flips its coin (fractional part)
+        torch.rand(N, dtype=torch.float64, device=u.device, out=u).mul_(K)
+        kk.copy_(u).clamp_(max=K - 1)
+        u.sub_(kk)
+        torch.index_select(self.prob, 0, kk, out=prob)
+        torch.index_select(self.alias, 0, kk, out=alias)
+        torch.lt(u, prob, out=keep)
+        return torch.where(keep, kk, alias)
@@ -0,0 +1,131 @@
+import functools
+import math
+
+import torch
+import torch.distributed as dist
+
+from .NCEAverage import NCEAverage
+from .storage import register_memory, read_memory, write_memory
+
+
+def all_gather(tensor, group=None):
+    """concatenate `tensor` of every rank along dim 0, every rank must pass the same shape"""
+    tensors = [torch.empty_like(tensor) for _ in range(dist.get_world_size(group))]
+    dist.all_gather(tensors, tensor.contiguous(), group=group)
+    return torch.cat(tensors)
+
+
+class ShardedScore(torch.autograd.Function):
+    """
+    out[b, k] = <memory[idx[b, k]], x[b]> for the local anchors, when every rank only holds the
+    rows [offset, offset + rows) of the memory. Each rank scores the samples of all anchors which
+    fall in its shard and the partial logits are summed over ranks; backward routes the gradient
+    of the anchors the same way.
+    """
+    @staticmethod
+    def forward(ctx, x, idx, read, offset, rows, group):
+        rank = dist.get_rank(group)
+        batchSize = x.size(0)
+        x = all_gather(x, group)
+        local = idx - offset
+        anchor, col = torch.nonzero((local >= 0) & (local < rows), as_tuple=True)
+        weight = read(local[anchor, col])
+        out = x.new_zeros(idx.shape)
+        out[anchor, col] = (weight * x[anchor]).sum(1)
+        dist.all_reduce(out, group=group)
+
+        ctx.save_for_backward(anchor, col, weight)
+        ctx.group = group
+        return out[rank * batchSize:(rank + 1) * batchSize]
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        anchor, col, weight = ctx.saved_tensors
+        rank = dist.get_rank(ctx.group)
+        batchSize = grad_out.size(0)
+        grad_out = all_gather(grad_out, ctx.group)
+        grad_x = grad_out.new_zeros(grad_out.size(0), weight.size(1))
+        grad_x.index_add_(0, anchor, weight * grad_out[anchor, col].unsqueeze(1))
+        dist.all_reduce(grad_x, group=ctx.group)
+        return grad_x[rank * batchSize:(rank + 1) * batchSize], None, None, None, None, None
+
+
+class DistributedNCEAverage(NCEAverage):
+    """
+    NCEAverage sharded over the processes of `group`: rank r owns the rows
+    [r * shard, (r + 1) * shard) of memory_l / memory_ab (its state_dict holds only them).
+    Every rank draws the same negatives for the anchors of all ranks from a generator seeded
+    with `seed`, scores the ones it owns and the logits are combined with an all-reduce; the
+    momentum update of a row is applied by its owner. In NCE mode Z_l / Z_ab are estimated from
+    the logits of all ranks, so every rank scales by the same constants. All ranks must use the
+    same batch size. Negatives are uniform, the sampler of NCEAverage is not used.
+    """
+    def __init__(self, inputSize, outputSize, K, T=0.07, momentum=0.5, use_softmax=False, storage='float32',
+                 sync_free=False, seed=0, group=None):
+        self.group = group
+        self.shard = (outputSize + dist.get_world_size(group) - 1) // dist.get_world_size(group)
+        self.offset = min(outputSize, dist.get_rank(group) * self.shard)
+        self.seed = seed
+        self.generator = None
+        # Z set by the all-reduced estimate in sync-free mode
+        self._estimated = set()
+        super(DistributedNCEAverage, self).__init__(inputSize, outputSize, K, T, momentum, use_softmax,
+                                                    storage=storage, sync_free=sync_free)
+
+    def _init_memory(self, inputSize, outputSize, storage):
+        rows = min(outputSize, self.offset + self.shard) - self.offset
+        stdv = 1. / math.sqrt(inputSize / 3)
+        register_memory(self, 'memory_l', torch.rand(rows, inputSize).mul_(2 * stdv).add_(-stdv), storage)
+        register_memory(self, 'memory_ab', torch.rand(rows, inputSize).mul_(2 * stdv).add_(-stdv), storage)
+
+    def score(self, l, ab, y, idx=None):
+        K = self.K
+        if idx is None:
+            if self.generator is None or self.generator.device != y.device:
+                self.generator = torch.Generator(device=y.device)
+                self.generator.manual_seed(self.seed)
+            y = all_gather(y, self.group)
+            idx = torch.randint(self.nLem, (y.size(0), K + 1), generator=self.generator, device=y.device)
+            idx.select(1, 0).copy_(y)
+        else:
+            idx = all_gather(idx, self.group)
+        rows = self.memory_l.size(0)
+        out_ab = ShardedScore.apply(ab, idx, functools.partial(read_memory, self, 'memory_l'),
+                                    self.offset, rows, self.group).unsqueeze(2)
+        out_l = ShardedScore.apply(l, idx, functools.partial(read_memory, self, 'memory_ab'),
+                                   self.offset, rows, self.group).unsqueeze(2)
+        return out_l, out_ab
+
+    def _batch_mean(self, x):
+        mean = x.mean().view(1)
+        dist.all_reduce(mean, group=self.group)
+        return mean.squeeze(0) / dist.get_world_size(self.group)
+
+    def _normalize(self, out, i, name):
+        if self.sync_free:
+            if i not in self._estimated:
+                # Z stays on the device, only the first batch all-reduces its estimate
+                Z = self.params[i]
+                Z.copy_(torch.where(Z < 0, (self._batch_mean(out.detach()) * self.nLem).to(Z.dtype), Z))
+                self._estimated.add(i)
+        elif self.params[i].item() < 0:
+            self.params[i] = self._batch_mean(out.detach()) * self.nLem
+            print("normalization constant {} is set to {:.1f}".format(name, self.params[i].item()))
+        return super(DistributedNCEAverage, self)._normalize(out, i, name)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys,
+                              unexpected_keys, error_msgs):
+        super(DistributedNCEAverage, self)._load_from_state_dict(state_dict, prefix, local_metadata, strict,
+                                                                 missing_keys, unexpected_keys, error_msgs)
+        self._estimated = set()
+
+    def update(self, l, ab, y, momentum):
+        y = all_gather(y, self.group) - self.offset
+        owned = (y >= 0) & (y < self.memory_l.size(0))
+        y = y[owned]
+        for name, x in [('memory_l', l), ('memory_ab', ab)]:
+            pos = read_memory(self, name, y)
+            pos.mul_(momentum)
+            pos.add_(torch.mul(all_gather(x, self.group)[owned], 1 - momentum))
+            norm = pos.pow(2).sum(1, keepdim=True).pow(0.5)
+            write_memory(self, name, y, pos.div(norm))
@@ -0,0 +1,187 @@
+import os
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from .NCEAverage import NCEAverage
+from .storage import STORAGE, load_memory
+
+
+class OffloadNCEAverage(NCEAverage):
+    """
+    NCEAverage whose memories stay in host memory (pinned, or an .npy file opened with mmap when
+    `path` is given) instead of device buffers.
+
+    The negatives of the next step are drawn while the current one finishes: a worker thread
+    gathers their unique rows into pinned staging buffers and copies them to the device on a
+    side stream. Updated positive rows are copied back asynchronously and written into the host
+    table by the same worker before it gathers the next negatives, so every step reads fresh rows.
+    The sampler stays on the host.
+    storage: 'float32', 'float16' or 'bfloat16' (not with `path`) host tables, rows are copied in
+    that dtype and scored in float32. int8 and the fused / shared layouts are not supported.
+    """
+    def __init__(self, inputSize, outputSize, K, T=0.07, momentum=0.5, use_softmax=False, sampler=None,
+                 chunk_size=None, storage='float32', sync_free=False, path=None):
+        self.path = path
+        super(OffloadNCEAverage, self).__init__(inputSize, outputSize, K, T, momentum, use_softmax, sampler,
+                                                chunk_size, storage=storage, sync_free=sync_free)
+        self._worker = None
+        self._stream = None
+        self._future = None
+        self._copied = None
+        self._staging = None
+        self._positives = None
+
+    def _init_memory(self, inputSize, outputSize, storage):
+        if storage not in ['float32', 'float16', 'bfloat16'] or (self.path is not None and storage == 'bfloat16'):
+            raise NotImplementedError('offloaded storage not supported {}'.format(storage))
+        stdv = 1. / math.sqrt(inputSize / 3)
+        self.host_memory = {}
+        for name in ['memory_l', 'memory_ab']:
+            if self.path is not None:
+                file = os.path.join(self.path, name + '.npy')
+                if os.path.exists(file):
+                    memory = np.load(file, mmap_mode='r+')
+                else:
+                    memory = np.lib.format.open_memmap(file, mode='w+', dtype=np.dtype(storage),
+                                                       shape=(outputSize, inputSize))
+                    for i in range(0, outputSize, 65536):
+                        rows = memory[i:i + 65536]
+                        rows[:] = np.random.uniform(-stdv, stdv, size=rows.shape)
+                memory = torch.from_numpy(memory)
+            else:
+                memory = self._empty(outputSize, inputSize, dtype=STORAGE[storage]).uniform_(-stdv, stdv)
+            self.host_memory[name] = memory
+
+    @staticmethod
+    def _empty(*shape, **kwargs):
+        return torch.empty(*shape, pin_memory=torch.cuda.is_available(), **kwargs)
+
+    def _gather(self, idx, device, copied):
+        """worker job: unique rows of idx from both memories, on the device"""
+        if copied is not None:
+            # the staging buffers are still being read by the previous copy
+            copied.synchronize()
+        uniq, inverse = torch.unique(idx, return_inverse=True)
+        rows = []
+        for name, staging in zip(['memory_l', 'memory_ab'], self._staging):
+            torch.index_select(self.host_memory[name], 0, uniq, out=staging[:len(uniq)])
+            rows.append(staging[:len(uniq)])
+        if device.type != 'cuda':
+            return idx, inverse, [r.to(torch.float32, copy=True) for r in rows], None
+        with torch.cuda.stream(self._stream):
+            rows = [r.to(device, non_blocking=True).float() for r in rows]
+            event = torch.cuda.Event()
+            event.record(self._stream)
+        return idx, inverse, rows, event
+
+    def _write(self, y, rows, event):
+        """worker job: store updated rows once their copy to the host is done"""
+        if event is not None:
+            event.synchronize()
+        for name, row in zip(['memory_l', 'memory_ab'], rows):
+            self.host_memory[name].index_copy_(0, y, row.to(self.host_memory[name].dtype))
+
+    def _prefetch(self, batchSize, device):
+        K = self.K
+        if self._worker is None:
+            self._worker = ThreadPoolExecutor(max_workers=1)
+            if device.type == 'cuda':
+                self._stream = torch.cuda.Stream(device)
+        if self._staging is None or self._staging[0].size(0) < min(self.nLem, batchSize * K):
+            memory = self.host_memory['memory_l']
+            self._staging = [self._empty(min(self.nLem, batchSize * K), memory.size(1), dtype=memory.dtype)
+                             for _ in range(2)]
+        idx = self.sampler.draw(batchSize * K).view(batchSize, K).clone()
+        self._future = self._worker.submit(self._gather, idx, device, self._copied)
+
+    def synchronize(self):
+        """wait for the pending write-backs and prefetches"""
+        if self._future is not None:
+            self._future.result()
+
+    def score(self, l, ab, y, idx=None):
+        batchSize = l.size(0)
+        y_host = y.cpu()
+        if idx is not None:
+            # explicit samples, gather them now
+            self.synchronize()
+            uniq, inverse = torch.unique(idx.cpu(), return_inverse=True)
+            rows = [self.host_memory[name].index_select(0, uniq).to(l.device).float() for name in ['memory_l', 'memory_ab']]
+            local = inverse.to(l.device)
+        else:
+            if self._future is None or self._future.result()[0].size(0) != batchSize:
+                if self._future is not None:
+                    # a batch of another size, e.g. the last one of the epoch
+                    self._copied = self._future.result()[3]
+                self._prefetch(batchSize, l.device)
+            negatives, inverse, rows, self._copied = self._future.result()
+            if self._copied is not None:
+                torch.cuda.current_stream(l.device).wait_event(self._copied)
+                # allocated on the side stream, keep the allocator from reusing them while this one reads
+                for r in rows:
+                    r.record_stream(torch.cuda.current_stream(l.device))
+            # positives are gathered now, after the last write-back
+            positives = [self.host_memory[name].index_select(0, y_host).to(l.device).float()
+                         for name in ['memory_l', 'memory_ab']]
+            local = torch.cat([torch.arange(batchSize).view(-1, 1) + rows[0].size(0), inverse], 1).to(l.device)
+            rows = [torch.cat([r, p]) for r, p in zip(rows, positives)]
+            idx = torch.cat([y_host.view(-1, 1), negatives], 1)
+        self._positives = [r.index_select(0, local[:, 0]) for r in rows]
+
+        out_l, out_ab = self.score_rows(lambda i: rows[0].index_select(0, i.view(-1)),
+                                        lambda i: rows[1].index_select(0, i.view(-1)), local, l, ab)
+        if self.sampler.observes:
+            self.sampler.observe(idx, ((out_l + out_ab).view(batchSize, -1).detach() / 2).cpu())
+        return out_l, out_ab
+
+    def update(self, l, ab, y, momentum):
+        updated = []
+        for pos, x in zip(self._positives, [l, ab]):
+            pos = pos.mul(momentum).add_(torch.mul(x, 1 - momentum))
+            updated.append(pos.div(pos.pow(2).sum(1, keepdim=True).pow(0.5)))
+        self._positives = None
+
+        if l.is_cuda:
+            dtype = self.host_memory['memory_l'].dtype
+            updated = [self._empty(u.shape, dtype=dtype).copy_(u.to(dtype), non_blocking=True) for u in updated]
+            event = torch.cuda.Event()
+            event.record(torch.cuda.current_stream(l.device))
+        else:
+            event = None
+        if self._worker is None:
+            self._write(y.cpu(), updated, event)
+        else:
+            self._worker.submit(self._write, y.cpu(), updated, event)
+            # queued behind the write-back, so the next negatives see the updated rows
+            self._prefetch(l.size(0), l.device)
+
+    def memory_rows(self, view, start=0, end=None):
+        self.synchronize()
+        return self.host_memory[['memory_l', 'memory_ab'][view]][start:end].float()
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        super(OffloadNCEAverage, self)._save_to_state_dict(destination, prefix, keep_vars)
+        self.synchronize()
+        for name, memory in self.host_memory.items():
+            destination[prefix + name] = memory
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys,
+                              unexpected_keys, error_msgs):
+        self.synchronize()
+        for name, memory in self.host_memory.items():
+            load_memory(self, state_dict, prefix, name, memory.dtype)
+            if prefix + name in state_dict:
+                memory.copy_(state_dict[prefix + name])
+            elif strict:
+                missing_keys.append(prefix + name)
+        state_dict = {k: v for k, v in state_dict.items() if k[len(prefix):] not in self.host_memory}
+        super(OffloadNCEAverage, self)._load_from_state_dict(state_dict, prefix, local_metadata, strict,
+                                                             missing_keys, unexpected_keys, error_msgs)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_worker'] = state['_stream'] = state['_future'] = state['_copied'] = None
+        return state
@@ -0,0 +1,145 @@
+import torch
+from .alias_multinomial import AliasMethod
+
+
+def _compiling():
+    compiler = getattr(torch, 'compiler', None)
+    return compiler is not None and hasattr(compiler, 'is_compiling') and compiler.is_compiling()
+
+
+class NegativeSampler(object):
+    """
+    Noise distribution of NCEAverage / MemoryInsDis.
+    draw(N) returns N indices on the device of the sampler; observe(idx, scores) is called after
+    every scoring step with the (B, K+1) sampled indices and their similarities, column 0 being
+    the positive.
+    """
+    observes = False
+
+    def __init__(self, n):
+        self.n = n
+        self.device = torch.device('cpu')
+
+    def to(self, device):
+        self.device = torch.device(device)
+        return self
+
+    def draw(self, N):
+        raise NotImplementedError
+
+    def observe(self, idx, scores):
+        pass
+
+
+class UniformSampler(NegativeSampler):
+    """
+    Uniform noise, a plain randint. The indices are a new tensor every call: NCEAverage writes
+    the positives into them and keeps them for backward.
+    """
+    def draw(self, N):
+        return torch.randint(self.n, (N,), device=self.device)
+
+
+class WeightedSampler(NegativeSampler):
+    """
+    Noise proportional to `weights`, drawn through a two level alias table: one table over the
+    masses of blocks of `block_size` outcomes and one table per block. update(idx, weights) only
+    marks the blocks it touches, which are rebuilt (with the top table) on the first draw after
+    `rebuild_every` draws.
+    Note NCECriterion assumes uniform noise, the softmax losses are unaffected.
+    """
+    def __init__(self, weights, block_size=4096, rebuild_every=1):
+        super(WeightedSampler, self).__init__(len(weights))
+        self.block_size = min(block_size, self.n)
+        self.n_blocks = (self.n + self.block_size - 1) // self.block_size
+        self.rebuild_every = rebuild_every
+        self.weights = torch.zeros(self.n_blocks * self.block_size)
+        self.weights[:self.n] = weights.detach().float().cpu()
+        self.prob = torch.zeros(self.n_blocks, self.block_size)
+        self.alias = torch.zeros(self.n_blocks, self.block_size, dtype=torch.long)
+        self.dirty = torch.ones(self.n_blocks, dtype=torch.bool)
+        self.top = None
+        self._draws = 0
+        self.rebuild()
+
+    def to(self, device):
+        self.prob = self.prob.to(device)
+        self.alias = self.alias.to(device)
+        self.top.to(device)
+        return super(WeightedSampler, self).to(device)
+
+    def update(self, idx, weights):
+        idx = idx.detach().view(-1).cpu()
+        self.weights[idx] = weights.detach().view(-1).float().cpu()
+        self.dirty[idx // self.block_size] = True
+
+    def rebuild(self):
+        blocks = torch.nonzero(self.dirty).view(-1)
+        if len(blocks) > 0:
+            weights = self.weights.view(self.n_blocks, self.block_size)[blocks]
+            # an empty block is never drawn, any table will do
+            weights[weights.sum(1) <= 0] = 1
+            prob, alias = AliasMethod.build(weights)
+            self.prob[blocks.to(self.prob.device)] = prob.to(self.prob.device)
+            self.alias[blocks.to(self.alias.device)] = alias.to(self.alias.device)
+            self.top = AliasMethod(self.weights.view(self.n_blocks, self.block_size).sum(1).double()).to(self.device)
+            self.dirty.zero_()
+
+    def draw(self, N):
+        if self._draws % self.rebuild_every == 0:
+            self.rebuild()
+        self._draws += 1
+        block = self.top.draw(N)
+        u = torch.rand(N, dtype=torch.float64, device=self.device).mul_(self.block_size)
+        col = u.long().clamp_(max=self.block_size - 1)
+        u.sub_(col)
+        keep = u < self.prob[block, col]
+        col = torch.where(keep, col, self.alias[block, col])
+        return block * self.block_size + col
+
+
+class HardNegativeSampler(WeightedSampler):
+    """
+    Draw memory entries in proportion to exp(hardness / temperature), the hardness of an entry
+    being the moving average of its similarity to the anchors it was drawn for. Similarities are
+    accumulated on the device and folded into the weights every `rebuild_every` steps.
+    """
+    observes = True
+
+    def __init__(self, n, temperature=1.0, momentum=0.5, block_size=4096, rebuild_every=100):
+        self.temperature = temperature
+        self.momentum = momentum
+        self.hardness = torch.zeros(n)
+        self._sum = torch.zeros(n)
+        self._count = torch.zeros(n)
+        super(HardNegativeSampler, self).__init__(torch.ones(n), block_size, rebuild_every)
+
+    def to(self, device):
+        self._sum = self._sum.to(device)
+        self._count = self._count.to(device)
+        return super(HardNegativeSampler, self).to(device)
+
+    def observe(self, idx, scores):
+        with torch.no_grad():
+            idx = idx[:, 1:].reshape(-1)
+            self._sum.index_add_(0, idx, scores[:, 1:].reshape(-1).float())
+            self._count.index_add_(0, idx, torch.ones_like(idx, dtype=torch.float))
+
+    def rebuild(self):
+        seen = torch.nonzero(self._count > 0).view(-1)
+        if len(seen) > 0:
+            mean = (self._sum[seen] / self._count[seen]).cpu()
+            seen = seen.cpu()
+            self.hardness[seen] = self.momentum * self.hardness[seen] + (1 - self.momentum) * mean
+            self.update(seen, torch.exp(self.hardness[seen] / self.temperature))
+            self._sum.zero_()
+            self._count.zero_()
+        super(HardNegativeSampler, self).rebuild()
+
+
+def get_sampler(name, n, **kwargs):
+    if name == 'uniform':
+        return UniformSampler(n)
+    if name == 'hard':
+        return HardNegativeSampler(n, **kwargs)
+    raise NotImplementedError('sampler not supported {}'.format(name))
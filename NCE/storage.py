@@ -0,0 +1,90 @@
+import torch
+
+# storage dtypes of the memory banks; 'int8' keeps a float32 scale per row next to the codes
+STORAGE = {
+    'float32': torch.float32,
+    'float16': torch.float16,
+    'bfloat16': torch.bfloat16,
+    'int8': torch.int8,
+}
+
+
+def register_memory(module, name, memory, storage='float32'):
+    """register `memory` as buffer `name` of `module`, stored as `storage`"""
+    if storage not in STORAGE:
+        raise NotImplementedError('storage not supported {}'.format(storage))
+    if storage == 'int8':
+        codes, scale = quantize(memory)
+        module.register_buffer(name, codes)
+        module.register_buffer(name + '_scale', scale)
+    else:
+        module.register_buffer(name, memory.to(STORAGE[storage]))
+
+
+def quantize(rows):
+    """symmetric int8 codes with one scale per row (per vector along the last dim)"""
+    scale = rows.abs().max(-1, keepdim=True)[0].float().clamp_(min=1e-12) / 127.
+    codes = torch.round(rows.float() / scale).clamp_(-127, 127).to(torch.int8)
+    return codes, scale
+
+
+def load_memory(module, state_dict, prefix, name, dtype=None):
+    """
+    convert the checkpoint entry of memory `name` to the storage of `module` (or `dtype`) before
+    it is loaded: float rows are quantized for int8 storage, int8 codes are dequantized otherwise
+    """
+    key = prefix + name
+    if key not in state_dict:
+        return
+    dtype = getattr(module, name).dtype if dtype is None else dtype
+    rows = state_dict[key]
+    if dtype == torch.int8 and rows.is_floating_point():
+        state_dict[key], state_dict[key + '_scale'] = quantize(rows)
+    elif dtype != torch.int8 and rows.dtype == torch.int8 and key + '_scale' in state_dict:
+        state_dict[key] = rows.float().mul_(state_dict.pop(key + '_scale'))
+
+
+def read_memory(module, name, idx=None, copy=False):
+    """
+    float32 rows `idx` (all rows if None) of memory `name`. Only float32 storage can return the
+    buffer itself, `copy` asks for a tensor not aliasing it.
+    """
+    memory = getattr(module, name)
+    rows = memory if idx is None else memory.index_select(0, idx.view(-1))
+    if memory.dtype == torch.int8:
+        scale = getattr(module, name + '_scale')
+        scale = scale if idx is None else scale.index_select(0, idx.view(-1))
+        return rows.float().mul_(scale)
+    if memory.dtype != torch.float32:
+        return rows.float()
+    return rows.clone() if copy and idx is None else rows
+
+
+def read_slice(module, name, start, end):
+    """float32 rows start:end of memory `name`, a view of the buffer for float32 storage"""
+    memory = getattr(module, name)
+    if memory.dtype == torch.int8:
+        return memory[start:end].float().mul_(getattr(module, name + '_scale')[start:end])
+    return memory[start:end].float()
+
+
+def write_memory(module, name, idx, rows):
+    """store float rows at `idx` of memory `name`, rounding to its storage"""
+    memory = getattr(module, name)
+    if memory.dtype == torch.int8:
+        codes, scale = quantize(rows)
+        memory.index_copy_(0, idx, codes)
+        getattr(module, name + '_scale').index_copy_(0, idx, scale)
+    else:
+        memory.index_copy_(0, idx, rows.to(memory.dtype))
+
+
+def write_slice(module, name, start, rows):
+    """store float rows at start:start + len(rows) of memory `name`, rounding to its storage"""
+    memory = getattr(module, name)
+    if memory.dtype == torch.int8:
+        codes, scale = quantize(rows)
+        memory[start:start + len(rows)] = codes
+        getattr(module, name + '_scale')[start:start + len(rows)] = scale
+    else:
+        memory[start:start + len(rows)] = rows
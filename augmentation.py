@@ -0,0 +1,49 @@
+"""
+Batched corruption stage for CMC views.
+The same engine can run as a DataLoader collate_fn (in the workers) or as a layer
+inside the model (on the device of the batch).
+"""
+from __future__ import print_function
+
+import torch
+from torch import nn
+from torch.utils.data.dataloader import default_collate
+
+from corruption import create_batch_augmentation
+
+NORM = ((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
+
+
+def normalize_batch(x, mean=NORM[0], std=NORM[1]):
+	"""transforms.Normalize for a (B, C, H, W) tensor"""
+	mean = x.new_tensor(mean).view(1, -1, 1, 1)
+	std = x.new_tensor(std).view(1, -1, 1, 1)
+	return x.sub(mean).div_(std)
+
+
+class BatchCorruption(nn.Module):
+	"""Turn a (B, 3, H, W) batch in [0, 1] into the [clean, corrupted] views of CMC"""
+	def __init__(self, view, level=5, normalize=True):
+		super(BatchCorruption, self).__init__()
+		self.view = view
+		self.level = level
+		self.normalize = normalize
+		self.augmentation = create_batch_augmentation(view, level)
+
+	def forward(self, x, rng=None):
+		with torch.no_grad():
+			views = self.augmentation(x.float(), rng)
+		if self.normalize:
+			views = [normalize_batch(v) for v in views]
+		return views
+
+
+class CorruptionCollate(object):
+	"""collate_fn which corrupts the whole collated batch instead of one image per transform call"""
+	def __init__(self, view, level=5, normalize=True):
+		self.corruption = BatchCorruption(view, level, normalize)
+
+	def __call__(self, batch):
+		batch = default_collate(batch)
+		batch[0] = self.corruption(batch[0])
+		return batch
@@ -0,0 +1,183 @@
+"""
+Benchmark every corruption in corruption.C_list() on CIFAR-sized images.
+
+For each (corruption, severity) and path ('scalar': one PIL image per call as in
+create_augmentation, 'batch': C_batch_list() on whole batches) it records per-image
+latency percentiles, images/sec, peak RSS and the peak of traced allocations, and
+checks the batched outputs against the scalar ones. Results are written as JSON so
+runs can be compared over time.
+
+python bench_corruption.py --data_folder ../data/myCIFAR-10-C/ --output ./results/bench/corruption.json
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import resource
+import tracemalloc
+
+import numpy as np
+import torch
+from PIL import Image
+
+from corruption import C_list, C_batch_list
+
+
+def parse_option():
+
+	parser = argparse.ArgumentParser('argument for corruption benchmark')
+
+	parser.add_argument('--data_folder', type=str, default=None, help='CIFAR-10 root, random images if not given')
+	parser.add_argument('--num_images', type=int, default=256, help='number of images to corrupt')
+	parser.add_argument('--batch_size', type=int, default=128, help='batch size of the batched path')
+	parser.add_argument('--corruptions', type=str, default='', help='comma separated, all of C_list() if empty')
+	parser.add_argument('--severities', type=str, default='1,2,3,4,5')
+	parser.add_argument('--path', type=str, default='both', choices=['scalar', 'batch', 'both'])
+	parser.add_argument('--repeat', type=int, default=3, help='timed passes over the images')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--output', type=str, default='corruption_bench.json', help='json file to write')
+
+	opt = parser.parse_args()
+	opt.corruptions = opt.corruptions.split(',') if opt.corruptions else list(C_list().keys())
+	opt.severities = [int(s) for s in opt.severities.split(',')]
+	return opt
+
+
+def load_images(opt):
+	"""(num_images, 32, 32, 3) uint8, the first CIFAR-10 test images when a data folder is given"""
+	if opt.data_folder is not None:
+		from torchvision import datasets
+		return datasets.CIFAR10(root=opt.data_folder, train=False, download=True).data[:opt.num_images]
+	return np.random.RandomState(opt.seed).randint(0, 256, size=(opt.num_images, 32, 32, 3)).astype(np.uint8)
+
+
+def run_scalar(corruption, images, severity):
+	"""corrupt one PIL image per call; returns the outputs and the per-image latencies"""
+	outputs, latencies = [], []
+	for img in images:
+		img = Image.fromarray(img)
+		start = time.perf_counter()
+		out = corruption(img, severity)
+		latencies.append(time.perf_counter() - start)
+		outputs.append(np.asarray(out, dtype=np.float32))
+	return np.stack(outputs), latencies
+
+
+def run_batch(corruption, images, severity, batch_size):
+	"""corrupt whole batches; the latency of an image is its batch time over the batch size"""
+	outputs, latencies = [], []
+	for i in range(0, len(images), batch_size):
+		batch = images[i:i + batch_size]
+		start = time.perf_counter()
+		out = corruption(batch, severity)
+		latencies.extend([(time.perf_counter() - start) / len(batch)] * len(batch))
+		outputs.append(np.asarray(out, dtype=np.float32))
+	return np.concatenate(outputs), latencies
+
+
+def measure(run, repeat):
+	"""time `run` over `repeat` passes, then trace the allocations of one more pass"""
+	rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	latencies = []
+	for _ in range(repeat):
+		outputs, lat = run()
+		latencies.extend(lat)
+	rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+	tracemalloc.start()
+	run()
+	_, alloc_peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+
+	latencies = np.asarray(latencies) * 1000.
+	return outputs, {
+		'latency_ms': {'mean': float(latencies.mean()), 'p50': float(np.percentile(latencies, 50)),
+					   'p90': float(np.percentile(latencies, 90)), 'p99': float(np.percentile(latencies, 99))},
+		'images_per_sec': float(1000. / latencies.mean()),
+		# ru_maxrss is in KB on linux, the growth shows what this corruption added to the peak
+		'peak_rss_mb': rss_after / 1024.,
+		'peak_rss_growth_mb': (rss_after - rss_before) / 1024.,
+		'alloc_peak_mb': alloc_peak / 1024. / 1024.,
+	}
+
+
+def compare(reference, outputs, images):
+	"""
+	batched vs scalar outputs: the max abs error only means something for deterministic
+	corruptions, the statistics of (output - clean) compare the distributions of random ones
+	"""
+	if reference.shape != outputs.shape:
+		return {'shape': [list(reference.shape), list(outputs.shape)]}
+	clean = images.astype(np.float32)
+	ref_delta, out_delta = reference - clean, outputs - clean
+	return {
+		'max_abs_err': float(np.abs(reference - outputs).max()),
+		'delta_mean': [float(ref_delta.mean()), float(out_delta.mean())],
+		'delta_std': [float(ref_delta.std()), float(out_delta.std())],
+	}
+
+
+def main():
+
+	opt = parse_option()
+	images = load_images(opt)
+	scalar_list, batch_list = C_list(), C_batch_list()
+
+	results = []
+	for name in opt.corruptions:
+		for severity in opt.severities:
+			np.random.seed(opt.seed)
+			torch.manual_seed(opt.seed)
+			record = {'corruption': name, 'severity': severity}
+			reference = None
+			if opt.path in ['scalar', 'both']:
+				try:
+					reference, record['scalar'] = measure(
+						lambda: run_scalar(scalar_list[name], images, severity), opt.repeat)
+				except Exception as e:
+					record['scalar'] = {'error': repr(e)}
+			if opt.path in ['batch', 'both']:
+				try:
+					outputs, record['batch'] = measure(
+						lambda: run_batch(batch_list[name], images, severity, opt.batch_size), opt.repeat)
+					if reference is not None:
+						record['check'] = compare(reference, outputs, images)
+				except Exception as e:
+					record['batch'] = {'error': repr(e)}
+			if 'images_per_sec' in record.get('scalar', {}) and 'images_per_sec' in record.get('batch', {}):
+				record['speedup'] = record['batch']['images_per_sec'] / record['scalar']['images_per_sec']
+
+			print('{:<20s} {}  '.format(name, severity) + '  '.join(
+				'{} {:.1f} img/s'.format(p, record[p]['images_per_sec']) if 'images_per_sec' in record[p]
+				else '{} failed'.format(p) for p in ['scalar', 'batch'] if p in record))
+			sys.stdout.flush()
+			results.append(record)
+
+	report = {
+		'meta': {
+			'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+			'host': socket.gethostname(),
+			'numpy': np.__version__,
+			'torch': torch.__version__,
+			'num_images': len(images),
+			'batch_size': opt.batch_size,
+			'repeat': opt.repeat,
+			'seed': opt.seed,
+			'data': opt.data_folder or 'random',
+		},
+		'results': results,
+	}
+	folder = os.path.dirname(opt.output)
+	if folder and not os.path.isdir(folder):
+		os.makedirs(folder)
+	with open(opt.output, 'w') as f:
+		json.dump(report, f, indent=2)
+	print('==> results saved to {}'.format(opt.output))
+
+
+if __name__ == '__main__':
+	main()
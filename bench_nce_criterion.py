@@ -0,0 +1,150 @@
+"""
+Benchmark NCECriterion against the previous implementation of Eq. (12).
+
+For each (batch size, K) it times forward + backward on NCE probabilities shaped like the
+output of NCEAverage, records the memory the step allocates (peak on CUDA, bytes allocated by
+the ops on CPU) and checks loss and gradient against the reference. Results are written as JSON.
+
+python bench_nce_criterion.py --batch_sizes 128,256 --nce_k 4096,16384 --output ./results/bench/nce_criterion.json
+"""
+from __future__ import print_function
+
+import os
+import json
+import time
+import socket
+import argparse
+
+import numpy as np
+import torch
+
+from NCE.NCECriterion import NCECriterion, eps
+
+
+def parse_option():
+
+    parser = argparse.ArgumentParser('argument for NCE criterion benchmark')
+
+    parser.add_argument('--batch_sizes', type=str, default='128,256')
+    parser.add_argument('--nce_k', type=str, default='4096,16384')
+    parser.add_argument('--n_data', type=int, default=50000)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--repeat', type=int, default=20, help='timed steps')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default='nce_criterion_bench.json', help='json file to write')
+
+    opt = parser.parse_args()
+    opt.batch_sizes = [int(b) for b in opt.batch_sizes.split(',')]
+    opt.nce_k = [int(k) for k in opt.nce_k.split(',')]
+    return opt
+
+
+class ReferenceNCECriterion(torch.nn.Module):
+    """NCECriterion before the log-space rewrite"""
+    def __init__(self, n_data):
+        super(ReferenceNCECriterion, self).__init__()
+        self.n_data = n_data
+
+    def forward(self, x):
+        bsz = x.shape[0]
+        m = x.size(1) - 1
+        Pn = 1 / float(self.n_data)
+        P_pos = x.select(1, 0)
+        log_D1 = torch.div(P_pos, P_pos.add(m * Pn + eps)).log_()
+        P_neg = x.narrow(1, 1, m)
+        log_D0 = torch.div(P_neg.clone().fill_(m * Pn), P_neg.add(m * Pn + eps)).log_()
+        return - (log_D1.sum(0) + log_D0.view(-1, 1).sum(0)) / bsz
+
+
+def make_input(bsz, K, n_data, device):
+    """probabilities exp(s / T) / Z as NCEAverage returns them in NCE mode"""
+    out = torch.randn(bsz, K + 1, 1, device=device).div_(0.07 * 10).exp_()
+    return out.div_(out.mean() * n_data)
+
+
+def step(criterion, x):
+    x = x.detach().requires_grad_()
+    loss = criterion(x)
+    loss.backward()
+    return loss.detach(), x.grad
+
+
+def measure(criterion, x, repeat):
+    """time `repeat` steps, then measure the memory of one more"""
+    device = x.device
+    step(criterion, x)
+    latencies = []
+    for _ in range(repeat):
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        step(criterion, x)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        latencies.append(time.perf_counter() - start)
+
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+        step(criterion, x)
+        memory = {'peak_mb': (torch.cuda.max_memory_allocated(device) - base) / 1024. / 1024.}
+    else:
+        with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+            step(criterion, x)
+        allocated = sum(max(0, e.self_cpu_memory_usage) for e in prof.key_averages())
+        memory = {'allocated_mb': allocated / 1024. / 1024.}
+
+    latencies = np.asarray(latencies) * 1000.
+    record = {'latency_ms': {'mean': float(latencies.mean()), 'p50': float(np.percentile(latencies, 50)),
+                             'p90': float(np.percentile(latencies, 90))}}
+    record.update(memory)
+    return record
+
+
+def main():
+
+    opt = parse_option()
+    device = torch.device(opt.device)
+    reference, fused = ReferenceNCECriterion(opt.n_data), NCECriterion(opt.n_data)
+
+    results = []
+    for bsz in opt.batch_sizes:
+        for K in opt.nce_k:
+            torch.manual_seed(opt.seed)
+            x = make_input(bsz, K, opt.n_data, device)
+            record = {'batch_size': bsz, 'nce_k': K,
+                      'reference': measure(reference, x, opt.repeat),
+                      'fused': measure(fused, x, opt.repeat)}
+            (loss_r, grad_r), (loss_f, grad_f) = step(reference, x), step(fused, x)
+            record['check'] = {'loss': [float(loss_r), float(loss_f)],
+                               'grad_max_rel_err': float(((grad_r - grad_f).abs() / grad_r.abs().clamp(min=1e-12)).max())}
+            record['speedup'] = record['reference']['latency_ms']['mean'] / record['fused']['latency_ms']['mean']
+
+            key = 'peak_mb' if device.type == 'cuda' else 'allocated_mb'
+            print('bsz {:<5d} K {:<6d} {:.2f} -> {:.2f} ms  {} {:.1f} -> {:.1f}'.format(
+                bsz, K, record['reference']['latency_ms']['mean'], record['fused']['latency_ms']['mean'],
+                key, record['reference'][key], record['fused'][key]))
+            results.append(record)
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'host': socket.gethostname(),
+            'torch': torch.__version__,
+            'device': str(device),
+            'n_data': opt.n_data,
+            'repeat': opt.repeat,
+            'seed': opt.seed,
+        },
+        'results': results,
+    }
+    folder = os.path.dirname(opt.output)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    with open(opt.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('==> results saved to {}'.format(opt.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,7 @@ from PIL import Image
 import os.path
 import time
 import torch
+import torch.nn.functional as F
 import torchvision.datasets as dset
 import torchvision.transforms as trn
 import torch.utils.data as data
@@ -16,15 +17,14 @@ from PIL import Image
 import skimage as sk
 from skimage.filters import gaussian
 from io import BytesIO
-from wand.image import Image as WandImage
-from wand.api import library as wandlibrary
-import wand.color as WandColor
-import ctypes
+import functools
 from PIL import Image as PILImage
 import cv2
 from scipy.ndimage import zoom as scizoom
+from scipy.ndimage import gaussian_filter
 from scipy.ndimage.interpolation import map_coordinates
 import warnings
+import threading
 from Resizer import resizer
 import random
 warnings.simplefilter("ignore", UserWarning)
@@ -45,17 +45,39 @@ def disk(radius, alias_blur=0.1, dtype=np.float32):
 	return cv2.GaussianBlur(aliased_disk, ksize=ksize, sigmaX=alias_blur)
 
 
-# Tell Python about the C method
-wandlibrary.MagickMotionBlurImage.argtypes = (ctypes.c_void_p,  # wand
-											  ctypes.c_double,  # radius
-											  ctypes.c_double,  # sigma
-											  ctypes.c_double)  # angle
+@functools.lru_cache(maxsize=None)
+def _motion_blur_kernel(radius, sigma, angle):
+	width = 2 * int(np.ceil(radius)) + 1
+	weights = np.exp(-np.arange(width) ** 2 / (2. * sigma ** 2))
+	weights /= weights.sum()
+	# pixel i of the blur is read at i steps along `angle`, rounded as ImageMagick does
+	theta = np.deg2rad(angle)
+	dx = np.ceil(np.arange(width) * np.cos(theta) - 0.5).astype(np.int64)
+	dy = np.ceil(np.arange(width) * np.sin(theta) - 0.5).astype(np.int64)
+	kernel = np.zeros((2 * width - 1, 2 * width - 1), dtype=np.float32)
+	np.add.at(kernel, (dy + width - 1, dx + width - 1), weights)
+	kernel.flags.writeable = False
+	return kernel
 
 
-# Extend wand.image.Image class to include method signature
-class MotionImage(WandImage):
-	def motion_blur(self, radius=0.0, sigma=0.0, angle=0.0):
-		wandlibrary.MagickMotionBlurImage(self.wand, radius, sigma, angle)
+def motion_blur_kernel(radius, sigma, angle):
+	"""
+	Correlation kernel of ImageMagick's MagickMotionBlurImage: a one-sided gaussian
+	of width 2 * radius + 1 laid along `angle` (degrees). Kernels are cached per
+	(radius, sigma, whole degree).
+	"""
+	return _motion_blur_kernel(radius, sigma, int(np.round(angle)))
+
+
+def _motion_blur(x, radius, sigma, angle):
+	"""Motion blur an (H, W) or (H, W, C) float image, replicating the border like ImageMagick"""
+	kernel = motion_blur_kernel(radius, sigma, angle)
+	return cv2.filter2D(x, -1, kernel, borderType=cv2.BORDER_REPLICATE)
+
+
+def _to_uint8(x):
+	"""round to 8 bits, as the PNG blob of the former ImageMagick round-trip did"""
+	return np.clip(np.round(x), 0, 255).astype(np.uint8)
 
 
 # modification of https://github.com/FLHerne/mapgen/blob/master/diamondsquare.py
@@ -108,6 +130,127 @@ def plasma_fractal(mapsize=32, wibbledecay=3):
 	return maparray / maparray.max()
 
 
+def plasma_fractal_batch(n, mapsize=32, wibbledecay=3, rng=None, dtype=np.float32):
+	"""
+	plasma_fractal for n heightmaps at once: (n, mapsize, mapsize) array in [0, 1].
+	`rng` is None (np.random) or one np.random.Generator for the whole batch.
+	"""
+	assert (mapsize & (mapsize - 1) == 0)
+	maparray = np.empty((n, mapsize, mapsize), dtype=dtype)
+	maparray[:, 0, 0] = 0
+	stepsize = mapsize
+	wibble = 100
+	uniform = np.random.uniform if rng is None else rng.uniform
+
+	def wibbledmean(array):
+		return array / 4 + wibble * uniform(-wibble, wibble, array.shape).astype(dtype)
+
+	while stepsize >= 2:
+		half = stepsize // 2
+		# squares
+		cornerref = maparray[:, 0:mapsize:stepsize, 0:mapsize:stepsize]
+		squareaccum = cornerref + np.roll(cornerref, shift=-1, axis=1)
+		squareaccum += np.roll(squareaccum, shift=-1, axis=2)
+		maparray[:, half:mapsize:stepsize, half:mapsize:stepsize] = wibbledmean(squareaccum)
+		# diamonds
+		drgrid = maparray[:, half:mapsize:stepsize, half:mapsize:stepsize]
+		ulgrid = maparray[:, 0:mapsize:stepsize, 0:mapsize:stepsize]
+		ltsum = drgrid + np.roll(drgrid, 1, axis=1) + ulgrid + np.roll(ulgrid, -1, axis=2)
+		maparray[:, 0:mapsize:stepsize, half:mapsize:stepsize] = wibbledmean(ltsum)
+		ttsum = drgrid + np.roll(drgrid, 1, axis=2) + ulgrid + np.roll(ulgrid, -1, axis=1)
+		maparray[:, half:mapsize:stepsize, 0:mapsize:stepsize] = wibbledmean(ttsum)
+		stepsize //= 2
+		wibble /= wibbledecay
+
+	maparray -= maparray.min(axis=(1, 2), keepdims=True)
+	return maparray / maparray.max(axis=(1, 2), keepdims=True)
+
+
+class FractalBank(object):
+	"""
+	Pool of plasma fractals per wibbledecay for fog. Samples are pool entries under a random
+	rotation/flip and a random cyclic offset; the diamond-square maps wrap around (np.roll),
+	so every such variant is itself a valid fractal.
+	With `path` the pools are saved as .npy files there and opened with mmap, so
+	DataLoader workers and later runs share them. refill() regenerates a pool, optionally in
+	a background thread, and swaps it in when done.
+	"""
+	def __init__(self, size=1024, mapsize=32, path=None):
+		self.size = size
+		self.mapsize = mapsize
+		self.path = path
+		self.pools = {}
+		self._refilling = set()
+		self._lock = threading.Lock()
+
+	def _file(self, wibbledecay):
+		return os.path.join(self.path, 'fractal_{}_{}_{}.npy'.format(self.mapsize, wibbledecay, self.size))
+
+	def pool(self, wibbledecay):
+		"""The (size, mapsize, mapsize) float32 pool for `wibbledecay`, built or loaded on first use"""
+		if wibbledecay not in self.pools:
+			if self.path is not None and os.path.isfile(self._file(wibbledecay)):
+				self.pools[wibbledecay] = np.load(self._file(wibbledecay), mmap_mode='r')
+			else:
+				pool = plasma_fractal_batch(self.size, self.mapsize, wibbledecay)
+				if self.path is not None:
+					if not os.path.isdir(self.path):
+						os.makedirs(self.path)
+					tmp = '{}.{}.tmp.npy'.format(self._file(wibbledecay)[:-4], os.getpid())
+					np.save(tmp, pool)
+					os.replace(tmp, self._file(wibbledecay))
+				self.pools[wibbledecay] = pool
+		return self.pools[wibbledecay]
+
+	def refill(self, wibbledecay, background=True):
+		"""Replace the pool of `wibbledecay` with freshly generated fractals"""
+		def run():
+			pool = plasma_fractal_batch(self.size, self.mapsize, wibbledecay, rng=np.random.default_rng())
+			self.pools[wibbledecay] = pool
+			with self._lock:
+				self._refilling.discard(wibbledecay)
+		with self._lock:
+			if wibbledecay in self._refilling:
+				return
+			self._refilling.add(wibbledecay)
+		if background:
+			threading.Thread(target=run, daemon=True).start()
+		else:
+			run()
+
+	def sample(self, n, wibbledecay, rng=None):
+		"""(n, mapsize, mapsize) fractals; `rng` is None (np.random) or a list of n np.random.Generator"""
+		pool = self.pool(wibbledecay)
+		m = self.mapsize
+		if rng is None:
+			k = np.random.randint(len(pool), size=n)
+			params = np.random.randint(2, size=(n, 3))
+			offsets = np.random.randint(m, size=(n, 2))
+		else:
+			k = np.array([g.integers(len(pool)) for g in rng])
+			params = np.stack([g.integers(2, size=3) for g in rng])
+			offsets = np.stack([g.integers(m, size=2) for g in rng])
+		# cyclic offset, then flips of either axis and a transpose: the 8 rotations/flips
+		rows = (np.arange(m)[np.newaxis] + offsets[:, 0:1]) % m
+		cols = (np.arange(m)[np.newaxis] + offsets[:, 1:2]) % m
+		rows = np.where(params[:, 0:1] == 1, rows[:, ::-1], rows)
+		cols = np.where(params[:, 1:2] == 1, cols[:, ::-1], cols)
+		transpose = params[:, 2, np.newaxis, np.newaxis] == 1
+		rows, cols = rows[:, :, np.newaxis], cols[:, np.newaxis, :]
+		return pool[k[:, np.newaxis, np.newaxis], np.where(transpose, cols, rows), np.where(transpose, rows, cols)]
+
+
+_fractal_bank = None
+
+
+def get_fractal_bank():
+	"""The process-wide FractalBank, built on first use"""
+	global _fractal_bank
+	if _fractal_bank is None:
+		_fractal_bank = FractalBank()
+	return _fractal_bank
+
+
 def clipped_zoom(img, zoom_factor):
 	h = img.shape[0]
 	# ceil crop height(= crop width)
@@ -121,6 +264,91 @@ def clipped_zoom(img, zoom_factor):
 	return img[trim_top:trim_top + h, trim_top:trim_top + h]
 
 
+class FrostBank(object):
+	"""
+	Frost textures read, resized and converted to RGB once per process instead of once per image.
+	The resized textures are also saved as .npy files under `cache_dir` and opened with mmap,
+	so every DataLoader worker maps the same pages rather than decoding its own copy.
+	"""
+	base_path = '../robustness/ImageNet-C/create_c'
+	filenames = ['frost1.png', 'frost2.png', 'frost3.png', 'frost4.jpg', 'frost5.jpg', 'frost6.jpg']
+
+	def __init__(self, base_path=None, scale=0.2, cache_dir=None):
+		self.base_path = base_path or self.base_path
+		self.scale = scale
+		self.cache_dir = cache_dir or os.path.join(self.base_path, 'cache_{}'.format(scale))
+		self.textures = [self._load(filename) for filename in self.filenames]
+
+	def _load(self, filename):
+		cache = os.path.join(self.cache_dir, os.path.splitext(filename)[0] + '.npy')
+		if os.path.isfile(cache):
+			return np.load(cache, mmap_mode='r')
+		frost = cv2.imread(os.path.join(self.base_path, filename))
+		frost = cv2.resize(frost, (0, 0), fx=self.scale, fy=self.scale)
+		frost = np.ascontiguousarray(frost[..., [2, 1, 0]])  # BGR to RGB
+		try:
+			if not os.path.isdir(self.cache_dir):
+				os.makedirs(self.cache_dir)
+			tmp = '{}.{}.tmp.npy'.format(cache[:-4], os.getpid())
+			np.save(tmp, frost)
+			os.replace(tmp, cache)
+			return np.load(cache, mmap_mode='r')
+		except OSError:
+			# read-only location: keep the texture in (fork-shared) process memory
+			return frost
+
+	def crop(self, idx, size=32, rng=None):
+		"""Random (size, size, 3) crop of texture `idx`, drawn like the original frost()"""
+		frost = self.textures[idx]
+		randint = np.random.randint if rng is None else rng.integers
+		x_start, y_start = randint(0, frost.shape[0] - size), randint(0, frost.shape[1] - size)
+		return frost[x_start:x_start + size, y_start:y_start + size]
+
+	def sample(self, n, size=32, rng=None):
+		"""(n, size, size, 3) uint8 crops; `rng` is None or a list of n np.random.Generator"""
+		if rng is None:
+			return np.stack([self.crop(idx, size) for idx in np.random.randint(5, size=n)])
+		return np.stack([self.crop(g.integers(5), size, g) for g in rng])
+
+
+_frost_bank = None
+
+
+def get_frost_bank():
+	"""The process-wide FrostBank, built on first use"""
+	global _frost_bank
+	if _frost_bank is None:
+		_frost_bank = FrostBank()
+	return _frost_bank
+
+
+@functools.lru_cache(maxsize=None)
+def _zoom_matrix(h, zoom_factor):
+	"""
+	(h, h) matrix of clipped_zoom along one axis: row p holds the linear interpolation
+	weights scipy's zoom(order=1) gives to the input pixels for output pixel p
+	"""
+	ch = int(np.ceil(h / zoom_factor))
+	top = (h - ch) // 2
+	out = int(round(ch * zoom_factor))
+	trim_top = (out - h) // 2
+	coords = top + (np.arange(h) + trim_top) * (ch - 1) / float(max(out - 1, 1))
+	lo = np.floor(coords).astype(np.int64)
+	frac = coords - lo
+	matrix = np.zeros((h, h), dtype=np.float32)
+	np.add.at(matrix, (np.arange(h), lo), 1 - frac)
+	np.add.at(matrix, (np.arange(h), np.minimum(lo + 1, h - 1)), frac)
+	return matrix
+
+
+@functools.lru_cache(maxsize=None)
+def zoom_pyramid(h, zoom_factors):
+	"""(len(zoom_factors), h, h) stack of _zoom_matrix, so img -> M @ img @ M.T is clipped_zoom"""
+	pyramid = np.stack([_zoom_matrix(h, z) for z in zoom_factors])
+	pyramid.flags.writeable = False
+	return pyramid
+
+
 # /////////////// End Distortion Helpers ///////////////
 
 
@@ -161,20 +389,31 @@ def gaussian_blur(x, severity=5):
 	return np.clip(x, 0, 1) * 255
 
 
+def _glass_shuffle(x, d, max_delta):
+	"""
+	One pass of glass_blur's local pixel shuffle over (N, H, W, C) images, in place.
+	`d` holds the (dx, dy) draws of every visited pixel, shape (N, H - 2 * max_delta, W - 2 * max_delta, 2),
+	in the bottom-right to top-left order of the original loop. That loop's tuple 'swap' of numpy
+	views only copies x[h + dy, w + dx] into x[h, w], and with max_delta == 1 every offset is -1 or 0,
+	so it always reads a pixel it has not visited yet: the whole pass is one gather.
+	"""
+	hs = np.arange(x.shape[1] - max_delta, max_delta, -1)[:, np.newaxis]
+	ws = np.arange(x.shape[2] - max_delta, max_delta, -1)[np.newaxis, :]
+	n = np.arange(len(x))[:, np.newaxis, np.newaxis]
+	x[n, hs, ws] = x[n, hs + d[..., 1], ws + d[..., 0]]
+	return x
+
+
 def glass_blur(x, severity=5):
 	# sigma, max_delta, iterations
 	c = [(0.05,1,1), (0.25,1,1), (0.4,1,1), (0.25,1,2), (0.4,1,2)][severity - 1]
 
 	x = np.uint8(gaussian(np.array(x) / 255., sigma=c[0], multichannel=True) * 255)
 
-	# locally shuffle pixels
+	# locally shuffle pixels, drawing all displacements of an iteration at once
 	for i in range(c[2]):
-		for h in range(32 - c[1], c[1], -1):
-			for w in range(32 - c[1], c[1], -1):
-				dx, dy = np.random.randint(-c[1], c[1], size=(2,))
-				h_prime, w_prime = h + dy, w + dx
-				# swap
-				x[h, w], x[h_prime, w_prime] = x[h_prime, w_prime], x[h, w]
+		d = np.random.randint(-c[1], c[1], size=(1, 32 - 2 * c[1], 32 - 2 * c[1], 2))
+		x = _glass_shuffle(x[np.newaxis], d, c[1])[0]
 
 	return np.clip(gaussian(x / 255., sigma=c[0], multichannel=True), 0, 1) * 255
 
@@ -196,17 +435,11 @@ def defocus_blur(x, severity=5):
 def motion_blur(x, severity=5):
 	c = [(6,1), (6,1.5), (6,2), (8,2), (9,2.5)][severity - 1]
 
-	output = BytesIO()
-	x.save(output, format='PNG')
-	x = MotionImage(blob=output.getvalue())
-
-	x.motion_blur(radius=c[0], sigma=c[1], angle=np.random.uniform(-45, 45))
-
-	x = cv2.imdecode(np.fromstring(x.make_blob(), np.uint8),
-					 cv2.IMREAD_UNCHANGED)
+	x = np.array(x, dtype=np.float32)
+	x = _to_uint8(_motion_blur(x, radius=c[0], sigma=c[1], angle=np.random.uniform(-45, 45)))
 
-	if x.shape != (32, 32):
-		return np.clip(x[..., [2, 1, 0]], 0, 255)  # BGR to RGB
+	if x.ndim == 3:
+		return np.clip(x, 0, 255)
 	else:  # greyscale to RGB
 		return np.clip(np.array([x, x, x]).transpose((1, 2, 0)), 0, 255)
 
@@ -229,20 +462,15 @@ def fog(x, severity=5):
 
 	x = np.array(x) / 255.
 	max_val = x.max()
-	x += c[0] * plasma_fractal(wibbledecay=c[1])[:32, :32][..., np.newaxis]
+	x += c[0] * get_fractal_bank().sample(1, c[1])[0][:32, :32][..., np.newaxis]
 	return np.clip(x * max_val / (max_val + c[0]), 0, 1) * 255
 
 
 def frost(x, severity=5):
 	c = [(1, 0.2), (1, 0.3), (0.9, 0.4), (0.85, 0.4), (0.75, 0.45)][severity - 1]
 	idx = np.random.randint(5)
-	base_path = '../robustness/ImageNet-C/create_c'
-	filename = [base_path+'/frost1.png', base_path+'/frost2.png', base_path+'/frost3.png', base_path+'/frost4.jpg', base_path+'/frost5.jpg', base_path+'/frost6.jpg'][idx]
-	frost = cv2.imread(filename)
-	frost = cv2.resize(frost, (0, 0), fx=0.2, fy=0.2)
-	# randomly crop and convert to rgb
-	x_start, y_start = np.random.randint(0, frost.shape[0] - 32), np.random.randint(0, frost.shape[1] - 32)
-	frost = frost[x_start:x_start + 32, y_start:y_start + 32][..., [2, 1, 0]]
+	# randomly crop a texture which is already resized and in rgb
+	frost = get_frost_bank().crop(idx, 32)
 
 	return np.clip(c[0] * np.array(x) + c[1] * frost, 0, 255)
 
@@ -260,15 +488,8 @@ def snow(x, severity=5):
 	snow_layer = clipped_zoom(snow_layer[..., np.newaxis], c[2])
 	snow_layer[snow_layer < c[3]] = 0
 
-	snow_layer = PILImage.fromarray((np.clip(snow_layer.squeeze(), 0, 1) * 255).astype(np.uint8), mode='L')
-	output = BytesIO()
-	snow_layer.save(output, format='PNG')
-	snow_layer = MotionImage(blob=output.getvalue())
-
-	snow_layer.motion_blur(radius=c[4], sigma=c[5], angle=np.random.uniform(-135, -45))
-
-	snow_layer = cv2.imdecode(np.fromstring(snow_layer.make_blob(), np.uint8),
-							  cv2.IMREAD_UNCHANGED) / 255.
+	snow_layer = (np.clip(snow_layer.squeeze(), 0, 1) * 255).astype(np.uint8).astype(np.float32)
+	snow_layer = _to_uint8(_motion_blur(snow_layer, radius=c[4], sigma=c[5], angle=np.random.uniform(-135, -45))) / 255.
 	snow_layer = snow_layer[..., np.newaxis]
 
 	x = c[6] * x + (1 - c[6]) * np.maximum(x, cv2.cvtColor(x, cv2.COLOR_RGB2GRAY).reshape(32, 32, 1) * 1.5 + 0.5)
@@ -379,38 +600,19 @@ def pixelate(x, severity=5):
 	return x
 
 
-# mod of https://gist.github.com/erniejunior/601cdf56d2b424757de5
-def elastic_transform(image, severity=5):
-	IMSIZE = 32
-	c = [(IMSIZE*0, IMSIZE*0, IMSIZE*0.08),
-		 (IMSIZE*0.05, IMSIZE*0.2, IMSIZE*0.07),
-		 (IMSIZE*0.08, IMSIZE*0.06, IMSIZE*0.06),
-		 (IMSIZE*0.1, IMSIZE*0.04, IMSIZE*0.05),
-		 (IMSIZE*0.1, IMSIZE*0.03, IMSIZE*0.03)][severity - 1]
+@functools.lru_cache(maxsize=None)
+def _elastic_grid(shape):
+	"""The (x, y, z) sampling grid of elastic_transform, built once per image shape"""
+	x, y, z = np.meshgrid(np.arange(shape[1], dtype=np.float32), np.arange(shape[0], dtype=np.float32),
+						  np.arange(shape[2], dtype=np.float32))
+	z = np.reshape(z, (-1, 1))
+	for grid in (x, y, z):
+		grid.flags.writeable = False
+	return x, y, z
 
-	image = np.array(image, dtype=np.float32) / 255.
-	shape = image.shape
-	shape_size = shape[:2]
-
-	# random affine
-	center_square = np.float32(shape_size) // 2
-	square_size = min(shape_size) // 3
-	pts1 = np.float32([center_square + square_size,
-					   [center_square[0] + square_size, center_square[1] - square_size],
-					   center_square - square_size])
-	pts2 = pts1 + np.random.uniform(-c[2], c[2], size=pts1.shape).astype(np.float32)
-	M = cv2.getAffineTransform(pts1, pts2)
-	image = cv2.warpAffine(image, M, shape_size[::-1], borderMode=cv2.BORDER_REFLECT_101)
 
-	dx = (gaussian(np.random.uniform(-1, 1, size=shape[:2]),
-				   c[1], mode='reflect', truncate=3) * c[0]).astype(np.float32)
-	dy = (gaussian(np.random.uniform(-1, 1, size=shape[:2]),
-				   c[1], mode='reflect', truncate=3) * c[0]).astype(np.float32)
-	dx, dy = dx[..., np.newaxis], dy[..., np.newaxis]
-
-	x, y, z = np.meshgrid(np.arange(shape[1]), np.arange(shape[0]), np.arange(shape[2]))
-	indices = np.reshape(y + dy, (-1, 1)), np.reshape(x + dx, (-1, 1)), np.reshape(z, (-1, 1))
-	return np.clip(map_coordinates(image, indices, order=1, mode='reflect').reshape(shape), 0, 1) * 255
+# mod of https://gist.github.com/erniejunior/601cdf56d2b424757de5
+def elastic_transform(image, severity=5):
 	IMSIZE = 32
 	c = [(IMSIZE*0, IMSIZE*0, IMSIZE*0.08),
 		 (IMSIZE*0.05, IMSIZE*0.2, IMSIZE*0.07),
@@ -438,8 +640,8 @@ def elastic_transform(image, severity=5):
 				   c[1], mode='reflect', truncate=3) * c[0]).astype(np.float32)
 	dx, dy = dx[..., np.newaxis], dy[..., np.newaxis]
 
-	x, y, z = np.meshgrid(np.arange(shape[1]), np.arange(shape[0]), np.arange(shape[2]))
-	indices = np.reshape(y + dy, (-1, 1)), np.reshape(x + dx, (-1, 1)), np.reshape(z, (-1, 1))
+	x, y, z = _elastic_grid(shape)
+	indices = np.reshape(y + dy, (-1, 1)), np.reshape(x + dx, (-1, 1)), z
 	return np.clip(map_coordinates(image, indices, order=1, mode='reflect').reshape(shape), 0, 1) * 255
 
 def scale(image, severity=5):
@@ -478,6 +680,379 @@ def mix(view, level=5):
 	return func
 # /////////////// End Distortions ///////////////
 
+
+# /////////////// Batched Distortions ///////////////
+# A batched corruption takes a whole stack of images at once:
+#   - np.ndarray (N, H, W, C), uint8 or float, in [0, 255] -> float32 array in [0, 255]
+#   - torch.Tensor (N, C, H, W) in [0, 1] -> tensor in [0, 1] on the same device
+# `rng` selects the random stream:
+#   - None: the global np.random / torch generator, like the single-image versions
+#   - an int seed: one independent stream per image for arrays (see image_rngs),
+#     one torch.Generator on the batch device for tensors
+#   - a list of np.random.Generator (arrays) or a torch.Generator (tensors)
+
+def image_rngs(n, seed):
+	"""One independent np.random.Generator per image, all derived from `seed`"""
+	return [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(n)]
+
+
+def _numpy_rngs(rng, n):
+	if rng is None or isinstance(rng, (list, tuple)):
+		return rng
+	return image_rngs(n, rng)
+
+
+def _host_rngs(rng, n):
+	"""Per-image np.random streams for the host-side draws of a tensor batch"""
+	if isinstance(rng, torch.Generator):
+		rng = int(torch.randint(2 ** 62, (1,), generator=rng, device=rng.device))
+	return _numpy_rngs(rng, n)
+
+
+def _torch_generator(rng, device):
+	if rng is None or isinstance(rng, torch.Generator):
+		return rng
+	generator = torch.Generator(device=device)
+	generator.manual_seed(int(rng))
+	return generator
+
+
+def _normal(rng, shape, scale):
+	"""float32 N(0, scale) noise of `shape`, drawn per image when `rng` is a list of Generators"""
+	if rng is None:
+		return np.random.normal(size=shape, scale=scale).astype(np.float32)
+	return np.stack([g.standard_normal(shape[1:], dtype=np.float32) for g in rng]) * np.float32(scale)
+
+
+def _uniform(rng, shape):
+	if rng is None:
+		return np.random.random_sample(shape).astype(np.float32)
+	return np.stack([g.random(shape[1:], dtype=np.float32) for g in rng])
+
+
+def _tensor_to_batch(x):
+	"""(N, C, H, W) tensor in [0, 1] -> (N, H, W, C) uint8 array, as ToPILImage does per image"""
+	return x.detach().mul(255).byte().permute(0, 2, 3, 1).cpu().numpy()
+
+
+def _batch_to_tensor(x, like):
+	"""(N, H, W, C) array in [0, 255] -> (N, C, H, W) tensor in [0, 1] on the device of `like`"""
+	x = torch.from_numpy(np.ascontiguousarray(np.uint8(np.clip(x, 0, 255)))).to(like.device)
+	return x.permute(0, 3, 1, 2).to(like.dtype).div_(255)
+
+
+def batched(corruption):
+	"""Lift a single-image corruption to a batched one (per-image fallback, draws from np.random)"""
+	def func(x, severity=5, rng=None):
+		if torch.is_tensor(x):
+			return _batch_to_tensor(func(_tensor_to_batch(x), severity), x)
+		return np.stack([np.asarray(corruption(PILImage.fromarray(np.uint8(img)), severity), dtype=np.float32)
+						 for img in x])
+	return func
+
+
+def mix_batch(corruptions):
+	"""Batched corruption applying one of `corruptions`, drawn independently for every image"""
+	def func(x, severity=5, rng=None):
+		if torch.is_tensor(x):
+			rng = _torch_generator(rng, x.device)
+			choice = torch.randint(len(corruptions), (len(x),), generator=rng, device=x.device).cpu().numpy()
+		else:
+			rng = _numpy_rngs(rng, len(x))
+			if rng is None:
+				choice = np.random.randint(len(corruptions), size=len(x))
+			else:
+				choice = np.array([g.integers(len(corruptions)) for g in rng])
+		out = None
+		for i, corruption in enumerate(corruptions):
+			sel = np.flatnonzero(choice == i)
+			if len(sel) == 0:
+				continue
+			sub_rng = [rng[j] for j in sel] if isinstance(rng, list) else rng
+			if torch.is_tensor(x):
+				sel = torch.from_numpy(sel).to(x.device)
+			res = corruption(x[sel], severity, sub_rng)
+			if out is None:
+				shape = (len(x),) + tuple(res.shape[1:])
+				out = res.new_empty(shape) if torch.is_tensor(res) else np.empty(shape, res.dtype)
+			out[sel] = res
+		return out
+	return func
+
+
+def gaussian_noise_batch(x, severity=5, rng=None):
+	c = [0.04, 0.06, .08, .09, .10][severity - 1]
+
+	if torch.is_tensor(x):
+		generator = _torch_generator(rng, x.device)
+		noise = torch.randn(x.shape, generator=generator, device=x.device, dtype=x.dtype)
+		return x.add(noise.mul_(c)).clamp_(0, 1)
+	x = np.asarray(x, dtype=np.float32) / 255.
+	return np.clip(x + _normal(_numpy_rngs(rng, len(x)), x.shape, c), 0, 1) * 255
+
+
+def shot_noise_batch(x, severity=5, rng=None):
+	c = [500, 250, 100, 75, 50][severity - 1]
+
+	if torch.is_tensor(x):
+		generator = _torch_generator(rng, x.device)
+		return torch.poisson(x * c, generator=generator).div_(c).clamp_(0, 1)
+	x = np.asarray(x, dtype=np.float32) / 255.
+	rng = _numpy_rngs(rng, len(x))
+	if rng is None:
+		x = np.random.poisson(x * c)
+	else:
+		x = np.stack([g.poisson(img * c) for g, img in zip(rng, x)])
+	return np.clip(x.astype(np.float32) / c, 0, 1) * 255
+
+
+def impulse_noise_batch(x, severity=5, rng=None):
+	c = [.01, .02, .03, .05, .07][severity - 1]
+
+	# same law as skimage's s&p with salt_vs_pepper=0.5: every value is flipped with
+	# probability c, to pepper or salt with equal odds; one uniform draw decides both
+	if torch.is_tensor(x):
+		generator = _torch_generator(rng, x.device)
+		u = torch.rand(x.shape, generator=generator, device=x.device)
+		x = torch.where(u < c, (u >= c / 2).to(x.dtype), x)
+		return x.clamp_(0, 1)
+	x = np.asarray(x, dtype=np.float32) / 255.
+	u = _uniform(_numpy_rngs(rng, len(x)), x.shape)
+	x = np.where(u < c, (u >= c / 2).astype(np.float32), x)
+	return np.clip(x, 0, 1) * 255
+
+
+def speckle_noise_batch(x, severity=5, rng=None):
+	c = [.06, .1, .12, .16, .2][severity - 1]
+
+	if torch.is_tensor(x):
+		generator = _torch_generator(rng, x.device)
+		noise = torch.randn(x.shape, generator=generator, device=x.device, dtype=x.dtype)
+		return x.add(x * noise.mul_(c)).clamp_(0, 1)
+	x = np.asarray(x, dtype=np.float32) / 255.
+	return np.clip(x + x * _normal(_numpy_rngs(rng, len(x)), x.shape, c), 0, 1) * 255
+
+
+def _uniform_params(rng, n, low, high, like):
+	"""One U(low, high) host-side parameter per image, drawn from the stream(s) of `rng`"""
+	if torch.is_tensor(like):
+		return torch.empty(n, device=like.device).uniform_(low, high, generator=rng).cpu().numpy()
+	if rng is None:
+		return np.random.uniform(low, high, size=n)
+	return np.array([g.uniform(low, high) for g in rng])
+
+
+def _filter_batch(x, kernels):
+	"""cv2.filter2D with BORDER_REPLICATE for a (N, C, H, W) tensor, one (k, k) kernel per image"""
+	n, ch, h, w = x.shape
+	k = kernels.shape[-1]
+	weight = kernels.to(x).repeat_interleave(ch, dim=0).unsqueeze(1)
+	x = F.pad(x.reshape(1, n * ch, h, w), [k // 2] * 4, mode='replicate')
+	return F.conv2d(x, weight, groups=n * ch).view(n, ch, h, w)
+
+
+def original_batch(x, severity=5, rng=None):
+	"""identity, float32 like the other array corruptions so that mix_batch can combine them"""
+	if torch.is_tensor(x):
+		return x
+	return np.asarray(x, dtype=np.float32)
+
+
+def motion_blur_batch(x, severity=5, rng=None):
+	c = [(6,1), (6,1.5), (6,2), (8,2), (9,2.5)][severity - 1]
+
+	if torch.is_tensor(x):
+		rng = _torch_generator(rng, x.device)
+		angles = _uniform_params(rng, len(x), -45, 45, x)
+		kernels = np.stack([motion_blur_kernel(c[0], c[1], a) for a in angles])
+		return _filter_batch(x, torch.from_numpy(kernels)).clamp_(0, 1)
+	x = np.asarray(x, dtype=np.float32)
+	angles = _uniform_params(_numpy_rngs(rng, len(x)), len(x), -45, 45, x)
+	return np.stack([_to_uint8(_motion_blur(img, c[0], c[1], a)) for img, a in zip(x, angles)]).astype(np.float32)
+
+
+def _pad_symmetric(x, radius, dim):
+	"""scipy's mode='reflect' (d c b a | a b c d) padding along `dim`, for radius <= size"""
+	size = x.shape[dim]
+	return torch.cat([x.narrow(dim, 0, radius).flip(dim), x, x.narrow(dim, size - radius, radius).flip(dim)], dim)
+
+
+def _gaussian_batch(x, sigma, truncate=4.0, mode='nearest'):
+	"""skimage.filters.gaussian (mode 'nearest' or 'reflect') over H and W of a (N, C, H, W) tensor"""
+	radius = int(truncate * sigma + 0.5)
+	if radius == 0:
+		return x
+	t = torch.arange(-radius, radius + 1, device=x.device, dtype=x.dtype)
+	kernel = torch.exp(-0.5 * (t / sigma) ** 2)
+	kernel = kernel / kernel.sum()
+	n, ch, h, w = x.shape
+	x = x.reshape(n * ch, 1, h, w)
+	if mode == 'nearest':
+		x = F.conv2d(F.pad(x, [radius, radius, 0, 0], mode='replicate'), kernel.view(1, 1, 1, -1))
+		x = F.conv2d(F.pad(x, [0, 0, radius, radius], mode='replicate'), kernel.view(1, 1, -1, 1))
+	else:
+		x = F.conv2d(_pad_symmetric(x, radius, 3), kernel.view(1, 1, 1, -1))
+		x = F.conv2d(_pad_symmetric(x, radius, 2), kernel.view(1, 1, -1, 1))
+	return x.view(n, ch, h, w)
+
+
+@functools.lru_cache(maxsize=None)
+def _pixel_grid(h, w, device):
+	"""(H, W, 3) homogeneous pixel coordinates (x, y, 1), built once per shape and device"""
+	xs = torch.arange(w, dtype=torch.float32, device=device).view(1, w).expand(h, w)
+	ys = torch.arange(h, dtype=torch.float32, device=device).view(h, 1).expand(h, w)
+	return torch.stack([xs, ys, torch.ones_like(xs)], dim=-1)
+
+
+def _elastic_warp(x, jitter, noise, c):
+	"""
+	elastic_transform of a (N, C, H, W) float tensor in [0, 1], given the (N, 3, 2) jitter of
+	the affine control points and the (N, 2, H, W) raw U(-1, 1) displacement noise
+	"""
+	n, _, h, w = x.shape
+	grid = _pixel_grid(h, w, x.device)
+
+	# random affine: cv2.warpAffine samples src at M^-1(p), with BORDER_REFLECT_101
+	center_square = torch.tensor([h // 2, w // 2], dtype=torch.float32, device=x.device)
+	square_size = min(h, w) // 3
+	pts1 = torch.stack([center_square + square_size,
+						center_square + torch.tensor([square_size, -square_size], device=x.device),
+						center_square - square_size]).expand(n, 3, 2)
+	pts2 = torch.cat([pts1 + jitter, torch.ones(n, 3, 1, device=x.device)], dim=2)
+	inverse = torch.matmul(torch.inverse(pts2), pts1)  # (N, 3, 2): maps pts2 back onto pts1
+	src = torch.matmul(grid.view(1, h * w, 3), inverse).view(n, h, w, 2)
+	scale = torch.tensor([2. / (w - 1), 2. / (h - 1)], device=x.device)
+	x = F.grid_sample(x, src * scale - 1, mode='bilinear', padding_mode='reflection', align_corners=True)
+
+	# smooth displacement field, then map_coordinates(order=1, mode='reflect')
+	disp = _gaussian_batch(noise, c[1], truncate=3, mode='reflect') * c[0]
+	src = grid[..., :2] + disp.permute(0, 2, 3, 1)
+	scale = torch.tensor([2. / w, 2. / h], device=x.device)
+	return F.grid_sample(x, (src + 0.5) * scale - 1, mode='bilinear', padding_mode='reflection',
+						 align_corners=False)
+
+
+def elastic_transform_batch(x, severity=5, rng=None):
+	IMSIZE = 32
+	c = [(IMSIZE*0, IMSIZE*0, IMSIZE*0.08),
+		 (IMSIZE*0.05, IMSIZE*0.2, IMSIZE*0.07),
+		 (IMSIZE*0.08, IMSIZE*0.06, IMSIZE*0.06),
+		 (IMSIZE*0.1, IMSIZE*0.04, IMSIZE*0.05),
+		 (IMSIZE*0.1, IMSIZE*0.03, IMSIZE*0.03)][severity - 1]
+
+	if torch.is_tensor(x):
+		n, _, h, w = x.shape
+		rng = _torch_generator(rng, x.device)
+		jitter = torch.empty(n, 3, 2, device=x.device).uniform_(-c[2], c[2], generator=rng)
+		noise = torch.empty(n, 2, h, w, device=x.device).uniform_(-1, 1, generator=rng)
+		return _elastic_warp(x.float(), jitter, noise, c).to(x.dtype).clamp_(0, 1)
+
+	# arrays run the same float32 warp through torch on the cpu
+	x = torch.from_numpy(np.asarray(x, dtype=np.float32) / 255.).permute(0, 3, 1, 2)
+	n, _, h, w = x.shape
+	rng = _numpy_rngs(rng, n)
+	if rng is None:
+		jitter = np.random.uniform(-c[2], c[2], size=(n, 3, 2))
+		noise = np.random.uniform(-1, 1, size=(n, 2, h, w))
+	else:
+		jitter = np.stack([g.uniform(-c[2], c[2], size=(3, 2)) for g in rng])
+		noise = np.stack([g.uniform(-1, 1, size=(2, h, w)) for g in rng])
+	jitter = torch.from_numpy(jitter.astype(np.float32))
+	noise = torch.from_numpy(noise.astype(np.float32))
+	x = _elastic_warp(x, jitter, noise, c)
+	return np.clip(x.permute(0, 2, 3, 1).numpy(), 0, 1) * 255
+
+
+def glass_blur_batch(x, severity=5, rng=None):
+	# sigma, max_delta, iterations
+	c = [(0.05,1,1), (0.25,1,1), (0.4,1,1), (0.25,1,2), (0.4,1,2)][severity - 1]
+
+	if torch.is_tensor(x):
+		rng = _torch_generator(rng, x.device)
+		x = torch.floor(_gaussian_batch(x, c[0]) * 255) / 255
+		n, _, h, w = x.shape
+		hs = torch.arange(h - c[1], c[1], -1, device=x.device)[:, None]
+		ws = torch.arange(w - c[1], c[1], -1, device=x.device)[None, :]
+		idx = torch.arange(n, device=x.device)[:, None, None]
+		for i in range(c[2]):
+			d = torch.randint(-c[1], c[1], (n, h - 2 * c[1], w - 2 * c[1], 2), generator=rng, device=x.device)
+			x[idx, :, hs, ws] = x[idx, :, hs + d[..., 1], ws + d[..., 0]]
+		return _gaussian_batch(x, c[0]).clamp_(0, 1)
+
+	x = np.asarray(x, dtype=np.float32) / 255.
+	rng = _numpy_rngs(rng, len(x))
+	n, h, w = x.shape[:3]
+	size = (h - 2 * c[1], w - 2 * c[1], 2)
+	# skimage's gaussian is ndimage.gaussian_filter with mode='nearest', per channel
+	x = np.uint8(gaussian_filter(x, sigma=(0, c[0], c[0], 0), mode='nearest') * 255)
+	for i in range(c[2]):
+		if rng is None:
+			d = np.random.randint(-c[1], c[1], size=(n,) + size)
+		else:
+			d = np.stack([g.integers(-c[1], c[1], size=size) for g in rng])
+		x = _glass_shuffle(x, d, c[1])
+	x = gaussian_filter(x.astype(np.float32) / 255., sigma=(0, c[0], c[0], 0), mode='nearest')
+	return np.clip(x, 0, 1) * 255
+
+
+def frost_batch(x, severity=5, rng=None):
+	c = [(1, 0.2), (1, 0.3), (0.9, 0.4), (0.85, 0.4), (0.75, 0.45)][severity - 1]
+
+	if torch.is_tensor(x):
+		frost = get_frost_bank().sample(len(x), x.shape[-1], _host_rngs(rng, len(x)))
+		frost = torch.from_numpy(frost).to(x.device).permute(0, 3, 1, 2).to(x.dtype).div_(255)
+		return (c[0] * x + c[1] * frost).clamp_(0, 1)
+	x = np.asarray(x, dtype=np.float32)
+	frost = get_frost_bank().sample(len(x), x.shape[1], _numpy_rngs(rng, len(x)))
+	return np.clip(c[0] * x + c[1] * frost, 0, 255)
+
+
+def fog_batch(x, severity=5, rng=None):
+	c = [(.2,3), (.5,3), (0.75,2.5), (1,2), (1.5,1.75)][severity - 1]
+
+	if torch.is_tensor(x):
+		fractal = get_fractal_bank().sample(len(x), c[1], _host_rngs(rng, len(x)))
+		fractal = torch.from_numpy(fractal[:, :x.shape[2], :x.shape[3]]).to(x.device, x.dtype)
+		max_val = x.amax(dim=(1, 2, 3), keepdim=True)
+		x = x + c[0] * fractal.unsqueeze(1)
+		return (x * max_val / (max_val + c[0])).clamp_(0, 1)
+	x = np.asarray(x, dtype=np.float32) / 255.
+	fractal = get_fractal_bank().sample(len(x), c[1], _numpy_rngs(rng, len(x)))
+	max_val = x.max(axis=(1, 2, 3), keepdims=True)
+	x = x + c[0] * fractal[:, :x.shape[1], :x.shape[2], np.newaxis]
+	return np.clip(x * max_val / (max_val + c[0]), 0, 1) * 255
+
+
+def zoom_blur_batch(x, severity=5, rng=None):
+	c = [np.arange(1, 1.06, 0.01), np.arange(1, 1.11, 0.01), np.arange(1, 1.16, 0.01),
+		 np.arange(1, 1.21, 0.01), np.arange(1, 1.26, 0.01)][severity - 1]
+
+	# every zoom of the stack is a pair of precomputed matrix products over the whole batch
+	if torch.is_tensor(x):
+		rows = torch.from_numpy(zoom_pyramid(x.shape[2], tuple(c))).to(x.device, x.dtype)
+		cols = torch.from_numpy(zoom_pyramid(x.shape[3], tuple(c))).to(x.device, x.dtype)
+		out = torch.matmul(torch.matmul(rows[:, None, None], x[None]), cols[:, None, None].transpose(-1, -2))
+		return ((x + out.sum(0)) / (len(c) + 1)).clamp_(0, 1)
+	x = np.asarray(x, dtype=np.float32).transpose(0, 3, 1, 2) / 255.
+	rows = zoom_pyramid(x.shape[2], tuple(c))
+	cols = zoom_pyramid(x.shape[3], tuple(c))
+	out = np.matmul(np.matmul(rows[:, None, None], x[None]), cols[:, None, None].transpose(0, 1, 2, 4, 3))
+	x = (x + out.sum(0)) / (len(c) + 1)
+	return np.clip(x.transpose(0, 2, 3, 1), 0, 1) * 255
+
+
+def contrast_batch(x, severity=5, rng=None):
+	c = [.75, .5, .4, .3, 0.15][severity - 1]
+
+	if torch.is_tensor(x):
+		means = x.mean(dim=(2, 3), keepdim=True)
+		return ((x - means) * c + means).clamp_(0, 1)
+	x = np.asarray(x, dtype=np.float32) / 255.
+	means = np.mean(x, axis=(1, 2), keepdims=True)
+	return np.clip((x - means) * c + means, 0, 1) * 255
+
+# /////////////// End Batched Distortions ///////////////
+
 import collections
 
 def C_list():
@@ -502,7 +1077,7 @@ def C_list():
 	d['gaussian_blur'] = gaussian_blur
 	d['spatter'] = spatter
 	d['saturate'] = saturate
-	d['original'] = lambda x:x
+	d['original'] = lambda x, severity=5: x
 	d['scale'] = scale ###
 	d['various_noise'] = various_noise ###
 
@@ -524,4 +1099,45 @@ def create_augmentation(view, level):
 	def func(img):
 		res = [ img, trn.ToTensor()(corruption(convert_img(img), level)) ]
 		return res
-	return func
\ No newline at end of file
+	return func
+
+
+def C_batch_list():
+	d = collections.OrderedDict()
+	for name, corruption in C_list().items():
+		d[name] = batched(corruption)
+	d['gaussian_noise'] = gaussian_noise_batch
+	d['shot_noise'] = shot_noise_batch
+	d['impulse_noise'] = impulse_noise_batch
+	d['glass_blur'] = glass_blur_batch
+	d['motion_blur'] = motion_blur_batch
+	d['zoom_blur'] = zoom_blur_batch
+	d['frost'] = frost_batch
+	d['fog'] = fog_batch
+	d['elastic_transform'] = elastic_transform_batch
+	d['contrast'] = contrast_batch
+	d['speckle_noise'] = speckle_noise_batch
+	d['original'] = original_batch
+	d['various_noise'] = mix_batch([gaussian_noise_batch, shot_noise_batch, impulse_noise_batch])
+
+	return d
+
+def create_batch_augmentation(view, level):
+	"""Batched create_augmentation: func(x, rng=None) -> [x, corrupted x] for a whole batch"""
+	batch_list = C_batch_list()
+	if '-' in view:
+		# every image draws its own view
+		corruption = mix_batch([batch_list[v] for v in view.split('-')])
+	elif '+' in view:
+		views = [batch_list[v] for v in view.split('+')]
+		def corruption(x, severity, rng=None):
+			# share one set of streams so later stages do not replay earlier draws
+			rng = _torch_generator(rng, x.device) if torch.is_tensor(x) else _numpy_rngs(rng, len(x))
+			for v in views:
+				x = v(x, severity, rng)
+			return x
+	else:
+		corruption = batch_list[view]
+	def func(x, rng=None):
+		return [x, corruption(x, level, rng)]
+	return func
@@ -1,5 +1,7 @@
 from __future__ import print_function
 
+import os
+
 import numpy as np
 from skimage import color
 
@@ -36,6 +38,13 @@ class ImageFolderInstance(datasets.ImageFolder):
 
         return img, target, index
 
+class CIFAR10Instance(datasets.CIFAR10):
+    """CIFAR10 which returns the index of the image as well"""
+    def __getitem__(self, index):
+        img, target = super(CIFAR10Instance, self).__getitem__(index)
+        return img, target, index
+
+
 class RGB(object):
     """Return RGB PIL image directly."""
     def __call__(self, img):
@@ -127,3 +136,63 @@ class RGB2CIERGB(object):
         img = np.asarray(img, np.uint8)
         img = color.rgb2rgbcie(img)
         return img
+
+
+def corrupted_shard_path(folder, view, level, k=0):
+    """Shard k of (view, level) in `folder`. Like the CIFAR-10-C-trainval files, the name holds the
+    0-based severity level - 1, and copy 0 keeps their name"""
+    if k == 0:
+        return os.path.join(folder, '%s_%d_images.npy' % (view, level - 1))
+    return os.path.join(folder, '%s_%d_images_%d.npy' % (view, level - 1, k))
+
+
+def corrupted_shard_paths(root, train, view, level):
+    """Shards written by materialize_corruption.py"""
+    folder = os.path.join(root, 'CIFAR-10-C-trainval', 'train' if train else 'val')
+    paths = [corrupted_shard_path(folder, view, level)]
+    while os.path.exists(corrupted_shard_path(folder, view, level, len(paths))):
+        paths.append(corrupted_shard_path(folder, view, level, len(paths)))
+    return paths
+
+
+class CorruptedCIFAR10(datasets.CIFAR10):
+    """CIFAR10 whose corrupted view is read from pre-generated uint8 shards instead of computed
+
+    Every training sample picks one of the K materialized copies at random, the val split always
+    serves copy 0. The clean and corrupted images are stacked into a (6, H, W) tensor so that
+    `transform` (RandomCrop, RandomHorizontalFlip, ...) moves both the same way; `split_transform`
+    then turns the stack into the [clean, corrupted] views.
+    """
+
+    def __init__(self, root, view, level, train=True, transform=None, split_transform=None,
+                 target_transform=None, download=False):
+        super(CorruptedCIFAR10, self).__init__(root, train=train, transform=None,
+                                               target_transform=target_transform, download=download)
+        self.stack_transform = transform
+        self.split_transform = split_transform
+        self.copies = [np.load(p, mmap_mode='r') for p in corrupted_shard_paths(root, train, view, level)]
+        for c in self.copies:
+            assert c.shape == self.data.shape, 'shard {} does not match the dataset'.format(c.shape)
+
+    def __getitem__(self, index):
+        k = torch.randint(len(self.copies), (1,)).item() if self.train else 0
+        img = torch.from_numpy(np.concatenate([self.data[index], self.copies[k][index]], axis=2))
+        img = img.permute(2, 0, 1).float().div(255)
+        target = self.targets[index]
+
+        if self.stack_transform is not None:
+            img = self.stack_transform(img)
+        img = list(img.split(3))
+        if self.split_transform is not None:
+            img = self.split_transform(img)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+
+        return img, target
+
+
+class CorruptedCIFAR10Instance(CorruptedCIFAR10):
+    """CorruptedCIFAR10 which returns the index of the image as well"""
+    def __getitem__(self, index):
+        img, target = super(CorruptedCIFAR10Instance, self).__getitem__(index)
+        return img, target, index
@@ -0,0 +1,80 @@
+"""
+Pre-generate K corrupted copies of CIFAR-10 for a (view, level) pair.
+
+Copies are written as uint8 (N, 32, 32, 3) .npy shards next to the CIFAR-10-C-trainval files:
+	<data_folder>/CIFAR-10-C-trainval/{train,val}/<view>_<level - 1>_images.npy       copy 0
+	<data_folder>/CIFAR-10-C-trainval/{train,val}/<view>_<level - 1>_images_<k>.npy   copy k
+with the 0-based severity of the CIFAR-10-C-trainval files (gaussian_noise_4_images.npy is level 5)
+and are served by dataset.CorruptedCIFAR10 (--offline_aug in train_CMC_beta.py / LinearProbing_beta.py).
+
+python materialize_corruption.py --data_folder ../data/myCIFAR-10-C/ --view gaussian_noise --level 5 --copies 8
+"""
+from __future__ import print_function
+
+import os
+import time
+import argparse
+
+import numpy as np
+from torchvision import datasets
+
+from corruption import create_batch_augmentation, image_rngs
+from dataset import corrupted_shard_path
+
+
+def parse_option():
+
+	parser = argparse.ArgumentParser('argument for corruption materialization')
+
+	parser.add_argument('--data_folder', type=str, default=None, help='path to data')
+	parser.add_argument('--view', type=str, default='gaussian_noise')
+	parser.add_argument('--level', type=int, default=5)
+	parser.add_argument('--copies', type=int, default=4, help='number of stochastic copies of the train split')
+	parser.add_argument('--val_copies', type=int, default=1, help='number of copies of the val split')
+	parser.add_argument('--batch_size', type=int, default=1000)
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--overwrite', action='store_true', help='regenerate existing shards')
+
+	opt = parser.parse_args()
+	if opt.data_folder is None:
+		raise ValueError('one or more of the folders is None: data_folder')
+	return opt
+
+
+def materialize(images, corruption, path, seed, batch_size):
+	"""write one corrupted copy of `images` to `path`, chunk by chunk through a memory map"""
+	tmp = path + '.tmp.npy'
+	out = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.uint8, shape=images.shape)
+	rngs = image_rngs(len(images), seed)
+	for i in range(0, len(images), batch_size):
+		x = images[i:i + batch_size]
+		_, corrupted = corruption(x, rngs[i:i + batch_size])
+		out[i:i + batch_size] = np.uint8(np.clip(corrupted, 0, 255))
+	out.flush()
+	del out
+	# readers never see a partially written shard
+	os.replace(tmp, path)
+
+
+def main():
+
+	opt = parse_option()
+	corruption = create_batch_augmentation(opt.view, opt.level)
+
+	for split, train, copies in [('train', True, opt.copies), ('val', False, opt.val_copies)]:
+		folder = os.path.join(opt.data_folder, 'CIFAR-10-C-trainval', split)
+		if not os.path.isdir(folder):
+			os.makedirs(folder)
+		images = datasets.CIFAR10(root=opt.data_folder, train=train, download=True).data
+		for k in range(copies):
+			path = corrupted_shard_path(folder, opt.view, opt.level, k)
+			if os.path.exists(path) and not opt.overwrite:
+				print('==> {} exists, skip'.format(path))
+				continue
+			start = time.time()
+			materialize(images, corruption, path, [opt.seed, int(train), k], opt.batch_size)
+			print('==> {} ({:.1f}s)'.format(path, time.time() - start))
+
+
+if __name__ == '__main__':
+	main()
@@ -3,10 +3,8 @@ import torch.nn as nn
 import math
 import numpy as np
 import torch.utils.model_zoo as model_zoo
-from corruption import C_list
+from augmentation import BatchCorruption
 from models.ttt_resnet import ResNetCifar # use this for corruption commmonly
-from torchvision import transforms
-from PIL import Image
 # NORM = ((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
 # normalize = transforms.Normalize(*NORM)
 # norm = transforms.Compose([transforms.ToTensor(), transforms.Normalize(*NORM)])
@@ -31,14 +29,6 @@ model_urls = {
 	'resnet152': 'https://download.pytorch.org/models/resnet152-b121ed2d.pth',
 }
 
-convert_img = transforms.Compose([transforms.ToTensor(), transforms.ToPILImage()])
-
-NORM = ((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
-normalize = transforms.Normalize(*NORM)
-add_transform = transforms.Compose([
-	transforms.ToTensor(),
-	normalize,
-])
 def conv3x3(in_planes, out_planes, stride=1):
 	"""3x3 convolution with padding"""
 	return nn.Conv2d(in_planes, out_planes, kernel_size=3, stride=stride,
@@ -284,57 +274,15 @@ class ResNetV1(nn.Module):
 			raise NotImplementedError('model {} is not implemented'.format(name))
 		self.view = view
 		self.level = level
+		if view != 'Lab':
+			# corrupt the whole batch on its device instead of per image through PIL
+			self.augmentation = BatchCorruption(view, level)
 
 	def forward(self, x, layer=7): # layer can be removed
 		if self.view == 'Lab':
 			l, ab = torch.split(x, [1, 2], dim=1)
-		elif self.view == 'various_noise':
-			x_np = x.cpu().detach().numpy() #(128, 3, 32, 32)
-
-			x_l = []
-			x_np_tran = []
-			for i in range(x_np.shape[0]):
-				x_np_i = convert_img( x_np[i].transpose(1, 2, 0) )
-				x_np_i_c = np.uint8( C_list()[self.view](x_np_i, i, self.level) )
-				x_np_i_c_n = add_transform(x_np_i_c)
-				x_np_i_c_n = x_np_i_c_n.detach().numpy()
-
-				x_np_tran.append( x_np_i_c_n )
-
-				x_l.append( add_transform(x_np_i).detach().numpy() )
-			x_np_tran = np.array(x_np_tran).astype(np.uint8)
-			ab = torch.from_numpy(x_np_tran).float().cuda()
-
-			x_l = np.array(x_l).astype(np.uint8)
-			l = torch.from_numpy(x_l).float().cuda()
 		else:
-			x_np = x.cpu().detach().numpy() #(128, 3, 32, 32)
-
-			x_l = []
-			x_np_tran = []
-			for i in range(x_np.shape[0]):
-				x_np_i = convert_img( x_np[i].transpose(1, 2, 0) )
-				x_np_i_c = np.uint8( C_list()[self.view](x_np_i, self.level) )
-				
-				# x_np_i_c_n = x_np_i_c.transpose(2, 0, 1)
-				x_np_i_c_n = add_transform(x_np_i_c)
-				x_np_i_c_n = x_np_i_c_n.detach().numpy()
-
-				# ###### one can visualize images by using this
-				# if i == 100:
-				# 	des1 = './show/pic/img_np_i_c_%s_%s_n.jpg' %(self.view, str(self.level))
-				# 	des2 = './show/pic/img_np_i_n.jpg'
-				# 	convert_img( x_np_i_c_n.transpose(1, 2, 0) ).save(des1)
-				# 	convert_img( add_transform(x_np_i).detach().numpy().transpose(1, 2, 0) ).save(des2)
-				# ######
-
-				x_np_tran.append( x_np_i_c_n )
-				x_l.append( add_transform(x_np_i).detach().numpy() )
-			x_np_tran = np.array(x_np_tran).astype(np.uint8)
-			ab = torch.from_numpy(x_np_tran).float().cuda()
-
-			x_l = np.array(x_l).astype(np.uint8)
-			l = torch.from_numpy(x_l).float().cuda()
+			l, ab = self.augmentation(x)
 		
 		feat_l = self.l_to_ab(l)
 		feat_ab = self.ab_to_l(ab)
@@ -0,0 +1,76 @@
+from __future__ import print_function
+
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+
+
+class ShuffleBN(object):
+    """
+    Shuffling BN of the MoCo key encoder, keeping the positive key from being normalized with
+    the statistics of the sub-batch its query comes from.
+
+    mode:
+        'shuffle': permute the batch before the key encoder (split over GPUs by DataParallel)
+            and restore the order of the keys
+        'distributed': every rank sends batchSize / world_size of its permuted samples to every
+            other rank with all_to_all and the keys are sent back the same way
+        'syncbn': no shuffle, convert() replaces the BN layers with SyncBatchNorm, which needs
+            DistributedDataParallel on GPU
+        'none': nothing
+
+    Permutations are drawn on the device of the batch from a generator seeded with `seed` (and
+    the rank), so a step never waits for the host.
+    """
+    modes = ['shuffle', 'distributed', 'syncbn', 'none']
+
+    def __init__(self, mode='shuffle', seed=0, group=None):
+        if mode not in self.modes:
+            raise NotImplementedError('ShuffleBN mode not supported {}'.format(mode))
+        self.mode = mode
+        self.seed = seed
+        self.group = group
+        self.generator = None
+        self._perm = None
+
+    def convert(self, model):
+        """the key encoder to use with this mode"""
+        if self.mode == 'syncbn':
+            return nn.SyncBatchNorm.convert_sync_batchnorm(model, process_group=self.group)
+        return model
+
+    def _randperm(self, n, device):
+        if self.generator is None or self.generator.device != device:
+            self.generator = torch.Generator(device=device)
+            rank = dist.get_rank(self.group) if self.mode == 'distributed' else 0
+            self.generator.manual_seed(self.seed + rank)
+        return torch.randperm(n, generator=self.generator, device=device)
+
+    def shuffle(self, x):
+        if self.mode not in ['shuffle', 'distributed']:
+            return x
+        self._perm = self._randperm(x.size(0), x.device)
+        x = x.index_select(0, self._perm)
+        if self.mode == 'distributed':
+            world_size = dist.get_world_size(self.group)
+            if x.size(0) % world_size != 0:
+                raise ValueError('batch size {} not divisible by the world size {}'.format(x.size(0), world_size))
+            out = torch.empty_like(x)
+            dist.all_to_all_single(out, x, group=self.group)
+            x = out
+        return x
+
+    def unshuffle(self, x):
+        if self.mode not in ['shuffle', 'distributed']:
+            return x
+        if self.mode == 'distributed':
+            out = torch.empty_like(x)
+            dist.all_to_all_single(out, x.contiguous(), group=self.group)
+            x = out
+        out = torch.empty_like(x)
+        out.index_copy_(0, self._perm, x)
+        self._perm = None
+        return out
+
+    def __call__(self, model, x):
+        return self.unshuffle(model(self.shuffle(x)))
@@ -0,0 +1,94 @@
+import torch
+
+from NCE.alias_multinomial import AliasMethod
+
+
+def reference_table(probs):
+    """the sequential table construction of the original AliasMethod"""
+    K = len(probs)
+    prob = torch.zeros(K, dtype=torch.float64)
+    alias = torch.LongTensor([0] * K)
+    smaller = []
+    larger = []
+    for kk, p in enumerate(probs / probs.sum()):
+        prob[kk] = K * p
+        if prob[kk] < 1.0:
+            smaller.append(kk)
+        else:
+            larger.append(kk)
+    while len(smaller) > 0 and len(larger) > 0:
+        small = smaller.pop()
+        large = larger.pop()
+        alias[small] = large
+        prob[large] = (prob[large] - 1.0) + prob[small]
+        if prob[large] < 1.0:
+            smaller.append(large)
+        else:
+            larger.append(large)
+    for last_one in smaller + larger:
+        prob[last_one] = 1
+    return prob, alias
+
+
+def table_distribution(prob, alias):
+    """the outcome probabilities a (prob, alias) table draws with"""
+    prob = prob.double()
+    K = prob.size(-1)
+    dist = prob.clone()
+    dist.scatter_add_(-1, alias, 1 - prob)
+    return dist / K
+
+
+def distributions(K=1000):
+    g = torch.Generator().manual_seed(0)
+    yield torch.rand(K, generator=g, dtype=torch.float64)
+    # heavy tail, many outcomes far below 1 / K
+    yield 1. / torch.arange(1, K + 1, dtype=torch.float64) ** 1.5
+    sparse = torch.rand(K, generator=g, dtype=torch.float64)
+    sparse[torch.randperm(K, generator=g)[:K // 2]] = 0
+    yield sparse
+    yield torch.ones(K, dtype=torch.float64)
+
+
+def test_build_matches_sequential_table():
+    for probs in distributions():
+        target = probs / probs.sum()
+        prob, alias = AliasMethod.build(probs)
+        assert prob.dtype == torch.float32 and prob.min() >= 0 and prob.max() <= 1
+        assert ((alias >= 0) & (alias < len(probs))).all()
+        assert torch.allclose(table_distribution(prob, alias), target, atol=1e-9, rtol=1e-6)
+        assert torch.allclose(table_distribution(*reference_table(probs)), target, atol=1e-9, rtol=1e-6)
+
+
+def test_build_rows():
+    probs = torch.stack(list(distributions(257)))
+    prob, alias = AliasMethod.build(probs)
+    assert prob.shape == alias.shape == probs.shape
+    for p, a, row in zip(prob, alias, probs):
+        assert torch.allclose(table_distribution(p, a), row / row.sum(), atol=1e-9, rtol=1e-6)
+
+
+def test_draw():
+    torch.manual_seed(0)
+    probs = 1. / torch.arange(1, 51, dtype=torch.float64)
+    sampler = AliasMethod(probs.clone())
+    first = sampler.draw(200000)
+    second = sampler.draw(200000)
+    assert first.data_ptr() != second.data_ptr()
+    assert first.min() >= 0 and first.max() < 50
+    freq = torch.bincount(first, minlength=50).double() / len(first)
+    target = probs / probs.sum()
+    # a few standard deviations of the binomial counts
+    assert ((freq - target).abs() <= 5 * (target * (1 - target) / len(first)).sqrt()).all()
+
+
+def test_save_load(tmpdir):
+    sampler = AliasMethod(torch.rand(100))
+    path = str(tmpdir.join('alias.pth'))
+    sampler.save(path)
+    loaded = AliasMethod.load(path)
+    assert torch.equal(loaded.prob, sampler.prob) and torch.equal(loaded.alias, sampler.alias)
+    torch.manual_seed(1)
+    a = sampler.draw(1000)
+    torch.manual_seed(1)
+    assert torch.equal(loaded.draw(1000), a)
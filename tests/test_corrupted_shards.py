@@ -0,0 +1,35 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dataset import corrupted_shard_path, corrupted_shard_paths
+
+
+def loader_path(data_folder, split, view, level):
+    """the CIFAR-10-C-trainval file train_CMC.py / LinearProbing_beta.py / test_lc.py read for a level"""
+    return data_folder + '/CIFAR-10-C-trainval/%s/%s_%s_images.npy' % (split, view, level - 1)
+
+
+def test_copy_0_is_the_loaders_file():
+    for level in range(1, 6):
+        for split in ['train', 'val']:
+            folder = os.path.join('data', 'CIFAR-10-C-trainval', split)
+            assert os.path.normpath(corrupted_shard_path(folder, 'gaussian_noise', level)) == \
+                os.path.normpath(loader_path('data', split, 'gaussian_noise', level))
+    assert corrupted_shard_path('val', 'fog', 5).endswith('fog_4_images.npy')
+
+
+def test_round_trip(tmpdir):
+    root = str(tmpdir)
+    folder = os.path.join(root, 'CIFAR-10-C-trainval', 'train')
+    os.makedirs(folder)
+    # materialize_corruption.py writes copies 0..2 of level 4; a level 5 file sits next to them
+    written = [corrupted_shard_path(folder, 'snow', 4, k) for k in range(3)]
+    for path in written + [loader_path(root, 'train', 'snow', 5)]:
+        np.save(path, np.zeros((1, 32, 32, 3), np.uint8))
+    assert corrupted_shard_paths(root, True, 'snow', 4) == written
+    assert [os.path.normpath(p) for p in corrupted_shard_paths(root, True, 'snow', 5)] == \
+        [os.path.normpath(loader_path(root, 'train', 'snow', 5))]
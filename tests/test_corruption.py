@@ -0,0 +1,426 @@
+import inspect
+import json
+import os
+
+import numpy as np
+import pytest
+import torch
+
+cv2 = pytest.importorskip('cv2')
+ndimage = pytest.importorskip('scipy.ndimage')
+# corruption.py imports the Resizer package of the scale corruption
+C = pytest.importorskip('corruption')
+
+# gaussian_blur and glass_blur call skimage's gaussian(multichannel=True), removed in skimage 0.19
+needs_multichannel = pytest.mark.skipif('multichannel' not in inspect.signature(C.gaussian).parameters,
+                                        reason='skimage without gaussian(multichannel=...)')
+
+
+def images(n=4, size=32, seed=0):
+    return np.random.RandomState(seed).randint(0, 256, (n, size, size, 3)).astype(np.uint8)
+
+
+def as_tensor(x):
+    return torch.from_numpy(x).permute(0, 3, 1, 2).float() / 255
+
+
+# resize the image ('scale') or need the frost textures
+SAME_SHAPE = [pytest.param(name, marks=needs_multichannel) if name == 'gaussian_blur' else name
+              for name in C.C_batch_list() if name not in ['scale', 'frost']]
+
+
+@pytest.mark.parametrize('name', SAME_SHAPE)
+def test_batched_corruption_contract(name):
+    corruption = C.C_batch_list()[name]
+    x = images()
+    out = corruption(x, 3, rng=0)
+    assert out.shape == x.shape and out.dtype == np.float32
+    assert out.min() >= 0 and out.max() <= 255
+    t = as_tensor(x)
+    out = corruption(t, 3, rng=0)
+    assert torch.is_tensor(out) and out.shape == t.shape and out.dtype == t.dtype
+    assert out.min() >= 0 and out.max() <= 1
+
+
+def test_contrast_batch_matches_contrast():
+    x = images()
+    for severity in range(1, 6):
+        ref = np.stack([C.contrast(img, severity) for img in x])
+        np.testing.assert_allclose(C.contrast_batch(x, severity), ref, atol=1e-3)
+        np.testing.assert_allclose(C.contrast_batch(as_tensor(x), severity).permute(0, 2, 3, 1).numpy() * 255,
+                                   ref, atol=1e-3)
+
+
+def test_per_image_fallback_matches_scalar():
+    x = images()
+    np.random.seed(0)
+    ref = np.stack([C.defocus_blur(C.PILImage.fromarray(img), 2) for img in x])
+    np.random.seed(0)
+    np.testing.assert_allclose(C.batched(C.defocus_blur)(x, 2), ref, atol=1e-3)
+
+
+def test_batch_corruption_views():
+    augmentation = pytest.importorskip('augmentation')
+    t = as_tensor(images())
+    clean, corrupted = C.create_batch_augmentation('contrast', 2)(t)
+    assert clean is t
+    torch.testing.assert_close(corrupted, C.contrast_batch(t, 2))
+    clean, corrupted = augmentation.BatchCorruption('contrast', 2)(t)
+    torch.testing.assert_close(clean, (t - 0.5) / 0.5)
+    torch.testing.assert_close(corrupted, (C.contrast_batch(t, 2) - 0.5) / 0.5)
+    # mixed views draw one corruption per image
+    out = C.create_batch_augmentation('contrast-original', 2)(t, rng=0)[1]
+    for img, o in zip(t, out):
+        assert torch.allclose(o, img) or torch.allclose(o, C.contrast_batch(img[None], 2)[0])
+
+NOISE = ['gaussian_noise', 'shot_noise', 'speckle_noise']
+
+
+@pytest.mark.parametrize('name', NOISE)
+def test_noise_batch_matches_scalar(name):
+    # with rng=None the batch draws from np.random in the order of the scalar version
+    x = images(1)
+    for severity in range(1, 6):
+        np.random.seed(severity)
+        ref = getattr(C, name)(x[0], severity)
+        np.random.seed(severity)
+        np.testing.assert_allclose(getattr(C, name + '_batch')(x, severity)[0], ref, atol=1e-3)
+
+
+@pytest.mark.parametrize('name', NOISE + ['impulse_noise'])
+def test_noise_batch_streams(name):
+    corruption = getattr(C, name + '_batch')
+    x = images(5)
+    out = corruption(x, 4, rng=7)
+    np.testing.assert_array_equal(out, corruption(x, 4, rng=C.image_rngs(5, 7)))
+    # every image has its own stream, the rest of the batch does not matter
+    for i, g in enumerate(C.image_rngs(5, 7)):
+        np.testing.assert_array_equal(out[i], corruption(x[i:i + 1], 4, rng=[g])[0])
+    t = as_tensor(x)
+    torch.testing.assert_close(corruption(t, 4, rng=7), corruption(t, 4, rng=7), rtol=0, atol=0)
+    assert not torch.equal(corruption(t, 4, rng=7), corruption(t, 4, rng=8))
+
+
+def test_impulse_noise_law():
+    # every value is flipped with probability c, to 0 or 255 with equal odds
+    x = np.full((64, 32, 32, 3), 128, dtype=np.uint8)
+    for severity, c in zip(range(1, 6), [.01, .02, .03, .05, .07]):
+        for out in [C.impulse_noise_batch(x, severity, rng=severity),
+                    np.round(C.impulse_noise_batch(as_tensor(x), severity, rng=severity).numpy() * 255)]:
+            pepper, salt = np.mean(out == 0), np.mean(out == 255)
+            assert abs(pepper + salt - c) < 0.1 * c and abs(pepper - salt) < 0.1 * c
+            assert np.sum(out == 0) + np.sum(out == 255) + np.sum(out == 128) == out.size
+
+def test_motion_blur_kernel():
+    # ImageMagick's kernel: a one-sided gaussian of width 2 * radius + 1 along the angle
+    for radius, sigma in [(6, 1), (9, 2.5)]:
+        width = 2 * radius + 1
+        weights = np.exp(-np.arange(width) ** 2 / (2. * sigma ** 2))
+        weights /= weights.sum()
+        kernel = C.motion_blur_kernel(radius, sigma, 0)
+        assert kernel.shape == (2 * width - 1, 2 * width - 1)
+        np.testing.assert_allclose(kernel[width - 1, width - 1:], weights, rtol=1e-6)
+        np.testing.assert_allclose(C.motion_blur_kernel(radius, sigma, 90)[width - 1:, width - 1], weights, rtol=1e-6)
+        for angle in [-45, -12.3, 30]:
+            assert abs(C.motion_blur_kernel(radius, sigma, angle).sum() - 1) < 1e-6
+    assert C.motion_blur_kernel(6, 1, 10.2) is C.motion_blur_kernel(6, 1, 9.8)
+
+
+def test_motion_blur_batch_matches_scalar():
+    x = images(3)
+    for severity in range(1, 6):
+        np.random.seed(severity)
+        ref = np.stack([C.motion_blur(img, severity) for img in x])
+        assert ref.dtype == np.uint8
+        np.random.seed(severity)
+        out = C.C_batch_list()['motion_blur'](x, severity)
+        # the batch draws the angles of all images first
+        np.random.seed(severity)
+        angles = np.random.uniform(-45, 45, size=len(x))
+        c = [(6, 1), (6, 1.5), (6, 2), (8, 2), (9, 2.5)][severity - 1]
+        np.testing.assert_array_equal(out, np.stack([C._to_uint8(C._motion_blur(img.astype(np.float32), c[0], c[1], a))
+                                                     for img, a in zip(x, angles)]))
+        np.testing.assert_array_equal(out[0], ref[0])
+
+
+def test_filter_batch_matches_filter2d():
+    # the tensor path convolves with the same kernels, replicating the border like cv2
+    x = images(3)
+    kernels = np.stack([C.motion_blur_kernel(8, 2, a) for a in [-40, 5, 33]])
+    out = C._filter_batch(as_tensor(x), torch.from_numpy(kernels)).permute(0, 2, 3, 1).numpy()
+    ref = np.stack([C._motion_blur(img.astype(np.float32) / 255, 8, 2, a) for img, a in zip(x, [-40, 5, 33])])
+    np.testing.assert_allclose(out, ref, atol=1e-5)
+
+
+def test_snow_layer_is_8_bit():
+    # on a black image snow is a constant plus the 8-bit snow layer and its rotation
+    np.random.seed(0)
+    for severity in range(1, 6):
+        c = [0.95, 0.9, 0.9, 0.85, 0.8][severity - 1]
+        layers = C.snow(np.zeros((32, 32, 3), dtype=np.uint8), severity) - (1 - c) * 0.5 * 255
+        unclipped = layers < 200
+        np.testing.assert_allclose(layers[unclipped], np.round(layers[unclipped]), atol=1e-3)
+
+GLASS = [(0.05, 1, 1), (0.25, 1, 1), (0.4, 1, 1), (0.25, 1, 2), (0.4, 1, 2)]
+
+
+def glass_shuffle_loop(x, d, max_delta):
+    """the pixel loop of the original glass_blur, reading the (dx, dy) of every pixel from d"""
+    x = x.copy()
+    for i, h in enumerate(range(x.shape[0] - max_delta, max_delta, -1)):
+        for j, w in enumerate(range(x.shape[1] - max_delta, max_delta, -1)):
+            dx, dy = d[i, j]
+            h_prime, w_prime = h + dy, w + dx
+            # swap
+            x[h, w], x[h_prime, w_prime] = x[h_prime, w_prime], x[h, w]
+    return x
+
+
+def reference_glass_blur(x, c, draws):
+    """the original glass_blur in float64, skimage's multichannel gaussian being gaussian_filter(mode='nearest')"""
+    blur = lambda img: ndimage.gaussian_filter(img, sigma=(c[0], c[0], 0), mode='nearest')
+    x = np.uint8(blur(x / 255.) * 255)
+    for i in range(c[2]):
+        x = glass_shuffle_loop(x, draws(), c[1])
+    return np.clip(blur(x / 255.), 0, 1) * 255
+
+
+def test_glass_shuffle_is_the_loop():
+    x = images(3)
+    d = np.random.RandomState(0).randint(-1, 1, size=(3, 30, 30, 2))
+    out = C._glass_shuffle(x.copy(), d, 1)
+    for img, o, di in zip(x, out, d):
+        np.testing.assert_array_equal(o, glass_shuffle_loop(img, di, 1))
+    # one randint call per pass draws what the loop drew pixel by pixel
+    np.random.seed(0)
+    loop = np.stack([np.random.randint(-1, 1, size=(2,)) for _ in range(30 * 30)])
+    np.random.seed(0)
+    np.testing.assert_array_equal(np.random.randint(-1, 1, size=(30, 30, 2)).reshape(-1, 2), loop)
+
+
+@needs_multichannel
+def test_glass_blur_is_the_loop():
+    x = images(1)[0]
+    for severity in range(1, 6):
+        np.random.seed(severity)
+        out = C.glass_blur(x, severity)
+        np.random.seed(severity)
+        ref = reference_glass_blur(x, GLASS[severity - 1], lambda: np.random.randint(-1, 1, size=(30, 30, 2)))
+        np.testing.assert_allclose(out, ref, atol=1e-6)
+
+
+def test_glass_blur_batch_matches_loop():
+    x = images(3)
+    for severity in range(1, 6):
+        c = GLASS[severity - 1]
+        out = C.glass_blur_batch(x, severity, rng=severity)
+        for img, o, g in zip(x, out, C.image_rngs(3, severity)):
+            ref = reference_glass_blur(img, c, lambda: g.integers(-1, 1, size=(30, 30, 2)))
+            np.testing.assert_allclose(o, ref, atol=1e-3)
+        # the tensor path draws the passes from one generator seeded with rng
+        generator = torch.Generator()
+        generator.manual_seed(severity)
+        draws = lambda: torch.randint(-1, 1, (3, 30, 30, 2), generator=generator).numpy()
+        out = C.glass_blur_batch(as_tensor(x), severity, rng=severity).permute(0, 2, 3, 1).numpy() * 255
+        d = [draws() for _ in range(c[2])]
+        for i, (img, o) in enumerate(zip(x, out)):
+            passes = iter([di[i] for di in d])
+            ref = reference_glass_blur(img, c, lambda: next(passes))
+            # float32 blur: a few values truncate to the neighbouring 8-bit step before the shuffle
+            assert np.abs(o - ref).max() < 1 and np.mean(np.abs(o - ref) > 1e-3) < 2e-3
+
+@pytest.fixture
+def frost_bank(tmpdir, monkeypatch):
+    """a FrostBank over random textures in tmpdir, installed as the process-wide bank"""
+    rs = np.random.RandomState(0)
+    for filename in C.FrostBank.filenames:
+        cv2.imwrite(os.path.join(str(tmpdir), filename), rs.randint(0, 256, (240, 200, 3)).astype(np.uint8))
+    bank = C.FrostBank(str(tmpdir))
+    monkeypatch.setattr(C, '_frost_bank', bank)
+    return bank
+
+
+def reference_frost(x, severity, base_path):
+    """the original frost(), decoding its texture on every call"""
+    c = [(1, 0.2), (1, 0.3), (0.9, 0.4), (0.85, 0.4), (0.75, 0.45)][severity - 1]
+    idx = np.random.randint(5)
+    frost = cv2.imread(os.path.join(base_path, C.FrostBank.filenames[idx]))
+    frost = cv2.resize(frost, (0, 0), fx=0.2, fy=0.2)
+    # randomly crop and convert to rgb
+    x_start, y_start = np.random.randint(0, frost.shape[0] - 32), np.random.randint(0, frost.shape[1] - 32)
+    frost = frost[x_start:x_start + 32, y_start:y_start + 32][..., [2, 1, 0]]
+    return np.clip(c[0] * np.array(x) + c[1] * frost, 0, 255)
+
+
+def test_frost_matches_original(frost_bank):
+    x = images(1)[0]
+    for severity in range(1, 6):
+        np.random.seed(severity)
+        ref = reference_frost(x, severity, frost_bank.base_path)
+        np.random.seed(severity)
+        np.testing.assert_array_equal(C.frost(x, severity), ref)
+    # cached textures are opened with mmap by the next bank
+    assert os.path.isfile(os.path.join(frost_bank.cache_dir, 'frost1.npy'))
+    bank = C.FrostBank(frost_bank.base_path)
+    assert all(isinstance(t, np.memmap) for t in bank.textures)
+    for a, b in zip(bank.textures, frost_bank.textures):
+        np.testing.assert_array_equal(a, b)
+
+
+def test_frost_bank_without_cache(frost_bank, tmpdir):
+    # a cache directory that cannot be created keeps the textures in memory
+    blocked = tmpdir.join('file')
+    blocked.write('')
+    bank = C.FrostBank(frost_bank.base_path, cache_dir=os.path.join(str(blocked), 'cache'))
+    assert not any(isinstance(t, np.memmap) for t in bank.textures)
+    for a, b in zip(bank.textures, frost_bank.textures):
+        np.testing.assert_array_equal(a, b)
+
+
+def test_frost_batch(frost_bank):
+    x = images(3)
+    out = C.frost_batch(x, 4, rng=0)
+    for img, o, g in zip(x, out, C.image_rngs(3, 0)):
+        crop = frost_bank.crop(g.integers(5), 32, g)
+        np.testing.assert_allclose(o, np.clip(0.85 * img + 0.4 * crop, 0, 255), atol=1e-3)
+    out = C.frost_batch(as_tensor(x), 4, rng=0)
+    assert out.shape == (3, 3, 32, 32) and 0 <= out.min() and out.max() <= 1
+
+def dihedral_variants(fractal):
+    """the 8 rotations/flips of a map under every cyclic offset"""
+    m = fractal.shape[0]
+    for k in range(4):
+        for flipped in [fractal, fractal[::-1]]:
+            rotated = np.rot90(flipped, k)
+            for dy in range(m):
+                for dx in range(m):
+                    yield np.roll(rotated, (dy, dx), axis=(0, 1))
+
+
+def test_plasma_fractal_batch_matches_scalar():
+    for wibbledecay in [3, 2.5, 1.75]:
+        np.random.seed(0)
+        ref = C.plasma_fractal(32, wibbledecay)
+        np.random.seed(0)
+        out = C.plasma_fractal_batch(1, 32, wibbledecay, dtype=np.float64)
+        np.testing.assert_allclose(out[0], ref, atol=1e-12)
+
+
+def test_fractal_bank_samples_pool_variants(tmpdir):
+    bank = C.FractalBank(size=3, mapsize=8, path=str(tmpdir))
+    pool = bank.pool(2)
+    for sample in bank.sample(6, 2, rng=C.image_rngs(6, 0)):
+        assert any(np.array_equal(sample, v) for fractal in pool for v in dihedral_variants(fractal))
+    # saved under path and mapped by the next bank
+    other = C.FractalBank(size=3, mapsize=8, path=str(tmpdir)).pool(2)
+    assert isinstance(other, np.memmap)
+    np.testing.assert_array_equal(other, pool)
+    bank.refill(2, background=False)
+    assert bank.pool(2).shape == pool.shape and not np.array_equal(bank.pool(2), pool)
+
+
+def test_fog_batch():
+    x = images(3)
+    out = C.fog_batch(x, 2, rng=0)
+    fractal = C.get_fractal_bank().sample(3, 3, C.image_rngs(3, 0))
+    x = x / 255.
+    max_val = x.max(axis=(1, 2, 3), keepdims=True)
+    ref = np.clip((x + 0.5 * fractal[..., np.newaxis]) * max_val / (max_val + 0.5), 0, 1) * 255
+    np.testing.assert_allclose(out, ref, atol=1e-3)
+
+
+ELASTIC = [(32 * 0, 32 * 0, 32 * 0.08),
+           (32 * 0.05, 32 * 0.2, 32 * 0.07),
+           (32 * 0.08, 32 * 0.06, 32 * 0.06),
+           (32 * 0.1, 32 * 0.04, 32 * 0.05),
+           (32 * 0.1, 32 * 0.03, 32 * 0.03)]
+
+
+def exact_elastic(img, jitter, noise, c):
+    """elastic_transform of one (H, W, C) image in [0, 1] with exact (float64) bilinear resampling"""
+    h, w = img.shape[:2]
+    center_square = np.float32([h, w]) // 2
+    square_size = min(h, w) // 3
+    pts1 = np.float32([center_square + square_size,
+                       [center_square[0] + square_size, center_square[1] - square_size],
+                       center_square - square_size])
+    inverse = cv2.invertAffineTransform(cv2.getAffineTransform(pts1, pts1 + jitter))
+    ys, xs = np.mgrid[0:h, 0:w].astype(np.float64)
+    # cv2.warpAffine with BORDER_REFLECT_101 is scipy's 'mirror'
+    src = [inverse[1, 0] * xs + inverse[1, 1] * ys + inverse[1, 2], inverse[0, 0] * xs + inverse[0, 1] * ys + inverse[0, 2]]
+    img = np.stack([ndimage.map_coordinates(img[..., k], src, order=1, mode='mirror') for k in range(img.shape[2])], -1)
+    dx = ndimage.gaussian_filter(noise[0].astype(np.float64), c[1], mode='reflect', truncate=3) * c[0]
+    dy = ndimage.gaussian_filter(noise[1].astype(np.float64), c[1], mode='reflect', truncate=3) * c[0]
+    return np.stack([ndimage.map_coordinates(img[..., k], [ys + dy, xs + dx], order=1, mode='reflect')
+                     for k in range(img.shape[2])], -1)
+
+
+@pytest.mark.parametrize('severity', range(1, 6))
+@pytest.mark.parametrize('smooth', [False, True])
+def test_elastic_warp_is_exact_bilinear(severity, smooth):
+    # cv2.warpAffine, used by the scalar elastic_transform, rounds the bilinear weights to 1/32
+    # pixel and differs from both by up to ~5/255; the batched warp is checked against exact bilinear
+    rs = np.random.RandomState(severity)
+    c = ELASTIC[severity - 1]
+    imgs = rs.rand(4, 32, 32, 3)
+    if smooth:
+        imgs = ndimage.gaussian_filter(imgs, (0, 2, 2, 0))
+    jitter = rs.uniform(-c[2], c[2], size=(4, 3, 2)).astype(np.float32)
+    noise = rs.uniform(-1, 1, size=(4, 2, 32, 32)).astype(np.float32)
+    out = C._elastic_warp(torch.from_numpy(imgs).float().permute(0, 3, 1, 2), torch.from_numpy(jitter),
+                          torch.from_numpy(noise), c).permute(0, 2, 3, 1).numpy()
+    ref = np.stack([exact_elastic(i, j, n, c) for i, j, n in zip(imgs, jitter, noise)])
+    np.testing.assert_allclose(out, ref, atol=1e-4)
+
+
+def test_elastic_transform_batch_shapes():
+    x = np.random.RandomState(0).randint(0, 256, (3, 32, 32, 3)).astype(np.uint8)
+    out = C.elastic_transform_batch(x, 3, rng=0)
+    assert out.shape == x.shape and out.dtype == np.float32 and out.min() >= 0 and out.max() <= 255
+    np.testing.assert_array_equal(out, C.elastic_transform_batch(x, 3, rng=0))
+    t = torch.from_numpy(x).permute(0, 3, 1, 2).float() / 255
+    out = C.elastic_transform_batch(t, 3, rng=0)
+    assert out.shape == t.shape and 0 <= out.min() and out.max() <= 1
+
+
+@pytest.mark.parametrize('severity', range(1, 6))
+def test_zoom_blur_batch_matches_scalar(severity):
+    x = images(3)
+    ref = np.stack([C.zoom_blur(img, severity) for img in x])
+    np.testing.assert_allclose(C.zoom_blur_batch(x, severity), ref, atol=1e-4)
+    out = C.zoom_blur_batch(as_tensor(x), severity).permute(0, 2, 3, 1).numpy() * 255
+    np.testing.assert_allclose(out, ref, atol=1e-4)
+
+
+def test_original_entries():
+    x = images(4)
+    img = C.PILImage.fromarray(x[0])
+    assert C.C_list()['original'](img, 3) is img
+    clean, corrupted = C.create_augmentation('original', 3)(as_tensor(x)[0])
+    torch.testing.assert_close(corrupted, clean, atol=1 / 255., rtol=0)
+    out = C.C_batch_list()['original'](x, 3)
+    assert out.dtype == np.float32
+    np.testing.assert_array_equal(out, x)
+    # mixed with another corruption, the float outputs are not truncated to the input dtype
+    out = C.create_batch_augmentation('original-contrast', 3)(x, rng=0)[1]
+    contrast = C.contrast_batch(x, 3)
+    for img, o, c in zip(x, out, contrast):
+        assert np.array_equal(o, img) or np.array_equal(o, c)
+    assert not np.array_equal(out, np.round(out))
+
+
+def test_bench_corruption(tmpdir, monkeypatch):
+    bench = pytest.importorskip('bench_corruption')
+    output = os.path.join(str(tmpdir), 'bench', 'corruption.json')
+    monkeypatch.setattr('sys.argv', ['bench_corruption.py', '--corruptions', 'contrast,original,gaussian_noise',
+                                     '--severities', '1,5', '--num_images', '6', '--batch_size', '4',
+                                     '--repeat', '1', '--output', output])
+    bench.main()
+    with open(output) as f:
+        results = json.load(f)['results']
+    assert [(r['corruption'], r['severity']) for r in results] == \
+        [(n, s) for n in ['contrast', 'original', 'gaussian_noise'] for s in [1, 5]]
+    for r in results:
+        assert r['scalar']['images_per_sec'] > 0 and r['batch']['images_per_sec'] > 0
+        if r['corruption'] != 'gaussian_noise':
+            assert r['check']['max_abs_err'] < 1e-3
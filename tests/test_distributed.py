@@ -0,0 +1,50 @@
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+if not dist.is_available() or not dist.is_gloo_available():
+    pytest.skip('torch.distributed with gloo is not available', allow_module_level=True)
+
+from NCE.NCEAverage import NCEAverage
+from NCE.distributed import DistributedNCEAverage
+
+
+def compare_with_single_process(rank, world_size, init_method):
+    """DistributedNCEAverage on `world_size` gloo processes against a single NCEAverage"""
+    dist.init_process_group('gloo', init_method=init_method, rank=rank, world_size=world_size)
+    n, D, K, B = 103, 16, 20, 4
+    for use_softmax, sync_free in [(True, False), (False, False), (False, True)]:
+        torch.manual_seed(0)
+        reference = NCEAverage(D, n, K, use_softmax=use_softmax)
+        sharded = DistributedNCEAverage(D, n, K, use_softmax=use_softmax, sync_free=sync_free)
+        rows = sharded.memory_l.size(0)
+        sharded.memory_l.copy_(reference.memory_l[sharded.offset:sharded.offset + rows])
+        sharded.memory_ab.copy_(reference.memory_ab[sharded.offset:sharded.offset + rows])
+        # the shards consumed a different number of draws on every rank
+        torch.manual_seed(1)
+        for step in range(3):
+            l = torch.nn.functional.normalize(torch.randn(world_size * B, D), dim=1).requires_grad_()
+            ab = torch.nn.functional.normalize(torch.randn(world_size * B, D), dim=1).requires_grad_()
+            y = torch.randperm(n)[:world_size * B]
+            idx = torch.randint(n, (world_size * B, K + 1))
+            idx[:, 0] = y
+            mine = slice(rank * B, (rank + 1) * B)
+            local = [t[mine].detach().clone().requires_grad_() for t in [l, ab]]
+            out = reference(l, ab, y, idx)
+            sum(o.pow(2).sum() for o in out).backward()
+            out_sharded = sharded(local[0], local[1], y[mine], idx[mine])
+            sum(o.pow(2).sum() for o in out_sharded).backward()
+            for o, s in zip(out, out_sharded):
+                assert torch.allclose(o[mine], s, rtol=1e-4, atol=1e-5)
+            for t, s in zip([l, ab], local):
+                assert torch.allclose(t.grad[mine], s.grad, rtol=1e-4, atol=1e-5)
+        # Z comes from the logits of all ranks
+        assert torch.allclose(reference.params, sharded.params)
+        assert torch.allclose(reference.memory_l[sharded.offset:sharded.offset + rows], sharded.memory_l, atol=1e-6)
+        assert torch.allclose(reference.memory_ab[sharded.offset:sharded.offset + rows], sharded.memory_ab, atol=1e-6)
+    dist.destroy_process_group()
+
+
+def test_matches_single_process(tmpdir):
+    mp.spawn(compare_with_single_process, args=(3, 'file://' + str(tmpdir.join('init'))), nprocs=3)
@@ -0,0 +1,297 @@
+import copy
+
+import pytest
+import torch
+
+from NCE.NCEAverage import NCEAverage, MemoryInsDis, MemoryMoCo
+from NCE.sampler import HardNegativeSampler
+
+# few rows, so negatives often hit the positives the update overwrites
+n, D, K, B = 30, 16, 20, 6
+
+
+def features(seed, batchSize=B):
+    g = torch.Generator().manual_seed(seed)
+    return [torch.nn.functional.normalize(torch.randn(batchSize, D, generator=g), dim=1).requires_grad_()
+            for _ in range(2)]
+
+
+def reference_forward(memory_l, memory_ab, params, l, ab, y, idx, use_softmax):
+    """forward of the original NCEAverage on the memories and params given, updating them in place"""
+    K, T, Z_l, Z_ab, momentum = params.tolist()
+    batchSize, inputSize = l.shape
+    weight_l = torch.index_select(memory_l, 0, idx.view(-1)).detach().view(batchSize, -1, inputSize)
+    out_ab = torch.bmm(weight_l, ab.view(batchSize, inputSize, 1))
+    weight_ab = torch.index_select(memory_ab, 0, idx.view(-1)).detach().view(batchSize, -1, inputSize)
+    out_l = torch.bmm(weight_ab, l.view(batchSize, inputSize, 1))
+    if use_softmax:
+        out_l, out_ab = torch.div(out_l, T), torch.div(out_ab, T)
+    else:
+        out_ab = torch.exp(torch.div(out_ab, T))
+        out_l = torch.exp(torch.div(out_l, T))
+        if Z_l < 0:
+            params[2] = out_l.mean() * memory_l.size(0)
+            Z_l = params[2].item()
+        if Z_ab < 0:
+            params[3] = out_ab.mean() * memory_l.size(0)
+            Z_ab = params[3].item()
+        out_l, out_ab = torch.div(out_l, Z_l), torch.div(out_ab, Z_ab)
+    with torch.no_grad():
+        for memory, x in [(memory_l, l), (memory_ab, ab)]:
+            pos = torch.index_select(memory, 0, y.view(-1)).mul_(momentum).add_(torch.mul(x, 1 - momentum))
+            memory.index_copy_(0, y, pos.div(pos.pow(2).sum(1, keepdim=True).pow(0.5)))
+    return out_l, out_ab
+
+
+def run(contrast, steps=3, seed=0, idx=None):
+    """forward + backward of `steps` batches; the outputs, input gradients and memories"""
+    outputs, grads = [], []
+    for step in range(steps):
+        l, ab = features(seed + step)
+        y = torch.randperm(n, generator=torch.Generator().manual_seed(seed + step))[:B]
+        torch.manual_seed(seed + step)
+        out = contrast(l, ab, y, None if idx is None else idx[step])
+        sum(o.pow(2).sum() for o in out).backward()
+        outputs.append([o.detach() for o in out])
+        grads.append([l.grad, ab.grad])
+    return outputs, grads
+
+
+def draws(steps=3, seed=0):
+    """explicit samples, column 0 the positives run() uses"""
+    idx = []
+    for step in range(steps):
+        y = torch.randperm(n, generator=torch.Generator().manual_seed(seed + step))[:B]
+        i = torch.randint(n, (B, K + 1), generator=torch.Generator().manual_seed(100 + step))
+        i[:, 0] = y
+        idx.append(i)
+    return idx
+
+
+def assert_close(a, b, tol=1e-6):
+    """equal up to float32 rounding, relative to the magnitude of the tensor"""
+    torch.testing.assert_close(a, b, rtol=10 * tol, atol=tol * max(1., b.abs().max().item()))
+
+
+def assert_runs_close(a, b, tol=1e-6):
+    for x, y in zip(a, b):
+        for s, t in zip(x, y):
+            for u, v in zip(s, t):
+                assert_close(u, v, tol)
+
+
+@pytest.mark.parametrize('use_softmax', [True, False])
+def test_matches_original_forward(use_softmax):
+    torch.manual_seed(0)
+    contrast = NCEAverage(D, n, K, use_softmax=use_softmax)
+    memory_l, memory_ab, params = contrast.memory_l.clone(), contrast.memory_ab.clone(), contrast.params.clone()
+    idx = draws()
+    result = run(contrast, idx=idx)
+
+    outputs, grads = [], []
+    for step in range(3):
+        l, ab = features(step)
+        out = reference_forward(memory_l, memory_ab, params, l, ab, idx[step][:, 0], idx[step], use_softmax)
+        sum(o.pow(2).sum() for o in out).backward()
+        outputs.append([o.detach() for o in out])
+        grads.append([l.grad, ab.grad])
+    assert_runs_close(result, (outputs, grads))
+    assert_close(contrast.memory_l, memory_l)
+    assert_close(contrast.memory_ab, memory_ab)
+    assert_close(contrast.params, params)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 4, K + 1, 64])
+@pytest.mark.parametrize('use_softmax', [True, False])
+def test_chunked_matches_dense(chunk_size, use_softmax):
+    torch.manual_seed(0)
+    dense = NCEAverage(D, n, K, use_softmax=use_softmax)
+    chunked = copy.deepcopy(dense)
+    chunked.chunk_size = chunk_size
+    assert_runs_close(run(chunked), run(dense))
+    assert_close(chunked.memory_l, dense.memory_l)
+    assert_close(chunked.memory_ab, dense.memory_ab)
+
+
+def test_chunked_backward_after_two_forwards():
+    # GatherScore keeps the drawn indices for backward, a second forward must not overwrite them.
+    # The samples of the first batch avoid the rows the second one updates.
+    torch.manual_seed(0)
+    dense = NCEAverage(D, n, K, use_softmax=True)
+    chunked = copy.deepcopy(dense)
+    chunked.chunk_size = 3
+    idx = [torch.randint(n // 2, (B, K + 1)), torch.randint(n, (B, K + 1))]
+    idx[0][:, 0] = torch.arange(B)
+    idx[1][:, 0] = torch.arange(B) + n // 2
+    grads = []
+    for contrast in [dense, chunked]:
+        inputs = features(0) + features(1)
+        out = contrast(inputs[0], inputs[1], idx[0][:, 0], idx[0]) + \
+            contrast(inputs[2], inputs[3], idx[1][:, 0], idx[1])
+        sum(o.pow(2).sum() for o in out).backward()
+        grads.append([x.grad for x in inputs])
+    for a, b in zip(*grads):
+        assert_close(a, b)
+
+
+def reference_moco(memory, params, index, q, k, T, use_softmax):
+    """forward of the original clone-based MemoryMoCo, updating memory and params in place"""
+    batchSize = q.size(0)
+    k = k.detach()
+    l_pos = torch.bmm(q.view(batchSize, 1, -1), k.view(batchSize, -1, 1)).view(batchSize, 1)
+    l_neg = torch.mm(memory.clone().detach(), q.transpose(1, 0)).transpose(0, 1)
+    out = torch.cat((l_pos, l_neg), dim=1)
+    if use_softmax:
+        out = torch.div(out, T)
+    else:
+        out = torch.exp(torch.div(out, T))
+        if params[0] < 0:
+            params[0] = out.mean() * n
+        out = torch.div(out, params[0].item())
+    with torch.no_grad():
+        memory.index_copy_(0, torch.fmod(torch.arange(batchSize) + index, memory.size(0)), k)
+    return out.squeeze().contiguous(), (index + batchSize) % memory.size(0)
+
+
+@pytest.mark.parametrize('use_softmax', [True, False])
+def test_moco_ring_buffer_matches_clone(use_softmax):
+    # a queue of 14 with batches of 6 wraps around every few steps
+    torch.manual_seed(0)
+    moco = MemoryMoCo(D, n, 14, use_softmax=use_softmax)
+    memory, params, index = moco.memory.clone(), moco.params.clone(), 0
+    for step in range(5):
+        q, k = features(step)
+        out = moco(q, k)
+        out.pow(2).sum().backward()
+        grad = q.grad
+        q.grad = None
+        ref, index = reference_moco(memory, params, index, q, k, moco.T, use_softmax)
+        ref.pow(2).sum().backward()
+        assert_close(out.detach(), ref.detach())
+        assert_close(grad, q.grad)
+        assert torch.equal(moco.memory, memory) and moco.index == index and moco.ptr.item() == index
+    assert_close(moco.params, params)
+
+
+def test_moco_pointer_checkpoint():
+    torch.manual_seed(0)
+    moco = MemoryMoCo(D, n, 14, use_softmax=True)
+    for step in range(3):
+        moco(*features(step))
+    state = moco.state_dict()
+    resumed = MemoryMoCo(D, n, 14, use_softmax=True)
+    resumed.load_state_dict(state)
+    assert resumed.index == moco.index == 4
+    # checkpoints saved before the pointer was stored start at the beginning of the queue
+    del state['ptr']
+    resumed.load_state_dict(state)
+    assert resumed.index == 0 and resumed.ptr.item() == 0
+
+
+def contrast_modules(use_softmax, **kwargs):
+    torch.manual_seed(0)
+    return [NCEAverage(D, n, K, use_softmax=use_softmax, **kwargs),
+            MemoryInsDis(D, n, K, use_softmax=use_softmax, **kwargs),
+            MemoryMoCo(D, n, 14, use_softmax=use_softmax, **kwargs)]
+
+
+def forward(contrast, step):
+    l, ab = features(step)
+    y = torch.randperm(n, generator=torch.Generator().manual_seed(step))[:B]
+    torch.manual_seed(step)
+    if isinstance(contrast, NCEAverage):
+        out = contrast(l, ab, y)
+    elif isinstance(contrast, MemoryInsDis):
+        out = contrast(l, y)
+    else:
+        out = contrast(l, ab)
+    out = out if isinstance(out, tuple) else (out,)
+    sum(o.pow(2).sum() for o in out).backward()
+    return [o.detach() for o in out] + [l.grad]
+
+
+@pytest.mark.parametrize('use_softmax', [True, False])
+def test_sync_free_matches_default(use_softmax):
+    for default, sync_free in zip(contrast_modules(use_softmax), contrast_modules(use_softmax, sync_free=True)):
+        for step in range(4):
+            for a, b in zip(forward(sync_free, step), forward(default, step)):
+                assert_close(a, b)
+        for (name, a), b in zip(sync_free.state_dict().items(), default.state_dict().values()):
+            assert_close(a.float(), b.float())
+
+
+def test_calibrate():
+    for contrast in contrast_modules(False, sync_free=True):
+        memories = {k: v.clone() for k, v in contrast.state_dict().items() if k != 'params'}
+        l, ab = features(0)
+        if isinstance(contrast, NCEAverage):
+            contrast.calibrate(l, ab, torch.arange(B))
+            assert (contrast.params[2:4] > 0).all()
+        elif isinstance(contrast, MemoryInsDis):
+            contrast.calibrate(l, torch.arange(B))
+            assert contrast.params[2] > 0
+        else:
+            contrast.calibrate(l, ab)
+            assert contrast.params[0] > 0
+        for k, v in memories.items():
+            assert torch.equal(contrast.state_dict()[k], v)
+
+
+def test_hyperparameters_from_checkpoint():
+    contrast = NCEAverage(D, n, K, T=0.07, momentum=0.5)
+    contrast.load_state_dict(NCEAverage(D, n, 7, T=0.2, momentum=0.9).state_dict())
+    assert (contrast.K, contrast.T, contrast.momentum) == (7, pytest.approx(0.2), pytest.approx(0.9))
+    assert isinstance(contrast.K, int)
+
+
+@pytest.mark.parametrize('storage', ['float32', 'float16', 'int8'])
+@pytest.mark.parametrize('chunk_size', [None, 4])
+@pytest.mark.parametrize('use_softmax', [True, False])
+def test_fused_matches_separate(storage, chunk_size, use_softmax):
+    torch.manual_seed(0)
+    separate = NCEAverage(D, n, K, use_softmax=use_softmax, chunk_size=chunk_size, storage=storage)
+    fused = NCEAverage(D, n, K, use_softmax=use_softmax, chunk_size=chunk_size, storage=storage, fused_memory=True)
+    # checkpoints of separate memories load into the fused layout
+    fused.load_state_dict(separate.state_dict())
+    assert_runs_close(run(fused), run(separate))
+    for view in range(2):
+        assert_close(fused.memory_rows(view), separate.memory_rows(view))
+
+
+def test_fused_duplicate_indices():
+    # every duplicate writes the same row, that of the last occurrence
+    torch.manual_seed(0)
+    fused = NCEAverage(D, n, K, fused_memory=True)
+    before = fused.memory.clone()
+    l, ab = features(0)
+    y = torch.tensor([3, 7, 3, 9, 7, 3])
+    fused.update(l.detach(), ab.detach(), y, 0.5)
+    for row, last in [(3, 5), (7, 4), (9, 3)]:
+        pos = before[row] * 0.5 + torch.stack([l[last], ab[last]]).detach() * 0.5
+        assert_close(fused.memory[row], pos / pos.norm(dim=1, keepdim=True))
+
+
+@pytest.mark.parametrize('fused_memory', [False, True])
+@pytest.mark.parametrize('use_softmax', [True, False])
+def test_shared_matches_per_sample(fused_memory, use_softmax):
+    torch.manual_seed(0)
+    per_sample = NCEAverage(D, n, K, use_softmax=use_softmax, fused_memory=fused_memory)
+    shared = copy.deepcopy(per_sample)
+    shared.shared_negatives = True
+    # run() seeds every step, UniformSampler draws the K shared negatives as one randint
+    idx = draws()
+    for step in range(3):
+        torch.manual_seed(step)
+        idx[step][:, 1:] = torch.randint(n, (K,)).view(1, K)
+    assert_runs_close(run(shared), run(per_sample, idx=idx))
+    for view in range(2):
+        assert_close(shared.memory_rows(view), per_sample.memory_rows(view))
+
+
+def test_shared_observed_samples():
+    torch.manual_seed(0)
+    sampler = HardNegativeSampler(n, rebuild_every=100)
+    contrast = NCEAverage(D, n, K, use_softmax=True, sampler=sampler, shared_negatives=True)
+    l, ab = features(0)
+    contrast(l, ab, torch.arange(B))
+    assert sampler._count.sum() == B * K
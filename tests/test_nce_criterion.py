@@ -0,0 +1,73 @@
+import pytest
+import torch
+
+from NCE.NCECriterion import NCECriterion, NCELoss, NCESoftmaxLoss, InfoNCELoss
+
+bench = pytest.importorskip('bench_nce_criterion')
+
+
+@pytest.mark.parametrize('bsz, K', [(256, 16384), (64, 4096), (1, 10)])
+def test_loss_matches_float64_reference(bsz, K):
+    torch.manual_seed(0)
+    x = bench.make_input(bsz, K, 50000, 'cpu')
+    reference = bench.ReferenceNCECriterion(50000)
+    x64 = x.double().requires_grad_()
+    loss64 = reference(x64)
+    loss64.backward()
+    x = x.requires_grad_()
+    loss = NCECriterion(50000)(x)
+    loss.backward()
+    assert loss.dtype == torch.float32 and loss.shape == loss64.shape
+    # the previous implementation was 1e-3 off at bsz 256, K 16384
+    assert abs(loss.item() - loss64.item()) < 1e-6
+    torch.testing.assert_close(x.grad.double(), x64.grad, rtol=1e-5, atol=1e-6 * x64.grad.abs().max().item())
+
+
+def test_chunks():
+    torch.manual_seed(0)
+    x = bench.make_input(37, 100, 1000, 'cpu')
+    losses = [NCECriterion(1000, chunk_size=c)(x).item() for c in [1, 5, 37, 100]]
+    assert max(losses) - min(losses) < 1e-6
+
+
+def test_gradcheck():
+    torch.manual_seed(0)
+    x = bench.make_input(4, 6, 100, 'cpu').double().requires_grad_()
+    assert torch.autograd.gradcheck(lambda t: NCELoss.apply(t, 100, 3), (x,))
+
+
+def cross_entropy(x):
+    """the previous NCESoftmaxLoss: squeeze, label 0, CrossEntropyLoss"""
+    x = x.squeeze()
+    return torch.nn.CrossEntropyLoss()(x, torch.zeros([x.size(0)]).long())
+
+
+@pytest.mark.parametrize('chunk_size', [None, 1, 7, 4097])
+@pytest.mark.parametrize('shape', [(64, 4097, 1), (64, 4097), (1, 4097)])
+def test_info_nce_matches_cross_entropy(chunk_size, shape):
+    torch.manual_seed(0)
+    x = (torch.randn(*shape) / 0.07).requires_grad_()
+    data = x.detach().clone()
+    loss = NCESoftmaxLoss(chunk_size)(x)
+    loss.backward()
+    x_ce = x.detach().clone().view(-1, shape[1]).requires_grad_()
+    # a batch of one used to be squeezed into a single row of classes
+    ref = cross_entropy(x_ce) if shape[0] > 1 else torch.nn.CrossEntropyLoss()(x_ce, torch.zeros(1).long())
+    ref.backward()
+    assert torch.equal(x.detach(), data)
+    assert abs(loss.item() - ref.item()) < 1e-5
+    torch.testing.assert_close(x.grad.view(-1, shape[1]), x_ce.grad, rtol=1e-5, atol=1e-5)
+
+
+def test_info_nce_half():
+    torch.manual_seed(0)
+    x = torch.randn(16, 1025) / 0.07
+    loss = NCESoftmaxLoss(chunk_size=100)(x.half().requires_grad_())
+    assert loss.dtype == torch.float16
+    assert abs(loss.item() - cross_entropy(x).item()) < 1e-2
+
+
+def test_info_nce_gradcheck():
+    torch.manual_seed(0)
+    x = torch.randn(4, 9, dtype=torch.float64, requires_grad=True)
+    assert torch.autograd.gradcheck(lambda t: InfoNCELoss.apply(t, 4), (x,))
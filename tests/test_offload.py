@@ -0,0 +1,110 @@
+import os
+
+import pytest
+import torch
+
+from NCE.NCEAverage import NCEAverage
+from NCE.offload import OffloadNCEAverage
+from NCE.sampler import UniformSampler
+
+n, D, K, B = 30, 16, 20, 6
+
+
+class RecordingSampler(UniformSampler):
+    """uniform draws, kept to replay them on another module"""
+    def __init__(self, n):
+        super(RecordingSampler, self).__init__(n)
+        self.draws = []
+
+    def draw(self, N):
+        idx = super(RecordingSampler, self).draw(N)
+        self.draws.append(idx.clone())
+        return idx
+
+
+def batch(step, batchSize=B):
+    g = torch.Generator().manual_seed(step)
+    l, ab = [torch.nn.functional.normalize(torch.randn(batchSize, D, generator=g), dim=1).requires_grad_()
+             for _ in range(2)]
+    return l, ab, torch.randperm(n, generator=g)[:batchSize]
+
+
+def step(contrast, l, ab, y, idx=None):
+    out = contrast(l, ab, y, idx)
+    sum(o.pow(2).sum() for o in out).backward()
+    return [o.detach() for o in out] + [l.grad, ab.grad]
+
+
+def assert_close(a, b):
+    torch.testing.assert_close(a, b, rtol=1e-5, atol=1e-6 * max(1., b.abs().max().item()))
+
+
+def pair(use_softmax, storage='float32', **kwargs):
+    torch.manual_seed(0)
+    reference = NCEAverage(D, n, K, use_softmax=use_softmax, storage=storage)
+    offload = OffloadNCEAverage(D, n, K, use_softmax=use_softmax, storage=storage, **kwargs)
+    offload.load_state_dict(reference.state_dict())
+    return reference, offload
+
+
+def assert_same_memories(reference, offload):
+    offload.synchronize()
+    for name in ['memory_l', 'memory_ab']:
+        assert_close(offload.host_memory[name].float(), getattr(reference, name).float())
+
+
+@pytest.mark.parametrize('use_softmax', [True, False])
+@pytest.mark.parametrize('storage', ['float32', 'float16'])
+def test_explicit_samples(use_softmax, storage):
+    reference, offload = pair(use_softmax, storage)
+    for i in range(3):
+        idx = torch.randint(n, (B, K + 1))
+        l, ab, y = batch(i)
+        idx[:, 0] = y
+        for a, b in zip(step(offload, l, ab, y, idx), step(reference, *batch(i), idx=idx)):
+            assert_close(a, b)
+    assert_same_memories(reference, offload)
+
+
+@pytest.mark.parametrize('use_softmax', [True, False])
+def test_prefetched_samples(use_softmax):
+    # the negatives of a step are drawn and gathered during the previous one, after its write-back
+    reference, offload = pair(use_softmax, sampler=RecordingSampler(n))
+    sizes = [B, B, B, 4, 4]
+    for i, batchSize in enumerate(sizes):
+        l, ab, y = batch(i, batchSize)
+        out = step(offload, l, ab, y)
+        # the update has drawn the negatives of the next step
+        idx = torch.cat([y.view(-1, 1), offload.sampler.draws[-2].view(batchSize, K)], 1)
+        for a, b in zip(out, step(reference, *batch(i, batchSize), idx=idx)):
+            assert_close(a, b)
+    assert_same_memories(reference, offload)
+
+
+def test_memory_file(tmpdir):
+    reference, offload = pair(True, 'float16', path=str(tmpdir))
+    assert os.path.isfile(str(tmpdir.join('memory_l.npy')))
+    for i in range(2):
+        idx = torch.randint(n, (B, K + 1))
+        l, ab, y = batch(i)
+        idx[:, 0] = y
+        step(offload, l, ab, y, idx)
+        step(reference, *batch(i), idx=idx)
+    offload.synchronize()
+    # a new module maps the same file
+    reopened = OffloadNCEAverage(D, n, K, use_softmax=True, storage='float16', path=str(tmpdir))
+    assert_same_memories(reference, reopened)
+    state = reopened.state_dict()
+    assert state['memory_l'].dtype == torch.float16
+    # and checkpoints of another storage load into it
+    other = NCEAverage(D, n, K, storage='int8')
+    reopened.load_state_dict(other.state_dict())
+    torch.testing.assert_close(reopened.host_memory['memory_ab'].float(), other.memory_ab.float() * other.memory_ab_scale,
+                               rtol=2 ** -11, atol=1e-7)
+
+
+def test_rejected_storage(tmpdir):
+    with pytest.raises(NotImplementedError):
+        OffloadNCEAverage(D, n, K, storage='int8')
+    with pytest.raises(NotImplementedError):
+        OffloadNCEAverage(D, n, K, storage='bfloat16', path=str(tmpdir))
@@ -0,0 +1,80 @@
+import math
+
+import pytest
+import torch
+
+from NCE.NCEAverage import NCEAverage, MemoryInsDis
+from NCE.sampler import UniformSampler, WeightedSampler, HardNegativeSampler, get_sampler
+
+
+def frequencies(sampler, n, draws=200000):
+    return torch.bincount(sampler.draw(draws), minlength=n).double() / draws
+
+
+def close_to(freq, target, draws=200000):
+    """within a few standard deviations of the binomial counts"""
+    target = target / target.sum()
+    return ((freq - target).abs() <= 5 * (target * (1 - target) / draws).sqrt() + 1e-12).all()
+
+
+def test_uniform_sampler():
+    torch.manual_seed(0)
+    sampler = UniformSampler(37)
+    first, second = sampler.draw(1000), sampler.draw(1000)
+    assert first.data_ptr() != second.data_ptr() and not torch.equal(first, second)
+    assert close_to(frequencies(sampler, 37), torch.ones(37, dtype=torch.float64))
+    assert isinstance(get_sampler('uniform', 37), UniformSampler)
+    with pytest.raises(NotImplementedError):
+        get_sampler('weighted', 37)
+
+
+def test_weighted_sampler():
+    torch.manual_seed(0)
+    # 100 outcomes in blocks of 16: the last block is padded and must never be drawn from
+    weights = torch.rand(100, dtype=torch.float64)
+    weights[::7] = 0
+    sampler = WeightedSampler(weights, block_size=16, rebuild_every=2)
+    freq = frequencies(sampler, 100)
+    assert freq.size(0) == 100 and (freq[::7] == 0).all()
+    assert close_to(freq, weights)
+    # updates are folded in at the next rebuild, every rebuild_every draws
+    weights[:10] = 20
+    sampler.update(torch.arange(10), weights[:10])
+    sampler.draw(1)
+    assert close_to(frequencies(sampler, 100), weights)
+
+
+def test_hard_negative_sampler():
+    torch.manual_seed(0)
+    sampler = HardNegativeSampler(50, temperature=0.5, momentum=0.5, block_size=8, rebuild_every=1)
+    assert close_to(frequencies(sampler, 50), torch.ones(50, dtype=torch.float64))
+    # column 0 holds the positives, they do not count
+    idx = torch.tensor([[0, 1, 2], [3, 1, 4]])
+    scores = torch.tensor([[9., 0.4, 0.2], [9., 0.8, -0.6]])
+    sampler.observe(idx, scores)
+    sampler.draw(1)
+    hardness = torch.zeros(50)
+    hardness[[1, 2, 4]] = 0.5 * torch.tensor([0.6, 0.2, -0.6])
+    assert torch.allclose(sampler.hardness, hardness)
+    assert close_to(frequencies(sampler, 50), torch.exp(hardness.double() / 0.5))
+    assert isinstance(get_sampler('hard', 50, temperature=0.5), HardNegativeSampler)
+
+
+@pytest.mark.parametrize('module', ['NCEAverage', 'MemoryInsDis'])
+def test_contrast_observes_samples(module):
+    torch.manual_seed(0)
+    B, D, n, K = 4, 8, 40, 6
+    sampler = HardNegativeSampler(n, rebuild_every=100)
+    x = torch.nn.functional.normalize(torch.randn(B, D), dim=1)
+    y = torch.arange(B)
+    if module == 'NCEAverage':
+        contrast = NCEAverage(D, n, K, use_softmax=True, sampler=sampler)
+        out = contrast(x, x, y)
+        # the mean similarity of both views
+        out = (out[0] + out[1]).squeeze(2) / 2
+    else:
+        contrast = MemoryInsDis(D, n, K, use_softmax=True, sampler=sampler)
+        out = contrast(x, y)
+    # every negative of the step was observed once, with its similarity
+    assert sampler._count.sum() == B * K
+    assert math.isclose(sampler._sum.sum().item() / 0.07, out[:, 1:].sum().item(), rel_tol=1e-4, abs_tol=1e-4)
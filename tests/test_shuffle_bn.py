@@ -0,0 +1,58 @@
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch import nn
+
+from shuffle_bn import ShuffleBN
+
+gloo = pytest.mark.skipif(not dist.is_available() or not dist.is_gloo_available(),
+                          reason='torch.distributed with gloo is not available')
+
+
+def test_shuffle():
+    x = torch.randn(8, 5)
+    shuffle_bn = ShuffleBN('shuffle', seed=0)
+    seen = []
+    for _ in range(3):
+        out = shuffle_bn(lambda t: seen.append(t) or t * 2, x)
+        assert torch.equal(out, x * 2)
+    # the encoder sees a fresh permutation of the batch every step
+    assert not torch.equal(seen[-1], x) and not torch.equal(seen[0], seen[1])
+    assert torch.equal(seen[0].sort(0)[0], x.sort(0)[0])
+    assert torch.equal(ShuffleBN('none')(lambda t: t * 2, x), x * 2)
+    assert torch.equal(ShuffleBN('none').shuffle(x), x)
+    with pytest.raises(NotImplementedError):
+        ShuffleBN('random')
+
+
+def test_syncbn_convert():
+    converted = ShuffleBN('syncbn').convert(nn.Sequential(nn.Linear(5, 5), nn.BatchNorm1d(5)))
+    assert isinstance(converted[1], nn.SyncBatchNorm)
+    model = nn.Sequential(nn.Linear(5, 5), nn.BatchNorm1d(5))
+    assert ShuffleBN('shuffle').convert(model) is model
+
+
+def round_trip(rank, world_size, init_method):
+    """ShuffleBN on `world_size` gloo processes: keys come back in order, BN sees every rank"""
+    dist.init_process_group('gloo', init_method=init_method, rank=rank, world_size=world_size)
+    B, D = 6, 5
+    torch.manual_seed(rank)
+    x = torch.randn(B, D)
+    shuffle_bn = ShuffleBN('distributed', seed=0)
+    for _ in range(3):
+        assert torch.equal(shuffle_bn(lambda t: t * 2, x), x * 2)
+    # a distributed batch holds B / world_size samples of every rank
+    origin = torch.full((B, 1), float(rank))
+    assert torch.equal(shuffle_bn(lambda t: t, origin), origin)
+    seen = shuffle_bn.shuffle(origin)
+    shuffle_bn.unshuffle(seen)
+    assert torch.equal(seen.view(-1).sort()[0], torch.arange(world_size).repeat_interleave(B // world_size).float())
+    with pytest.raises(ValueError):
+        shuffle_bn.shuffle(torch.randn(B + 1, D))
+    dist.destroy_process_group()
+
+
+@gloo
+def test_distributed(tmpdir):
+    mp.spawn(round_trip, args=(3, 'file://' + str(tmpdir.join('init'))), nprocs=3)
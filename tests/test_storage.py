@@ -0,0 +1,69 @@
+import pytest
+import torch
+
+from NCE.NCEAverage import NCEAverage, MemoryInsDis, MemoryMoCo
+from NCE.storage import STORAGE, quantize, register_memory, read_memory, write_memory
+
+
+def rows(n=64, D=32, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    return torch.nn.functional.normalize(torch.randn(n, D, generator=g), dim=1)
+
+
+@pytest.mark.parametrize('storage', list(STORAGE))
+def test_read_write(storage):
+    module = torch.nn.Module()
+    memory = rows()
+    register_memory(module, 'memory', memory, storage)
+    assert module.memory.dtype == STORAGE[storage]
+    # int8 rounds to 1/254 of the row range, fp16 / bf16 to their relative precision
+    tol = {'float32': 0, 'float16': 2 ** -11, 'bfloat16': 2 ** -8, 'int8': 1 / 254.}[storage]
+    bound = memory.abs().max(1, keepdim=True)[0] * tol + 1e-7
+    assert ((read_memory(module, 'memory') - memory).abs() <= bound).all()
+    idx = torch.tensor([5, 1, 60])
+    new = rows(3, seed=1)
+    write_memory(module, 'memory', idx, new)
+    out = read_memory(module, 'memory', idx)
+    assert out.dtype == torch.float32
+    assert ((out - new).abs() <= new.abs().max(1, keepdim=True)[0] * tol + 1e-7).all()
+    codes, scale = quantize(memory)
+    assert codes.dtype == torch.int8 and codes.abs().max() <= 127 and scale.shape == (64, 1)
+
+
+@pytest.mark.parametrize('storage, tol', [('float16', 1.5e-3), ('bfloat16', 1.5e-2), ('int8', 3e-2)])
+def test_logit_error(storage, tol):
+    # about 1e-3 for fp16 and 2e-2 for int8 after / T, on the initial bank of CMC's feature size
+    torch.manual_seed(0)
+    n, D, K, B = 1000, 128, 4096, 64
+    reference = NCEAverage(D, n, K, use_softmax=True)
+    contrast = NCEAverage(D, n, K, use_softmax=True, storage=storage)
+    contrast.load_state_dict(reference.state_dict())
+    l, ab = rows(B, D, 3), rows(B, D, 4)
+    idx = torch.randint(n, (B, K + 1))
+    for a, b in zip(reference.score(l, ab, idx[:, 0], idx), contrast.score(l, ab, idx[:, 0], idx)):
+        assert (a - b).abs().max() / reference.T < tol
+
+
+def modules(storage):
+    torch.manual_seed(0)
+    return [NCEAverage(16, 40, 8, storage=storage), NCEAverage(16, 40, 8, storage=storage, fused_memory=True),
+            MemoryInsDis(16, 40, 8, storage=storage), MemoryMoCo(16, 40, 8, storage=storage)]
+
+
+@pytest.mark.parametrize('source', list(STORAGE))
+@pytest.mark.parametrize('target', list(STORAGE))
+def test_load_other_storage(source, target):
+    for saved, loaded in zip(modules(source), modules(target)):
+        loaded.load_state_dict(saved.state_dict())
+        for name in ['memory'] if hasattr(saved, 'memory') else ['memory_l', 'memory_ab']:
+            a, b = read_memory(saved, name), read_memory(loaded, name)
+            tol = {'float32': 0, 'float16': 2 ** -11, 'bfloat16': 2 ** -8, 'int8': 1 / 254.}
+            bound = a.abs().max(-1, keepdim=True)[0] * max(tol[source], tol[target]) * 2 + 1e-7
+            assert ((a - b).abs() <= bound).all()
+
+
+def test_checkpoint_size():
+    size = lambda m: sum(t.numel() * t.element_size() for t in m.state_dict().values())
+    full = size(NCEAverage(128, 1000, 8))
+    assert size(NCEAverage(128, 1000, 8, storage='float16')) < full / 1.9
+    assert size(NCEAverage(128, 1000, 8, storage='int8')) < full / 3.5
@@ -0,0 +1,134 @@
+import copy
+
+import pytest
+import torch
+from torch import nn
+
+from util import ModelEMA, KNNMonitor
+
+
+def moment_update(model, model_ema, m):
+    """the per-parameter loop ModelEMA replaces"""
+    for p1, p2 in zip(model.parameters(), model_ema.parameters()):
+        p2.data.mul_(m).add_(p1.detach().data, alpha=1 - m)
+
+
+def model():
+    torch.manual_seed(0)
+    return nn.Sequential(nn.Linear(8, 16), nn.BatchNorm1d(16), nn.ReLU(), nn.Linear(16, 4))
+
+
+def train_step(net, step):
+    """move the parameters and the BN statistics"""
+    net.train()
+    device = next(net.parameters()).device
+    net(torch.randn(32, 8, generator=torch.Generator().manual_seed(step)).to(device))
+    with torch.no_grad():
+        for p in net.parameters():
+            p.add_(torch.randn(p.shape, generator=torch.Generator().manual_seed(step)).to(device))
+
+
+def assert_same(a, b):
+    for (name, x), y in zip(a.state_dict().items(), b.state_dict().values()):
+        torch.testing.assert_close(x, y, rtol=1e-6, atol=1e-6, msg=name)
+
+
+@pytest.mark.parametrize('foreach', [True, False])
+def test_matches_moment_update(foreach, monkeypatch):
+    if not foreach:
+        monkeypatch.delattr(torch, '_foreach_mul_')
+    net = model()
+    ema = ModelEMA(net, momentum=0.9)
+    reference = copy.deepcopy(ema.model_ema)
+    for step in range(5):
+        train_step(net, step)
+        ema.update()
+        moment_update(net, reference, 0.9)
+        assert_same(ema.model_ema, reference)
+    ema.update(momentum=0.5)
+    moment_update(net, reference, 0.5)
+    assert_same(ema.model_ema, reference)
+
+
+def test_every_and_buffers():
+    net = model()
+    ema = ModelEMA(net, momentum=0.9, buffers=True, every=3)
+    reference = copy.deepcopy(ema.model_ema)
+    for step in range(1, 8):
+        train_step(net, step)
+        ema.update()
+        if step % 3 == 0:
+            moment_update(net, reference, 0.9 ** 3)
+            bn, bn_ref = net[1], reference[1]
+            bn_ref.running_mean.mul_(0.9 ** 3).add_(bn.running_mean, alpha=1 - 0.9 ** 3)
+            bn_ref.running_var.mul_(0.9 ** 3).add_(bn.running_var, alpha=1 - 0.9 ** 3)
+            # integer buffers are copied
+            bn_ref.num_batches_tracked.copy_(bn.num_batches_tracked)
+        assert_same(ema.model_ema, reference)
+
+
+def test_state_dict():
+    net = model()
+    ema = ModelEMA(net, every=3)
+    for step in range(4):
+        ema.update()
+    resumed = ModelEMA(net, every=3)
+    resumed.load_state_dict(ema.state_dict())
+    assert resumed.steps == 4
+    # both update on the same steps
+    before = copy.deepcopy(resumed.model_ema)
+    train_step(net, 0)
+    resumed.update()
+    assert_same(resumed.model_ema, before)
+    resumed.update()
+    with pytest.raises(AssertionError):
+        assert_same(resumed.model_ema, before)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='needs a second device')
+def test_copy_on_another_device():
+    net = model().cuda()
+    ema = ModelEMA(net, momentum=0.9, device='cpu')
+    reference = copy.deepcopy(net).cpu()
+    for step in range(3):
+        train_step(net, step)
+        ema.update()
+        moment_update(copy.deepcopy(net).cpu(), reference, 0.9)
+        assert_same(ema.model_ema, reference)
+
+
+def knn_contrast(n=50, D=8):
+    from NCE.NCEAverage import NCEAverage
+    torch.manual_seed(0)
+    return NCEAverage(D, n, 4)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 50, 1000])
+@pytest.mark.parametrize('view', KNNMonitor.views)
+def test_knn_topk_matches_full(chunk_size, view):
+    contrast = knn_contrast()
+    labels = torch.randint(3, (50,))
+    monitor = KNNMonitor(contrast, labels, k=10, T=0.1, chunk_size=chunk_size)
+    feat_l, feat_ab = torch.randn(6, 8), torch.randn(6, 8)
+    sim = {'l': [(feat_l, contrast.memory_l)], 'ab': [(feat_ab, contrast.memory_ab)],
+           'l_ab': [(feat_l, contrast.memory_l), (feat_ab, contrast.memory_ab)]}[view]
+    sim = sum(nn.functional.normalize(f, dim=1).mm(m.t()) for f, m in sim)
+    top_sim, top_idx = sim.topk(10, dim=1)
+    out_sim, out_idx = monitor.topk(feat_l, feat_ab, view)
+    torch.testing.assert_close(out_sim, top_sim)
+    assert torch.equal(out_idx, top_idx)
+    # neighbours vote for their label with weight exp(sim / T)
+    votes = torch.zeros(6, 3).scatter_add_(1, labels[top_idx], top_sim.div(0.1).exp())
+    assert torch.equal(monitor.predict(feat_l, feat_ab, view), votes.argmax(1))
+
+
+def test_knn_evaluate():
+    contrast = knn_contrast()
+    labels = torch.arange(50) % 5
+    monitor = KNNMonitor(contrast, labels, k=1, chunk_size=16)
+    # unit rows, as the momentum update leaves them, are their own nearest neighbours
+    for memory in [contrast.memory_l, contrast.memory_ab]:
+        memory.copy_(nn.functional.normalize(memory, dim=1))
+    loader = [(torch.arange(20), labels[:20]), (torch.arange(20, 50), labels[20:])]
+    embed = lambda i: (contrast.memory_l[i], contrast.memory_ab[i])
+    assert monitor.evaluate(embed, loader) == {'l': 100., 'ab': 100., 'l_ab': 100.}
@@ -15,17 +15,19 @@ import tensorboard_logger as tb_logger
 
 from torchvision import transforms, datasets
 from dataset import RGB, RGB2Lab, RGB2YCbCr
-from util import adjust_learning_rate, AverageMeter
+from util import adjust_learning_rate, AverageMeter, KNNMonitor
 
 from models.alexnet import MyAlexNetCMC
 from models.alexnet import MyAlexNetCMC_c
 from models.alexnet import MyAlexNetCMC_cc
 from models.resnet import MyResNetsCMC
 from NCE.NCEAverage import NCEAverage
+from NCE.sampler import get_sampler
+from NCE.offload import OffloadNCEAverage
 from NCE.NCECriterion import NCECriterion
 from NCE.NCECriterion import NCESoftmaxLoss
 
-from dataset import ImageFolderInstance
+from dataset import ImageFolderInstance, CIFAR10Instance
 #####
 import numpy as np
 from Resizer import resizer
@@ -76,11 +78,25 @@ def parse_option():
 	parser.add_argument('--nce_k', type=int, default=16384)
 	parser.add_argument('--nce_t', type=float, default=0.07)
 	parser.add_argument('--nce_m', type=float, default=0.5)
+	parser.add_argument('--nce_sampler', type=str, default='uniform', choices=['uniform', 'hard'], help='noise distribution of the negatives, hard needs --softmax')
+	parser.add_argument('--nce_storage', type=str, default='float32', choices=['float32', 'float16', 'bfloat16', 'int8'], help='dtype of the memory bank')
+	parser.add_argument('--memory_offload', action='store_true', help='keep the memory bank in host memory (float32, float16 or bfloat16 storage)')
+	parser.add_argument('--memory_path', type=str, default=None, help='folder of the mmap memory bank with --memory_offload')
+	parser.add_argument('--nce_chunk', type=int, default=0, help='score the negatives in tiles of this size, 0 to gather all at once')
+	parser.add_argument('--sync_free', action='store_true', help='keep Z on the device, calibrated on the first batch')
+	parser.add_argument('--nce_fused', action='store_true', help='keep both views in one memory, gathered and updated together')
+	parser.add_argument('--nce_shared', action='store_true', help='draw one set of nce_k negatives per batch instead of per sample')
 	parser.add_argument('--feat_dim', type=int, default=128, help='dim of feat for inner product')
 
 	# dataset
 	parser.add_argument('--dataset', type=str, default='imagenet', choices=['imagenet100', 'imagenet'])
 
+	# online kNN monitor on the memory bank
+	parser.add_argument('--knn_freq', type=int, default=0, help='kNN accuracy every knn_freq epochs, 0 to disable')
+	parser.add_argument('--knn_k', type=int, default=200, help='neighbours of the kNN monitor')
+	parser.add_argument('--knn_corruptions', type=str, default='', help='corrupted val splits of the kNN monitor, comma separated')
+	parser.add_argument('--knn_level', type=int, default=5, help='level of the corrupted val splits')
+
 	# specify folder
 	parser.add_argument('--data_folder', type=str, default=None, help='path to data')
 	parser.add_argument('--model_path', type=str, default=None, help='path to save model')
@@ -99,6 +115,16 @@ def parse_option():
 	parser.add_argument('--crop_low', type=float, default=0.2, help='low area in crop')
 
 	opt = parser.parse_args()
+	if opt.nce_sampler != 'uniform' and not opt.softmax:
+		# NCECriterion assumes the noise distribution Pn = 1 / n_data
+		parser.error('--nce_sampler {} needs --softmax'.format(opt.nce_sampler))
+	if opt.memory_offload:
+		# the host tables are float32 / float16 / bfloat16, one per view
+		if opt.nce_storage == 'int8' or (opt.nce_storage == 'bfloat16' and opt.memory_path is not None):
+			parser.error('--nce_storage {} is not supported with --memory_offload{}'.format(
+				opt.nce_storage, ' --memory_path' if opt.memory_path is not None else ''))
+		if opt.nce_fused or opt.nce_shared:
+			parser.error('--nce_fused and --nce_shared are not supported with --memory_offload')
 	if (opt.data_folder is None) or (opt.model_path is None) or (opt.tb_path is None):
 		raise ValueError('one or more of the folders is None: data_folder | model_path | tb_path')
 
@@ -111,6 +137,8 @@ def parse_option():
 	for it in iterations:
 		opt.lr_decay_epochs.append(int(it))
 
+	opt.knn_corruptions = [c for c in opt.knn_corruptions.split(',') if c]
+
 	opt.method = 'softmax' if opt.softmax else 'nce'
 	opt.model_name = 'memory_{}_{}_{}_lr_{}_decay_{}_bsz_{}'.format(opt.method, opt.nce_k, opt.model, opt.learning_rate,
 																	opt.weight_decay, opt.batch_size)
@@ -167,7 +195,7 @@ def get_train_loader(args):
 			# normalize
 		])
 	
-	train_dataset = datasets.CIFAR10(root=args.data_folder,
+	train_dataset = CIFAR10Instance(root=args.data_folder,
 		train=True, download=True, transform=train_transform)
 	train_sampler = None
 
@@ -186,6 +214,33 @@ def get_train_loader(args):
 
 	return train_loader, n_data
 
+def get_knn_loaders(args):
+	"""get the (name, loader) of the clean and corrupted val splits of the kNN monitor"""
+	if args.view == 'Lab' or args.view == 'YCbCr':
+		if args.view == 'Lab':
+			mean = [(0 + 100) / 2, (-86.183 + 98.233) / 2, (-107.857 + 94.478) / 2]
+			std = [(100 - 0) / 2, (86.183 + 98.233) / 2, (107.857 + 94.478) / 2]
+			color_transfer = RGB2Lab()
+		else:
+			mean = [116.151, 121.080, 132.342]
+			std = [109.500, 111.855, 111.964]
+			color_transfer = RGB2YCbCr()
+		val_transform = transforms.Compose([
+			color_transfer,
+			transforms.ToTensor(),
+			transforms.Normalize(mean=mean, std=std),
+		])
+	else:
+		val_transform = transforms.ToTensor()
+	knn_sets = [('clean', datasets.CIFAR10(root=args.data_folder, train=False, download=True, transform=val_transform))]
+	for corruption in args.knn_corruptions:
+		val_dataset = datasets.CIFAR10(root=args.data_folder, train=False, download=True, transform=val_transform)
+		val_dataset.data = np.load(args.data_folder + '/CIFAR-10-C-trainval/val/%s_%s_images.npy' %(corruption, args.knn_level - 1))
+		knn_sets.append((corruption, val_dataset))
+
+	return [(name, torch.utils.data.DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False,
+		num_workers=args.num_workers, pin_memory=True)) for name, val_dataset in knn_sets]
+
 def set_model(args, n_data):
 	# set the model
 	if args.model == 'alexnet':
@@ -195,7 +250,14 @@ def set_model(args, n_data):
 	else:
 		raise ValueError('model not supported yet {}'.format(args.model))
 
-	contrast = NCEAverage(args.feat_dim, n_data, args.nce_k, args.nce_t, args.nce_m, args.softmax)
+	if args.memory_offload:
+		contrast = OffloadNCEAverage(args.feat_dim, n_data, args.nce_k, args.nce_t, args.nce_m, args.softmax,
+			sampler=get_sampler(args.nce_sampler, n_data), chunk_size=args.nce_chunk, storage=args.nce_storage,
+			sync_free=args.sync_free, path=args.memory_path)
+	else:
+		contrast = NCEAverage(args.feat_dim, n_data, args.nce_k, args.nce_t, args.nce_m, args.softmax,
+			sampler=get_sampler(args.nce_sampler, n_data), chunk_size=args.nce_chunk, storage=args.nce_storage,
+			sync_free=args.sync_free, fused_memory=args.nce_fused, shared_negatives=args.nce_shared)
 	criterion_l = NCESoftmaxLoss() if args.softmax else NCECriterion(n_data)
 	criterion_ab = NCESoftmaxLoss() if args.softmax else NCECriterion(n_data)
 
@@ -232,8 +294,7 @@ def train(epoch, train_loader, model, contrast, criterion_l, criterion_ab, optim
 	ab_prob_meter = AverageMeter()
 
 	end = time.time()
-	# for idx, (inputs, _, index) in enumerate(train_loader): # temp
-	for idx, (inputs, index) in enumerate(train_loader):
+	for idx, (inputs, _, index) in enumerate(train_loader):
 		data_time.update(time.time() - end)
 
 		bsz = inputs.size(0)
@@ -245,6 +306,9 @@ def train(epoch, train_loader, model, contrast, criterion_l, criterion_ab, optim
 
 		# ===================forward=====================
 		feat_l, feat_ab = model(inputs) # 128, 128
+		if opt.calibrate:
+			contrast.calibrate(feat_l, feat_ab, index)
+			opt.calibrate = False
 		out_l, out_ab = contrast(feat_l, feat_ab, index) # 128, 16385, 1
 		l_loss = criterion_l(out_l)
 		ab_loss = criterion_ab(out_ab)
@@ -289,6 +353,19 @@ def train(epoch, train_loader, model, contrast, criterion_l, criterion_ab, optim
 
 	return l_loss_meter.avg, l_prob_meter.avg, ab_loss_meter.avg, ab_prob_meter.avg
 
+def knn(epoch, model, monitor, knn_loaders, logger, opt):
+	"""
+	kNN accuracy of the val splits against the memory bank
+	"""
+	model.eval()
+	for name, loader in knn_loaders:
+		acc = monitor.evaluate(lambda inputs: model(inputs.float().cuda() if torch.cuda.is_available() else inputs.float()), loader)
+		for view, val in acc.items():
+			logger.log_value('knn_{}_{}'.format(name, view), val, epoch)
+		print('kNN {}: '.format(name) + ', '.join('{} {:.2f}'.format(view, val) for view, val in acc.items()))
+		sys.stdout.flush()
+	model.train()
+
 def main():
 
 	# parse the args
@@ -327,9 +404,17 @@ def main():
 		else:
 			print("=> no checkpoint found at '{}'".format(args.resume))
 
+	# Z is calibrated once before training instead of being checked every step
+	args.calibrate = args.sync_free and not args.softmax and contrast.params[2].item() < 0
+
 	# tensorboard
 	logger = tb_logger.Logger(logdir=args.tb_folder, flush_secs=2)
 
+	# kNN monitor, memory row i holds the embedding of training image i
+	if args.knn_freq > 0:
+		knn_loaders = get_knn_loaders(args)
+		monitor = KNNMonitor(contrast, train_loader.dataset.targets, k=args.knn_k, T=args.nce_t)
+
 	# routine
 	for epoch in range(args.start_epoch, args.epochs + 1):
 
@@ -348,6 +433,10 @@ def main():
 		logger.log_value('ab_loss', ab_loss, epoch)
 		logger.log_value('ab_prob', ab_prob, epoch)
 
+		if args.knn_freq > 0 and epoch % args.knn_freq == 0:
+			print("==> kNN monitor...")
+			knn(epoch, model, monitor, knn_loaders, logger, args)
+
 		# save model
 		if epoch % args.save_freq == 0:
 			print('==> Saving...')
@@ -18,15 +18,17 @@ import socket
 import tensorboard_logger as tb_logger
 
 from torchvision import transforms, datasets
-from util import adjust_learning_rate, AverageMeter
+from util import adjust_learning_rate, AverageMeter, ModelEMA
 
 from models.resnet import InsResNet50
 from NCE.NCEAverage import MemoryInsDis
 from NCE.NCEAverage import MemoryMoCo
+from NCE.sampler import get_sampler
 from NCE.NCECriterion import NCECriterion
 from NCE.NCECriterion import NCESoftmaxLoss
 
 from dataset import ImageFolderInstance
+from shuffle_bn import ShuffleBN
 
 try:
     from apex import amp, optimizers
@@ -85,15 +87,27 @@ def parse_option():
     parser.add_argument('--nce_k', type=int, default=16384)
     parser.add_argument('--nce_t', type=float, default=0.07)
     parser.add_argument('--nce_m', type=float, default=0.5)
+    parser.add_argument('--nce_sampler', type=str, default='uniform', choices=['uniform', 'hard'], help='noise distribution of the negatives of InsDis, hard needs --softmax')
+    parser.add_argument('--nce_storage', type=str, default='float32', choices=['float32', 'float16', 'bfloat16', 'int8'], help='dtype of the memory bank')
+    parser.add_argument('--sync_free', action='store_true', help='keep Z on the device, calibrated on the first batch')
 
     # memory setting
     parser.add_argument('--moco', action='store_true', help='using MoCo (otherwise Instance Discrimination)')
     parser.add_argument('--alpha', type=float, default=0.999, help='exponential moving average weight')
+    parser.add_argument('--ema_buffers', action='store_true', help='also average the BN statistics of the key encoder')
+    parser.add_argument('--ema_every', type=int, default=1, help='momentum update every n steps with alpha ** n')
+    # the distributed and syncbn modes of ShuffleBN need a process group, which this script does not launch
+    parser.add_argument('--shuffle_bn', type=str, default='shuffle', choices=['shuffle', 'none'],
+                        help='BN of the key encoder')
+    parser.add_argument('--shuffle_seed', type=int, default=0, help='seed of the ShuffleBN permutations')
 
     # GPU setting
     parser.add_argument('--gpu', default=None, type=int, help='GPU id to use.')
 
     opt = parser.parse_args()
+    if opt.nce_sampler != 'uniform' and not opt.softmax and not opt.moco:
+        # NCECriterion assumes the noise distribution Pn = 1 / n_data
+        parser.error('--nce_sampler {} needs --softmax'.format(opt.nce_sampler))
 
     # set the path according to the environment
     if hostname.startswith('visiongpu'):
@@ -137,21 +151,6 @@ def parse_option():
     return opt
 
 
-def moment_update(model, model_ema, m):
-    """ model_ema = m * model_ema + (1 - m) model """
-    for p1, p2 in zip(model.parameters(), model_ema.parameters()):
-        p2.data.mul_(m).add_(1-m, p1.detach().data)
-
-
-def get_shuffle_ids(bsz):
-    """generate shuffle ids for ShuffleBN"""
-    forward_inds = torch.randperm(bsz).long().cuda()
-    backward_inds = torch.zeros(bsz).long().cuda()
-    value = torch.arange(bsz).long().cuda()
-    backward_inds.index_copy_(0, forward_inds, value)
-    return forward_inds, backward_inds
-
-
 def main():
 
     args = parse_option()
@@ -213,13 +212,18 @@ def main():
 
     # copy weights from `model' to `model_ema'
     if args.moco:
-        moment_update(model, model_ema, 0)
+        model_ema.load_state_dict(model.state_dict())
+        shuffle_bn = ShuffleBN(args.shuffle_bn, seed=args.shuffle_seed)
+        model_ema = shuffle_bn.convert(model_ema)
 
     # set the contrast memory and criterion
     if args.moco:
-        contrast = MemoryMoCo(128, n_data, args.nce_k, args.nce_t, args.softmax).cuda(args.gpu)
+        contrast = MemoryMoCo(128, n_data, args.nce_k, args.nce_t, args.softmax,
+                              storage=args.nce_storage, sync_free=args.sync_free).cuda(args.gpu)
     else:
-        contrast = MemoryInsDis(128, n_data, args.nce_k, args.nce_t, args.nce_m, args.softmax).cuda(args.gpu)
+        contrast = MemoryInsDis(128, n_data, args.nce_k, args.nce_t, args.nce_m, args.softmax,
+                                sampler=get_sampler(args.nce_sampler, n_data), storage=args.nce_storage,
+                                sync_free=args.sync_free).cuda(args.gpu)
 
     criterion = NCESoftmaxLoss() if args.softmax else NCECriterion(n_data)
     criterion = criterion.cuda(args.gpu)
@@ -244,6 +248,10 @@ def main():
                                             weight_decay=0)
             model_ema, optimizer_ema = amp.initialize(model_ema, optimizer_ema, opt_level=args.opt_level)
 
+    # momentum update of the key encoder
+    if args.moco:
+        ema = ModelEMA(model, model_ema, args.alpha, buffers=args.ema_buffers, every=args.ema_every)
+
     # optionally resume from a checkpoint
     args.start_epoch = 1
     if args.resume:
@@ -257,6 +265,9 @@ def main():
             contrast.load_state_dict(checkpoint['contrast'])
             if args.moco:
                 model_ema.load_state_dict(checkpoint['model_ema'])
+                if 'ema' in checkpoint:
+                    # step count, keeps the --ema_every updates in phase
+                    ema.load_state_dict(checkpoint['ema'])
 
             if args.amp and checkpoint['opt'].amp:
                 print('==> resuming amp state_dict')
@@ -269,6 +280,10 @@ def main():
         else:
             print("=> no checkpoint found at '{}'".format(args.resume))
 
+    # Z is calibrated once before training instead of being checked every step
+    Z = contrast.params[0] if args.moco else contrast.params[2]
+    args.calibrate = args.sync_free and not args.softmax and Z.item() < 0
+
     # tensorboard
     logger = tb_logger.Logger(logdir=args.tb_folder, flush_secs=2)
 
@@ -280,7 +295,8 @@ def main():
 
         time1 = time.time()
         if args.moco:
-            loss, prob = train_moco(epoch, train_loader, model, model_ema, contrast, criterion, optimizer, args)
+            loss, prob = train_moco(epoch, train_loader, model, model_ema, ema, shuffle_bn, contrast, criterion,
+                                     optimizer, args)
         else:
             loss, prob = train_ins(epoch, train_loader, model, contrast, criterion, optimizer, args)
         time2 = time.time()
@@ -303,6 +319,7 @@ def main():
             }
             if args.moco:
                 state['model_ema'] = model_ema.state_dict()
+                state['ema'] = ema.state_dict()
             if args.amp:
                 state['amp'] = amp.state_dict()
             save_file = os.path.join(args.model_folder, 'ckpt_epoch_{epoch}.pth'.format(epoch=epoch))
@@ -321,6 +338,7 @@ def main():
         }
         if args.moco:
             state['model_ema'] = model_ema.state_dict()
+            state['ema'] = ema.state_dict()
         if args.amp:
             state['amp'] = amp.state_dict()
         save_file = os.path.join(args.model_folder, 'current.pth')
@@ -360,6 +378,9 @@ def train_ins(epoch, train_loader, model, contrast, criterion, optimizer, opt):
 
         # ===================forward=====================
         feat = model(inputs)
+        if opt.calibrate:
+            contrast.calibrate(feat, index)
+            opt.calibrate = False
         out = contrast(feat, index)
 
         loss = criterion(out)
@@ -397,7 +418,7 @@ def train_ins(epoch, train_loader, model, contrast, criterion, optimizer, opt):
     return loss_meter.avg, prob_meter.avg
 
 
-def train_moco(epoch, train_loader, model, model_ema, contrast, criterion, optimizer, opt):
+def train_moco(epoch, train_loader, model, model_ema, ema, shuffle_bn, contrast, criterion, optimizer, opt):
     """
     one epoch training for instance discrimination
     """
@@ -432,15 +453,13 @@ def train_moco(epoch, train_loader, model, model_ema, contrast, criterion, optim
         # ===================forward=====================
         x1, x2 = torch.split(inputs, [3, 3], dim=1)
 
-        # ids for ShuffleBN
-        shuffle_ids, reverse_ids = get_shuffle_ids(bsz)
-
         feat_q = model(x1)
         with torch.no_grad():
-            x2 = x2[shuffle_ids]
-            feat_k = model_ema(x2)
-            feat_k = feat_k[reverse_ids]
+            feat_k = shuffle_bn(model_ema, x2)
 
+        if opt.calibrate:
+            contrast.calibrate(feat_q, feat_k)
+            opt.calibrate = False
         out = contrast(feat_q, feat_k)
 
         loss = criterion(out)
@@ -459,7 +478,7 @@ def train_moco(epoch, train_loader, model, model_ema, contrast, criterion, optim
         loss_meter.update(loss.item(), bsz)
         prob_meter.update(prob.item(), bsz)
 
-        moment_update(model, model_ema, opt.alpha)
+        ema.update()
 
         torch.cuda.synchronize()
         batch_time.update(time.time() - end)
@@ -1,5 +1,7 @@
 from __future__ import print_function
 
+import copy
+
 import torch
 import numpy as np
 
@@ -52,5 +54,135 @@ def accuracy(output, target, topk=(1,)):
         return res
 
 
+class ModelEMA(object):
+    """
+    model_ema = m * model_ema + (1 - m) * model, applied to all tensors at once with the
+    multi-tensor torch._foreach kernels instead of two launches per parameter.
+    buffers: also average the floating point buffers (BN running stats), integer ones are copied
+    every: update every `every` calls with momentum m ** every
+    device: when model_ema is not given, keep a copy of the model on `device` (e.g. 'cpu'); a copy
+        on another device than the model is stored as one flat tensor and updated by one transfer
+    """
+    def __init__(self, model, model_ema=None, momentum=0.999, buffers=False, every=1, device=None):
+        if model_ema is None:
+            model_ema = copy.deepcopy(model)
+            for p in model_ema.parameters():
+                p.requires_grad_(False)
+            if device is not None:
+                model_ema.to(device)
+        self.model = model
+        self.model_ema = model_ema
+        self.momentum = momentum
+        self.every = every
+        self.steps = 0
+
+        src = list(model.parameters())
+        dst = list(model_ema.parameters())
+        self.copies = []
+        if buffers:
+            for b1, b2 in zip(model.buffers(), model_ema.buffers()):
+                if b2.is_floating_point():
+                    src.append(b1)
+                    dst.append(b2)
+                else:
+                    self.copies.append((b1, b2))
+
+        self.flat = None
+        if dst[0].device != src[0].device:
+            # dst tensors become views of one flat buffer
+            self.flat = torch.cat([t.detach().reshape(-1) for t in dst])
+            for t, view in zip(dst, self.flat.split([t.numel() for t in dst])):
+                t.data = view.view_as(t)
+        self.src = [t.detach() for t in src]
+        self.dst = [t.detach() for t in dst]
+
+    @torch.no_grad()
+    def update(self, momentum=None):
+        self.steps += 1
+        if self.steps % self.every != 0:
+            return
+        m = (self.momentum if momentum is None else momentum) ** self.every
+        if self.flat is not None:
+            src = torch.cat([t.reshape(-1) for t in self.src]).to(self.flat.device, self.flat.dtype)
+            self.flat.mul_(m).add_(src, alpha=1 - m)
+        elif hasattr(torch, '_foreach_mul_'):
+            torch._foreach_mul_(self.dst, m)
+            torch._foreach_add_(self.dst, self.src, alpha=1 - m)
+        else:
+            for t1, t2 in zip(self.src, self.dst):
+                t2.mul_(m).add_(t1, alpha=1 - m)
+        for b1, b2 in self.copies:
+            b2.copy_(b1)
+
+    def state_dict(self):
+        return {'steps': self.steps}
+
+    def load_state_dict(self, state_dict):
+        self.steps = state_dict['steps']
+
+
+class KNNMonitor(object):
+    """
+    Weighted kNN accuracy of validation embeddings against the memory bank of a contrast module,
+    without dumping features: cosine top-k over chunks of `chunk_size` memory rows (views of the
+    bank, contrast.memory_rows), neighbours voting for their label with weight exp(sim / T).
+    labels[i] is the class of memory row i. Views: 'l' (feat_l vs memory_l), 'ab' (feat_ab vs
+    memory_ab) and 'l_ab' (sum of both similarities, as the concatenated features).
+    """
+    views = ['l', 'ab', 'l_ab']
+
+    def __init__(self, contrast, labels, k=200, T=0.07, chunk_size=65536):
+        self.contrast = contrast
+        self.labels = torch.as_tensor(labels, dtype=torch.long)
+        self.n_classes = int(self.labels.max()) + 1
+        self.k = k
+        self.T = T
+        self.chunk_size = chunk_size
+
+    @torch.no_grad()
+    def topk(self, feat_l, feat_ab, view):
+        """similarities and memory rows of the k nearest neighbours of the anchors"""
+        feats = {'l': [(0, feat_l)], 'ab': [(1, feat_ab)], 'l_ab': [(0, feat_l), (1, feat_ab)]}[view]
+        feats = [(v, torch.nn.functional.normalize(f.float(), dim=1)) for v, f in feats]
+        top_sim, top_idx = None, None
+        n = len(self.labels)
+        for start in range(0, n, self.chunk_size):
+            end = min(n, start + self.chunk_size)
+            sim = sum(f.mm(self.contrast.memory_rows(v, start, end).to(f.device).t()) for v, f in feats)
+            sim, idx = sim.topk(min(self.k, end - start), dim=1)
+            idx += start
+            if top_sim is not None:
+                sim, idx = torch.cat([top_sim, sim], 1), torch.cat([top_idx, idx], 1)
+                sim, order = sim.topk(min(self.k, sim.size(1)), dim=1)
+                idx = idx.gather(1, order)
+            top_sim, top_idx = sim, idx
+        return top_sim, top_idx
+
+    @torch.no_grad()
+    def predict(self, feat_l, feat_ab, view):
+        sim, idx = self.topk(feat_l, feat_ab, view)
+        labels = self.labels.to(idx.device)[idx]
+        votes = sim.new_zeros(sim.size(0), self.n_classes)
+        votes.scatter_add_(1, labels, sim.div(self.T).exp())
+        return votes.argmax(1)
+
+    @torch.no_grad()
+    def evaluate(self, embed, loader):
+        """
+        top-1 accuracy (%) of every view over `loader`, embed(inputs) returns (feat_l, feat_ab);
+        the caller puts the model in eval mode
+        """
+        correct = dict((view, 0) for view in self.views)
+        total = 0
+        for batch in loader:
+            inputs, target = batch[0], batch[1]
+            feat_l, feat_ab = embed(inputs)
+            target = target.to(feat_l.device)
+            for view in self.views:
+                correct[view] += (self.predict(feat_l, feat_ab, view) == target).sum().item()
+            total += target.size(0)
+        return dict((view, 100. * c / total) for view, c in correct.items())
+
+
 if __name__ == '__main__':
     meter = AverageMeter()